@@ -3,13 +3,24 @@ A socket wrapper that uses Event IO.
 """
 
 import socket
-import event
 import time
 import logging
 import errno
 import traceback
 import os
+import sys
+import signal
+import fcntl
+import math
+import struct
+import mmap
+import weakref
+import contextlib
+import select
+import heapq
+import threading
 from collections import deque
+from itertools import islice
 
 # TODO: Use new io objects from 2.6
 # 26 July 10 - I looked into this and a potential problem with io.StringIO is
@@ -19,15 +30,869 @@ from collections import deque
 #   https://agora.lighthouseapp.com/projects/47111/tickets/628-odd-amqp-error
 from cStringIO import StringIO
 
+# The event module (libevent) is the default backend but is optional, see
+# set_backend().
+try:
+  import event
+except ImportError:
+  event = None
+_libevent = event
+
+# asyncio is optional, see use_asyncio().  On 2.x it's provided by trollius.
+try:
+  import trollius as asyncio
+except ImportError:
+  try:
+    import asyncio
+  except ImportError:
+    asyncio = None
+
+# The most buffers that can be passed to a single writev call.
+try:
+  IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+  IOV_MAX = -1
+if IOV_MAX<=0:
+  IOV_MAX = 1024
+
+# Where there's no writev, vectored writes instead coalesce small queued
+# chunks into a single send of up to this many bytes.
+COALESCE_WRITE_SIZE = 64*1024
+
+# The smallest read when adapting the read size to the traffic.
+MIN_READ_SIZE = 4096
+
+# Python 2 doesn't define SO_REUSEPORT even where the kernel supports it.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+  15 if sys.platform.startswith('linux') else None)
+
+# Holds back partial segments while a socket is corked.  BSD calls it
+# TCP_NOPUSH.
+TCP_CORK = getattr(socket, 'TCP_CORK', None) or getattr(socket, 'TCP_NOPUSH', None)
+
+# Python 2 has no os.sendfile, os.splice or sendmsg, so use the C library's
+# sendfile, splice and writev where there are ones.
+try:
+  import ctypes
+  _libc = ctypes.CDLL( None, use_errno=True )
+except (ImportError, OSError):
+  _libc = None
+
+def _libc_func(name, argtypes):
+  """
+  Return a wrapper for a C library function that returns a count or -1 and
+  sets errno, which raises OSError on failure.  Returns None if there's no
+  such function.
+  """
+  func = getattr( _libc, name, None )
+  if func is None:
+    return None
+  func.argtypes = argtypes
+  func.restype = ctypes.c_ssize_t
+
+  def wrapper(*args):
+    rval = func( *args )
+    if rval<0:
+      err = ctypes.get_errno()
+      raise OSError( err, os.strerror(err) )
+    return rval
+  return wrapper
+
+def _libc_sendfile():
+  if _libc is None:
+    return None
+  func = _libc_func( 'sendfile64', [ ctypes.c_int, ctypes.c_int,
+    ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t ] )
+  if func is None:
+    return None
+
+  def sendfile(out_fd, in_fd, offset, count):
+    return func( out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)), count )
+  return sendfile
+
+def _libc_splice():
+  if _libc is None:
+    return None
+  func = _libc_func( 'splice', [ ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+    ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint ] )
+  if func is None:
+    return None
+
+  def splice(src, dst, count, flags=0):
+    return func( src, None, dst, None, count, flags )
+  return splice
+
+def _libc_writev():
+  if _libc is None:
+    return None
+  func = _libc_func( 'writev', [ ctypes.c_int, ctypes.c_void_p, ctypes.c_int ] )
+  if func is None:
+    return None
+
+  class iovec(ctypes.Structure):
+    _fields_ = [ ('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t) ]
+  as_buffer = ctypes.pythonapi.PyObject_AsReadBuffer
+  as_buffer.argtypes = [ ctypes.py_object, ctypes.POINTER(ctypes.c_void_p),
+    ctypes.POINTER(ctypes.c_ssize_t) ]
+  as_buffer.restype = ctypes.c_int
+
+  def writev(fd, bufs, offset=0):
+    """
+    Write the buffers in order, skipping the first offset bytes of the
+    first one, without copying them.
+    """
+    iov = (iovec * len(bufs))()
+    addr = ctypes.c_void_p()
+    size = ctypes.c_ssize_t()
+    for i, buf in enumerate(bufs):
+      as_buffer( buf, ctypes.byref(addr), ctypes.byref(size) )
+      iov[i].iov_base = (addr.value or 0) + offset
+      iov[i].iov_len = size.value - offset
+      offset = 0
+    return func( fd, iov, len(bufs) )
+  return writev
+
+def _os_splice():
+  if not hasattr(os, 'splice'):
+    return None
+
+  # The fourth argument of os.splice is offset_src, not flags.
+  def splice(src, dst, count, flags=0):
+    return os.splice( src, dst, count, flags=flags )
+  return splice
+
+# The chunk types whose memory writev can be given directly.
+_IOVEC_TYPES = (str, bytearray, buffer, mmap.mmap)
+
+_sendfile = getattr(os, 'sendfile', None) or _libc_sendfile()
+_writev = _libc_writev()
+_splice = _os_splice() or _libc_splice()
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+F_GETPIPE_SZ = getattr(fcntl, 'F_GETPIPE_SZ', 1032)
+
+class FileSegment(object):
+  """
+  Part of a file queued for writing by EventSocket.write_file().  It's sent
+  with sendfile, or from a memory map of the file where sendfile isn't
+  available or doesn't support the file.  The length is the number of bytes
+  still to send.
+  """
+
+  # Errors from sendfile that mean it can't be used for this file.
+  _SENDFILE_UNSUPPORTED = ( errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP )
+
+  # The dict is only allocated if something else is set on a segment.
+  __slots__ = ( '__dict__', 'fileobj', 'offset', 'count', '_use_sendfile',
+    '_map', '_map_offset' )
+
+  def __init__(self, fileobj, offset, count):
+    self.fileobj = fileobj
+    self.offset = offset
+    self.count = count
+    self._use_sendfile = _sendfile is not None
+    self._map = None
+    self._map_offset = 0
+
+  def __len__(self):
+    return self.count
+
+  def send(self, sock):
+    """
+    Send as much of the segment to sock as it will take.  Returns the number
+    of bytes sent.
+    """
+    if self._use_sendfile:
+      try:
+        nbytes = _sendfile( sock.fileno(), self.fileobj.fileno(), self.offset,
+          self.count )
+      except EnvironmentError, e:
+        if e.errno not in self._SENDFILE_UNSUPPORTED:
+          raise
+        self._use_sendfile = False
+    if not self._use_sendfile:
+      if self._map is None:
+        # Maps have to start on a page boundary.
+        self._map_offset = self.offset - self.offset % mmap.ALLOCATIONGRANULARITY
+        self._map = mmap.mmap( self.fileobj.fileno(),
+          self.offset + self.count - self._map_offset, access=mmap.ACCESS_READ,
+          offset=self._map_offset )
+      nbytes = sock.send( buffer(self._map, self.offset-self._map_offset,
+        self.count) )
+
+    if nbytes==0:
+      raise IOError( "file ended with %d bytes left to send"%(self.count) )
+    self.offset += nbytes
+    self.count -= nbytes
+    if not self.count and self._map is not None:
+      self._map.close()
+      self._map = None
+    return nbytes
+
+def _tail(data, offset):
+  """
+  Return data from offset onwards without copying it.
+  """
+  # 2.x buffer and mmap objects only support the old buffer protocol, so
+  # they can't be wrapped in a memoryview.
+  if isinstance(data, (buffer, mmap.mmap)):
+    return buffer( data, offset )
+  return memoryview( data )[offset:]
+
+def _nonblocking_pipe():
+  """
+  Return the (read, write) fds of a non-blocking pipe that isn't inherited
+  by exec'd processes.
+  """
+  fds = os.pipe()
+  for fd in fds:
+    fcntl.fcntl( fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK )
+    fcntl.fcntl( fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC )
+  return fds
+
+def _wake_pipe(fd):
+  """
+  Write a byte to a wakeup pipe so that the loop reading it wakes up.
+  """
+  try:
+    os.write( fd, '\0' )
+  except OSError, e:
+    # A full pipe will wake the loop anyway.
+    if e.errno!=errno.EAGAIN:
+      raise
+
+def _drain_pipe(fd):
+  """
+  Read everything waiting in a wakeup pipe.
+  """
+  try:
+    while os.read( fd, 4096 ):
+      pass
+  except OSError:
+    pass
+
+class SplicePipe(object):
+  """
+  A kernel pipe that carries data one way between two EventSockets joined
+  by EventSocket.splice().  The source splices into it as it's readable and
+  the destination splices out of it as it's writable.  If size is set, the
+  pipe is resized to hold that many bytes where the platform allows.
+  """
+
+  def __init__(self, source, dest, size=0):
+    self.source = source
+    self.dest = dest
+    (self.read_fd, self.write_fd) = _nonblocking_pipe()
+
+    self.capacity = 65536
+    try:
+      if size:
+        fcntl.fcntl( self.write_fd, F_SETPIPE_SZ, size )
+      self.capacity = fcntl.fcntl( self.write_fd, F_GETPIPE_SZ )
+    except IOError:
+      pass
+
+    # Bytes in the pipe, whether the source has reached EOF, and whether the
+    # destination has been shut down for writing after that.
+    self.pending = 0
+    self.eof = False
+    self.done = False
+
+  def close(self):
+    """
+    Close the pipe.
+    """
+    if self.read_fd is not None:
+      os.close( self.read_fd )
+      os.close( self.write_fd )
+      self.read_fd = self.write_fd = None
+
+class ReadBuffer(object):
+  """
+  A growable input buffer owned by an EventSocket.  Data lives in
+  buf[start:end]; any storage past end is spare capacity that recv_into()
+  fills directly so that it can be reused across reads.  Data consumed from
+  the front, as frames or through the peek(), consume(), readexactly() and
+  readuntil() cursor, only moves once it's at least half of the buffer.
+  If a frame handed out by next_frame() is still in use when the storage
+  needs to be resized, the data is moved to new storage and the frame keeps
+  the old.
+  """
+
+  # Every socket has one, so don't give each a dict as well.
+  __slots__ = ( '_buf', '_start', '_end', '_scanned', '_scan_sep' )
+
+  def __init__(self):
+    self._buf = bytearray()
+    self._start = 0
+    self._end = 0
+    # How far past start a search for a delimiter has looked, and for what.
+    self._scanned = 0
+    self._scan_sep = None
+
+  def __len__(self):
+    return self._end - self._start
+
+  def extend(self, data):
+    """
+    Append data to the buffer.
+    """
+    if self._start and self._start*2>=self._end:
+      self._compact()
+    try:
+      if self._end<len(self._buf):
+        # Trim spare capacity so that the bytearray handles any growth.
+        del self._buf[self._end:]
+      self._buf.extend( data )
+    except BufferError:
+      self._copy()
+      self._buf.extend( data )
+    self._end = len(self._buf)
+
+  def recv_into(self, sock, size):
+    """
+    Receive up to size bytes from sock directly into spare capacity, growing
+    the buffer if necessary.  Returns the number of bytes read.
+    """
+    if self._start==self._end:
+      self._start = self._end = self._scanned = 0
+    spare = len(self._buf) - self._end
+    if spare < size:
+      if self._start:
+        self._compact()
+        spare = len(self._buf) - self._end
+      if spare < size:
+        try:
+          self._buf.extend( bytearray(size-spare) )
+        except BufferError:
+          self._copy()
+          self._buf.extend( bytearray(size) )
+
+    nbytes = sock.recv_into( memoryview(self._buf)[self._end:], size )
+    self._end += nbytes
+    return nbytes
+
+  def _compact(self):
+    """
+    Drop consumed data from the front of the storage.
+    """
+    try:
+      del self._buf[:self._start]
+      self._end -= self._start
+      self._scanned = max( 0, self._scanned - self._start )
+      self._start = 0
+    except BufferError:
+      self._copy()
+
+  def _copy(self):
+    """
+    Move the data to new storage, leaving the old storage to any frames that
+    are still using it.
+    """
+    self._buf = self._buf[self._start:self._end]
+    self._scanned = max( 0, self._scanned - self._start )
+    self._start = 0
+    self._end = len(self._buf)
+
+  def next_frame(self, framing):
+    """
+    Return the next complete frame as a memoryview and consume it, or None
+    if the buffer doesn't hold a complete frame.
+    """
+    scanned = self._scanned
+    if self._scan_sep is not None:
+      # The last search was by readuntil()
+      scanned = self._start
+      self._scan_sep = None
+
+    frame = framing.decode( self._buf, self._start, self._end, scanned )
+    if frame is None:
+      self._scanned = self._end
+      return None
+    (start, end, self._start) = frame
+    self._scanned = self._start
+    return memoryview( self._buf )[start:end]
+
+  def peek(self, n=None):
+    """
+    Return up to n bytes, or all the data, as a memoryview without consuming
+    it.
+    """
+    end = self._end
+    if n is not None:
+      end = min( self._start+n, end )
+    return memoryview( self._buf )[self._start:end]
+
+  def consume(self, n):
+    """
+    Drop up to n bytes from the front of the buffer.
+    """
+    self._start = min( self._start+n, self._end )
+
+  def readexactly(self, n):
+    """
+    Consume and return n bytes as a memoryview, or None if there are fewer.
+    """
+    if self._end-self._start < n:
+      return None
+    self._start += n
+    return memoryview( self._buf )[self._start-n:self._start]
+
+  def readuntil(self, sep):
+    """
+    Consume and return the data up to and including sep as a memoryview, or
+    None if sep isn't buffered.  Only searches what has arrived since the
+    last search for the same sep.
+    """
+    start = self._start
+    if sep==self._scan_sep:
+      start = max( start, self._scanned-len(sep)+1 )
+    pos = self._buf.find( sep, start, self._end )
+    if pos<0:
+      self._scanned = self._end
+      self._scan_sep = sep
+      return None
+
+    start = self._start
+    self._start = self._scanned = pos+len(sep)
+    return memoryview( self._buf )[start:self._start]
+
+  def detach(self):
+    """
+    Return the buffered data as a bytearray and empty the buffer.  If there
+    is no spare capacity the storage is handed over without a copy, else a
+    slice is copied out and the storage is kept for the next recv_into().
+    """
+    if self._start==0 and self._end==len(self._buf):
+      rval = self._buf
+      self._buf = bytearray()
+    else:
+      rval = self._buf[self._start:self._end]
+    self._start = self._end = self._scanned = 0
+    return rval
+
+  def assign(self, data):
+    """
+    Replace the buffer contents with the bytearray data, taking ownership.
+    """
+    self._buf = data
+    self._start = self._scanned = 0
+    self._end = len(data)
+
+class LengthPrefixFraming(object):
+  """
+  Frames that start with their length as an unsigned integer of 1, 2, 4 or
+  8 bytes in 'big' or 'little' endian byte order, not counting the prefix.
+  If max_length is set, a longer frame raises ValueError.
+  """
+
+  _FORMATS = { 1:'B', 2:'H', 4:'I', 8:'Q' }
+
+  def __init__(self, size=4, byteorder='big', max_length=0):
+    if size not in self._FORMATS:
+      raise ValueError( "invalid length prefix size %s"%(str(size)) )
+    if byteorder not in ('big','little'):
+      raise ValueError( "invalid byte order %s"%(str(byteorder)) )
+    self._size = size
+    self._struct = struct.Struct(
+      (byteorder=='big' and '>' or '<') + self._FORMATS[size] )
+    self._max_length = max_length
+
+  def decode(self, buf, start, end, scanned):
+    """
+    Return the (start, end) of the first frame in buf[start:end] and where
+    the data after it starts, or None if there isn't a complete frame.
+    """
+    if end-start < self._size:
+      return None
+    length = self._struct.unpack_from( buf, start )[0]
+    if self._max_length and length>self._max_length:
+      raise ValueError( "frame of %d bytes is too long"%(length) )
+    start += self._size
+    if start+length > end:
+      return None
+    return (start, start+length, start+length)
+
+  def encode(self, data):
+    """
+    Return data as a frame.
+    """
+    return self._struct.pack( len(data) ) + data
+
+class DelimiterFraming(object):
+  """
+  Frames that end with a delimiter, such as lines ending in '\r\n'.  The
+  frames don't include the delimiter.  If max_length is set, buffering more
+  than that without a delimiter raises ValueError.
+  """
+
+  def __init__(self, delimiter='\r\n', max_length=0):
+    if not delimiter:
+      raise ValueError( "delimiter can't be empty" )
+    self._delimiter = delimiter
+    self._max_length = max_length
+
+  def decode(self, buf, start, end, scanned):
+    """
+    Return the (start, end) of the first frame in buf[start:end] and where
+    the data after it starts, or None if there isn't a complete frame.  Only
+    searches what has arrived since the last search ended at scanned.
+    """
+    pos = buf.find( self._delimiter,
+      max(start, scanned-len(self._delimiter)+1), end )
+    if pos<0:
+      if self._max_length and end-start>self._max_length:
+        raise ValueError( "no delimiter in %d bytes"%(end-start) )
+      return None
+    return (start, pos, pos+len(self._delimiter))
+
+  def encode(self, data):
+    """
+    Return data as a frame.
+    """
+    return data + self._delimiter
+
+class NetstringFraming(object):
+  """
+  Frames encoded as netstrings, i.e. '<length>:<data>,'.  If max_length is
+  set, a longer frame raises ValueError, as does a malformed netstring.
+  """
+
+  # Enough digits for any 64 bit length
+  _MAX_DIGITS = 20
+
+  def __init__(self, max_length=0):
+    self._max_length = max_length
+
+  def decode(self, buf, start, end, scanned):
+    """
+    Return the (start, end) of the first frame in buf[start:end] and where
+    the data after it starts, or None if there isn't a complete frame.
+    """
+    colon = buf.find( ':', start, min(end, start+self._MAX_DIGITS+1) )
+    if colon<0:
+      if end-start>self._MAX_DIGITS:
+        raise ValueError( "invalid netstring length" )
+      return None
+
+    digits = buf[start:colon]
+    if not digits.isdigit():
+      raise ValueError( "invalid netstring length %r"%(str(digits)) )
+    length = int( digits )
+    if self._max_length and length>self._max_length:
+      raise ValueError( "frame of %d bytes is too long"%(length) )
+
+    start = colon+1
+    if start+length >= end:
+      return None
+    if buf[start+length]!=ord(','):
+      raise ValueError( "netstring not terminated by ','" )
+    return (start, start+length, start+length+1)
+
+  def encode(self, data):
+    """
+    Return data as a frame.
+    """
+    return '%d:%s,'%(len(data), data)
+
+class TimerWheel(object):
+  """
+  A hashed timer wheel for socket inactivity timeouts.  Rather than deleting
+  and re-adding a libevent timer on every read and write, sockets record the
+  time of their last activity and a single periodic timer sweeps the slot for
+  the current tick, closing sockets whose deadline has passed and moving the
+  rest to the slot of their new deadline.  Timeouts are accurate to within
+  one resolution.  Enable it for all sockets by setting
+  EventSocket.timer_wheel.
+  """
+
+  def __init__(self, resolution=1.0, num_slots=256):
+    self._resolution = resolution
+    self._slots = [ set() for x in xrange(num_slots) ]
+    self._size = 0
+    self._tick_event = None
+
+    # The time as of the last tick, which sockets use as their activity time.
+    self.now = time.time()
+    self._tick = self._tick_for( self.now )
+
+  def _tick_for(self, t):
+    """
+    Return the absolute tick number for a time.
+    """
+    return int( t / self._resolution )
+
+  def add(self, sock):
+    """
+    Start tracking the inactivity timeout of a socket.
+    """
+    if not self._tick_event:
+      self.now = time.time()
+      self._tick = self._tick_for( self.now )
+      self._tick_event = event.timeout( self._resolution, self._tick_cb )
+
+    sock._last_activity = self.now
+    self._schedule( sock, self.now + sock._inactive_timeout )
+    self._size += 1
+
+  def remove(self, sock):
+    """
+    Stop tracking a socket.
+    """
+    slot = self._slots[ sock._timer_slot ]
+    if sock in slot:
+      slot.remove( sock )
+      self._size -= 1
+
+  def _schedule(self, sock, deadline):
+    """
+    Put a socket in the slot for its deadline, which is never earlier than
+    the next tick.
+    """
+    tick = max( self._tick_for(deadline), self._tick+1 )
+    sock._timer_slot = tick % len(self._slots)
+    self._slots[ sock._timer_slot ].add( sock )
+
+  def _tick_cb(self):
+    """
+    Periodic timer callback that closes sockets which have been inactive too
+    long.
+    """
+    self.now = time.time()
+    last_tick = self._tick
+    self._tick = self._tick_for( self.now )
+    num_slots = len(self._slots)
+
+    # Sweep every tick since the last, but no more than one full rotation.
+    expired = []
+    for tick in xrange( max(last_tick+1, self._tick-num_slots+1), self._tick+1 ):
+      slot = self._slots[ tick % num_slots ]
+      if not slot:
+        continue
+      self._slots[ tick % num_slots ] = set()
+      for sock in slot:
+        deadline = sock._last_activity + sock._inactive_timeout
+        if deadline<=self.now:
+          expired.append( sock )
+        else:
+          self._schedule( sock, deadline )
+
+    self._size -= len(expired)
+    for sock in expired:
+      sock._timer_wheel = None
+      sock._protected_cb( sock._inactive_cb )
+
+    if self._size:
+      return True
+    self._tick_event = None
+    return None
+
+class Histogram(object):
+  """
+  A histogram with a bucket for each power of two, cheap enough to update on
+  every callback.
+  """
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0.0
+    self.max = 0
+    # Map of base 2 exponent to count
+    self._buckets = {}
+
+  def add(self, value):
+    """
+    Record a value.
+    """
+    self.count += 1
+    self.total += value
+    if value>self.max:
+      self.max = value
+    exp = math.frexp( value )[1]
+    self._buckets[exp] = self._buckets.get(exp, 0) + 1
+
+  def snapshot(self):
+    """
+    Return a dict of the count, mean and max, and the counts in each bucket
+    keyed by the bucket's upper bound.
+    """
+    return {
+      'count' : self.count,
+      'mean' : self.total/self.count if self.count else 0,
+      'max' : self.max,
+      'buckets' : dict( (2.0**exp, n) for exp,n in self._buckets.iteritems() ),
+    }
+
+class IOStats(object):
+  """
+  I/O counters for a socket, or for all sockets in the process.  Buffer sizes
+  are the largest seen, and closes are counted by reason.  If histograms is
+  True, the latency of each read_cb call is also recorded.
+  """
+
+  COUNTERS = ( 'bytes_in', 'bytes_out', 'recv_calls', 'send_calls', 'eagain',
+    'partial_writes', 'accepts', 'read_buf_high', 'write_buf_high' )
+
+  def __init__(self, histograms=False):
+    for name in self.COUNTERS:
+      setattr( self, name, 0 )
+    self.closes = {}
+    self.read_cb_latency = Histogram() if histograms else None
+
+  def snapshot(self):
+    """
+    Return the current values as a dict.
+    """
+    rval = dict( (name, getattr(self,name)) for name in self.COUNTERS )
+    rval['closes'] = dict( self.closes )
+    if self.read_cb_latency:
+      rval['read_cb_latency'] = self.read_cb_latency.snapshot()
+    return rval
+
+# Totals for every socket that collects stats, and the open ones among them.
+global_stats = IOStats( histograms=True )
+_stats_sockets = weakref.WeakSet()
+
+def stats_snapshot(sockets=False):
+  """
+  Return a snapshot of the I/O stats of all sockets created with stats
+  enabled.  If sockets is True, also include a list of snapshots of each open
+  socket, with its peer, to find the busiest connections.
+  """
+  rval = global_stats.snapshot()
+  if sockets:
+    rval['sockets'] = []
+    for sock in list(_stats_sockets):
+      snap = sock._stats.snapshot()
+      snap['peer'] = sock._peername
+      rval['sockets'].append( snap )
+  return rval
+
+class CallbackProfiler(object):
+  """
+  Times every callback that EventSocket runs through _protected_cb, which
+  covers reads, writes, accepts, inactivity timeouts and the user's read_cb
+  and accept_cb.  Latency is kept in a Histogram for each callback name, and
+  for each open socket by peer.  Calls to read_cb or message_cb are named
+  after the user's function.  Any call that blocks the loop for
+  slow_threshold seconds or more is passed to slow_cb as (sock, name,
+  seconds), or else logged as a warning if there's a logger.  Enable it for
+  all sockets by setting EventSocket.profiler.
+  """
+
+  def __init__(self, slow_threshold=0.1, slow_cb=None, logger=None):
+    self._slow_threshold = slow_threshold
+    self._slow_cb = slow_cb
+    self._logger = logger
+    self.callbacks = {}
+    self.peers = {}
+    self.slow_calls = 0
+
+  def call(self, sock, cb, args, kwargs):
+    """
+    Call cb(*args, **kwargs) on behalf of sock and record how long it took.
+    """
+    name = getattr( cb, '__name__', None ) or repr(cb)
+    if name=='_parent_read_timer_cb':
+      user_cb = sock._parent_read_cb or sock._parent_message_cb
+      if user_cb:
+        name = getattr( user_cb, '__name__', None ) or repr(user_cb)
+
+    start = time.time()
+    try:
+      return cb(*args, **kwargs)
+    finally:
+      self._record( sock, name, time.time()-start )
+
+  def _record(self, sock, name, elapsed):
+    """
+    Record the latency of a callback.
+    """
+    hist = self.callbacks.get( name )
+    if hist is None:
+      hist = self.callbacks[name] = Histogram()
+    hist.add( elapsed )
+
+    # Don't hold on to peers after they've closed.
+    if not sock._closed:
+      hist = self.peers.get( sock._peername )
+      if hist is None:
+        hist = self.peers[sock._peername] = Histogram()
+      hist.add( elapsed )
+
+    if self._slow_threshold and elapsed>=self._slow_threshold:
+      self.slow_calls += 1
+      if self._slow_cb:
+        self._slow_cb( sock, name, elapsed )
+      elif self._logger:
+        self._logger.warning( "%s for %s blocked the loop for %.3f seconds",
+          name, sock._peername, elapsed )
+
+  def forget(self, sock):
+    """
+    Drop the latency of a socket that has closed.
+    """
+    self.peers.pop( sock._peername, None )
+
+  def snapshot(self):
+    """
+    Return the latency of each callback and peer, and the number of slow
+    calls, as a dict.
+    """
+    return {
+      'callbacks' : dict( (k,h.snapshot()) for k,h in self.callbacks.iteritems() ),
+      'peers' : dict( (k,h.snapshot()) for k,h in self.peers.iteritems() ),
+      'slow_calls' : self.slow_calls,
+    }
+
 class EventSocket(object):
   """
   A socket wrapper which uses libevent.
   """
 
+  # Set to a TimerWheel to track inactivity timeouts of all sockets with it.
+  timer_wheel = None
+
+  # Set to a CallbackProfiler to time the callbacks of all sockets.
+  profiler = None
+
+  # Servers may hold many thousands of mostly idle sockets, so keep the
+  # attributes in slots rather than a dict per instance.  The __dict__ slot is
+  # only allocated if something outside of these is set on a socket, so that
+  # applications and tests can still do that.
+  __slots__ = (
+    '__dict__', '__weakref__',
+    '_debug', '_logger', '_sock', '_peername', '_closed', '_error_msg',
+    '_close_reason',
+    '_read_event', '_write_event', '_accept_event', '_connect_event',
+    '_connect_timeout_event', '_pending_read_cb_event', '_inactive_event',
+    '_inactive_timeout', '_last_activity', '_timer_wheel', '_timer_slot',
+    '_max_read_buffer', '_accept_burst', '_recv_into', '_sync_read',
+    '_drain_budget', '_drain_reads', '_max_read_size', '_min_read_size',
+    '_read_size', '_read_buf', '_read_paused', '_read_high_water',
+    '_read_buf_full', '_throttled_sock', '_throttled',
+    '_vectored_writes', '_write_buf', '_write_offset', '_write_buf_bytes',
+    '_write_high_water', '_write_low_water', '_write_paused',
+    '_cork_depth', '_cork_buf', '_tcp_corked',
+    '_splice_peer', '_splice_out', '_splice_in',
+    '_parent_accept_cb', '_parent_read_cb', '_parent_message_cb', '_framing',
+    '_parent_error_cb', '_parent_close_cb', '_parent_output_empty_cb',
+    '_parent_connect_cb', '_parent_write_paused_cb',
+    '_parent_write_resumed_cb',
+    '_stats_level', '_stats',
+  )
+
   def __init__( self, family=socket.AF_INET, type=socket.SOCK_STREAM, \
                 protocol=socket.IPPROTO_IP, read_cb=None, accept_cb=None, \
                 close_cb=None, error_cb=None, output_empty_cb=None, sock=None, \
-                debug=False, logger=None, max_read_buffer=0, **kwargs):
+                debug=False, logger=None, max_read_buffer=0, recv_into=False, \
+                vectored_writes=False, write_high_water=0, write_low_water=0, \
+                write_paused_cb=None, write_resumed_cb=None, read_high_water=0, \
+                connect_cb=None, accept_burst=1, stats=0, sync_read=False,
+                min_read_size=0, max_read_size=0, drain_budget=0,
+                drain_reads=16, framing=None, message_cb=None, **kwargs):
     """
     Initialize the socket.  If no read_cb defined, socket will only be used
     for reading.  If this socket will be used for accepting new connections,
@@ -36,8 +901,50 @@ class EventSocket(object):
     error_cb will be called if there are any errors on the socket.  The args
     to it will be this socket, an error message, and an optional exception.
     The close_cb will be called when this socket closes, with this socket as
-    its argument.  If needed, you can wrap an existing socket by setting the
-    sock argument to a socket object.
+    its argument.  The connect_cb will be called with this socket once a
+    connect() has completed.  If needed, you can wrap an existing socket by
+    setting the sock argument to a socket object.
+
+    If recv_into is True, data is received directly into a buffer owned by
+    the socket rather than allocating a new string for every read.  If
+    vectored_writes is True, the write buffer is flushed with as few writev
+    calls as possible rather than one send per write().
+
+    If write_high_water is set, write_paused_cb is called with this socket
+    when the unsent output exceeds that many bytes, and write_resumed_cb is
+    called once it drains to write_low_water bytes or less.  See throttle().
+
+    A non-blocking listening socket will accept up to accept_burst
+    connections each time it becomes readable.
+
+    If read_high_water is set, reading from the socket is paused whenever
+    the input buffer holds at least that many bytes, and resumes once read()
+    drains it.  Unlike max_read_buffer, which closes the socket, this leaves
+    the sender to be slowed down by TCP flow control.
+
+    If sync_read is True, read_cb is called as soon as data is read rather
+    than from a zero delay timer, which saves a loop iteration per read at
+    the cost of giving other sockets less of a chance to run.
+
+    Each read asks for up to SO_RCVBUF bytes, which is queried once and
+    cached.  If max_read_size is set, the size of each read instead adapts to
+    recent reads, starting at min_read_size (or MIN_READ_SIZE), doubling when
+    a read fills it and halving when a read uses a quarter of it or less, so
+    that mostly idle connections don't receive into huge buffers.  If
+    drain_budget is set, a non-blocking socket keeps reading each time it's
+    readable until it would block, a read comes up short, or it has read
+    drain_budget bytes or drain_reads times, whichever is first.
+
+    Instead of read_cb, set framing to a LengthPrefixFraming,
+    DelimiterFraming or NetstringFraming and message_cb will be called with
+    this socket and each complete frame as a memoryview.  The frames refer to
+    the input buffer without copying it, so they're only valid until
+    message_cb returns; call tobytes() on one to keep it.  If the input can't
+    be framed, error_cb is called and the socket closed.
+
+    If stats is 1, I/O counters are kept for this socket and added to
+    global_stats, see stats_snapshot().  If it's 2, read_cb latency is
+    recorded too.  Accepted sockets inherit the setting.
     """
     self._debug = debug
     self._logger = logger
@@ -50,6 +957,7 @@ class EventSocket(object):
     self._write_event = None
     self._accept_event = None
     self._connect_event = None
+    self._connect_timeout_event = None
     self._pending_read_cb_event = None
 
     # Cache the peername so we can include it in logs even if the socket
@@ -63,37 +971,68 @@ class EventSocket(object):
       try:
         self._peername = "%s:%d"%self._sock.getpeername()
         # Like connect(), only initialize these if the socket is already connected.
+        # The write event is created by the first write.
         self._read_event = event.read( self._sock, self._protected_cb, self._read_cb )
-        self._write_event = event.write( self._sock, self._protected_cb, self._write_cb )
       except socket.error, e:
         # unconnected
         pass
     else:
       self._sock = socket.socket(family, type, protocol)
 
-    # wholesale binding of stuff we don't need to alter or intercept
-    self.listen = self._sock.listen
-    self.setsockopt = self._sock.setsockopt
-    self.fileno = self._sock.fileno
-    self.getpeername = self._sock.getpeername
-    self.getsockname = self._sock.getsockname
-    self.getsockopt = self._sock.getsockopt
-    self.setblocking = self._sock.setblocking  # is this correct?
-    self.settimeout = self._sock.settimeout
-    self.gettimeout = self._sock.gettimeout
-    self.shutdown = self._sock.shutdown
 
     self._max_read_buffer = max_read_buffer
+    self._accept_burst = accept_burst
+    self._recv_into = recv_into
+    self._sync_read = sync_read
+    self._drain_budget = drain_budget
+    self._drain_reads = drain_reads
+    # The size of the next recv, 0 until SO_RCVBUF is cached if not adaptive.
+    self._max_read_size = max_read_size
+    self._min_read_size = 0
+    self._read_size = 0
+    if max_read_size:
+      self._min_read_size = min( min_read_size or MIN_READ_SIZE, max_read_size )
+      self._read_size = self._min_read_size
+    self._vectored_writes = vectored_writes
     #self._write_buf = []
     self._write_buf = deque()
+    # Number of bytes already sent from the head of the write buffer.
+    self._write_offset = 0
+    # Running count of unsent bytes in the write buffer.
+    self._write_buf_bytes = 0
+    self._write_high_water = write_high_water
+    self._write_low_water = write_low_water
+    self._write_paused = False
+    # While corked, small writes are gathered into _cork_buf, the tail of the
+    # write buffer, and TCP_CORK is held until the write buffer drains.
+    self._cork_depth = 0
+    self._cork_buf = None
+    self._tcp_corked = False
+    # The socket that we stop reading from while writes are paused, and
+    # whether reading on this socket has been stopped by another.
+    self._throttled_sock = None
+    self._throttled = False
+    # Reading may also be paused explicitly or by the read high watermark.
+    self._read_paused = False
+    self._read_high_water = read_high_water
+    self._read_buf_full = False
     #self._read_buf = StringIO()
-    self._read_buf = bytearray()
+    self._read_buf = ReadBuffer()
+    # The socket joined to this one by splice(), and the pipes to and from it
+    self._splice_peer = None
+    self._splice_out = None
+    self._splice_in = None
 
     self._parent_accept_cb = accept_cb
     self._parent_read_cb = read_cb
+    self._parent_message_cb = message_cb
+    self._framing = framing
     self._parent_error_cb = error_cb
     self._parent_close_cb = close_cb
     self._parent_output_empty_cb = output_empty_cb
+    self._parent_connect_cb = connect_cb
+    self._parent_write_paused_cb = write_paused_cb
+    self._parent_write_resumed_cb = write_resumed_cb
 
     # This is the pending global error message.  It's sort of a hack, but it's
     # used for __protected_cb in much the same way as errno.  This prevents
@@ -104,8 +1043,17 @@ class EventSocket(object):
     self._closed = False
 
     self._inactive_event = None
+    self._timer_wheel = None
     self.set_inactive_timeout( 0 )
 
+    # Why the socket was closed, if not by calling close()
+    self._close_reason = None
+    self._stats_level = stats
+    self._stats = None
+    if stats:
+      self._stats = IOStats( histograms=stats>1 )
+      _stats_sockets.add( self )
+
   @property
   def closed(self):
     '''
@@ -113,6 +1061,54 @@ class EventSocket(object):
     '''
     return self._closed
 
+  @property
+  def write_paused(self):
+    '''
+    Return whether the output has exceeded the write high watermark and not
+    yet drained to the low watermark.
+    '''
+    return self._write_paused
+
+  @property
+  def reading_paused(self):
+    '''
+    Return whether reading from the socket is paused, either explicitly,
+    by throttle() or by the read high watermark.
+    '''
+    return self._read_paused or self._throttled or self._read_buf_full
+
+  @property
+  def stats(self):
+    '''
+    Return the IOStats of this socket, or None if it isn't collecting them.
+    '''
+    return self._stats
+
+  @property
+  def pending_write_bytes(self):
+    '''
+    Return the number of bytes buffered for writing that have not been sent.
+    '''
+    return self._write_buf_bytes
+
+  @property
+  def pending_write_chunks(self):
+    '''
+    Return the number of chunks in the write buffer.
+    '''
+    if self._write_buf is None:
+      return 0
+    return len(self._write_buf)
+
+  @property
+  def pending_read_bytes(self):
+    '''
+    Return the number of bytes buffered for reading.
+    '''
+    if self._read_buf is None:
+      return 0
+    return len(self._read_buf)
+
   def close(self):
     """
     Close the socket.
@@ -131,12 +1127,18 @@ class EventSocket(object):
     if self._inactive_event:
       self._inactive_event.delete()
       self._inactive_event = None
+    if self._timer_wheel:
+      self._timer_wheel.remove( self )
+      self._timer_wheel = None
     if self._write_event:
       self._write_event.delete()
       self._write_event = None
     if self._connect_event:
       self._connect_event.delete()
       self._connect_event = None
+    if self._connect_timeout_event:
+      self._connect_timeout_event.delete()
+      self._connect_timeout_event = None
 
     if self._sock:
       self._sock.close()
@@ -155,10 +1157,30 @@ class EventSocket(object):
       self._parent_read_cb = None
       self._error_msg = "error processing remaining socket input buffer"
       self._protected_cb( cb, self )
+    elif self._parent_message_cb and len(self._read_buf)>0:
+      cb = self._parent_message_cb
+      self._parent_message_cb = None
+      self._error_msg = "error processing remaining socket input buffer"
+      self._protected_cb( self._dispatch_messages, cb )
+
+    if self._stats and not self._closed:
+      self._count_close()
+    if self.profiler:
+      self.profiler.forget( self )
 
     # Only mark as closed after socket is really closed, we've flushed buffered
     # input, and we're calling back to close handlers.
     self._closed = True
+
+    # Either end of a splice closing closes the other.
+    if self._splice_peer:
+      peer = self._splice_peer
+      self._splice_peer = None
+      self._splice_out.close()
+      self._splice_out = self._splice_in = None
+      if not peer._closed:
+        peer._close_reason = self._close_reason
+        peer.close()
     if self._parent_close_cb:
       self._parent_close_cb( self )
     
@@ -170,15 +1192,25 @@ class EventSocket(object):
       self._inactive_event.delete()
       self._inactive_event = None
     
+    # Nothing more will be written, so let the throttled socket read again.
+    if self._throttled_sock:
+      self._throttled_sock._set_throttled( False )
+      self._throttled_sock = None
+
     # Delete references to callbacks to help garbage collection
     self._parent_accept_cb = None
     self._parent_read_cb = None
+    self._parent_message_cb = None
     self._parent_error_cb = None
     self._parent_close_cb = None
     self._parent_output_empty_cb = None
+    self._parent_connect_cb = None
+    self._parent_write_paused_cb = None
+    self._parent_write_resumed_cb = None
     
     # Clear buffers
     self._write_buf = None
+    self._write_buf_bytes = 0
     self._read_buf = None
 
   def accept(self):
@@ -187,6 +1219,36 @@ class EventSocket(object):
     """
     pass
 
+  # Pass through the socket methods that we don't need to alter or intercept.
+  # These used to be bound on to each instance, which cost a bound method
+  # apiece per socket.
+  def setsockopt(self, *args):
+    return self._sock.setsockopt( *args )
+
+  def getsockopt(self, *args):
+    return self._sock.getsockopt( *args )
+
+  def fileno(self):
+    return self._sock.fileno()
+
+  def getpeername(self):
+    return self._sock.getpeername()
+
+  def getsockname(self):
+    return self._sock.getsockname()
+
+  def setblocking(self, flag):
+    return self._sock.setblocking( flag )
+
+  def settimeout(self, t):
+    return self._sock.settimeout( t )
+
+  def gettimeout(self):
+    return self._sock.gettimeout()
+
+  def shutdown(self, how):
+    return self._sock.shutdown( how )
+
   def _set_read_cb(self, cb):
     """
     Set the read callback.  If there's data in the output buffer, immediately
@@ -194,37 +1256,115 @@ class EventSocket(object):
     """
     self._parent_read_cb = cb
     #if self._read_buf.tell()>0 and self._parent_read_cb!=None and self._pending_read_cb_event==None:
-    if len(self._read_buf)>0 and self._parent_read_cb!=None and self._pending_read_cb_event==None:
+    if len(self._read_buf)>0 and (self._parent_read_cb or self._parent_message_cb) \
+        and self._pending_read_cb_event==None:
       self._pending_read_cb_event = \
         event.timeout( 0, self._protected_cb, self._parent_read_timer_cb )
 
+  def _set_message_cb(self, cb):
+    """
+    Set the message callback.  If there's data in the input buffer,
+    immediately setup a call.
+    """
+    self._parent_message_cb = cb
+    self._set_read_cb( self._parent_read_cb )
+
   # Allow someone to change the various callbacks.
   read_cb =   property( fset=_set_read_cb )
+  message_cb = property( fset=_set_message_cb )
   accept_cb = property( fset=lambda self,func: setattr(self, '_parent_accept_cb', func ) )
   close_cb =  property( fset=lambda self,func: setattr(self, '_parent_close_cb', func ) )
   error_cb =  property( fset=lambda self,func: setattr(self, '_parent_error_cb', func ) )
   output_empty_cb = property( fset=lambda self,func: setattr(self, '_parent_output_empty_cb',func) )
+  connect_cb = property( fset=lambda self,func: setattr(self, '_parent_connect_cb',func) )
+  write_paused_cb = property( fset=lambda self,func: setattr(self, '_parent_write_paused_cb',func) )
+  write_resumed_cb = property( fset=lambda self,func: setattr(self, '_parent_write_resumed_cb',func) )
 
-  def bind(self, *args):
+  def throttle(self, sock):
     """
-    Bind the socket.
+    Stop reading from sock whenever writes to this socket are paused by the
+    write high watermark, and start again when they resume.  A proxy should
+    throttle each side of a connection with the other so that a slow peer
+    limits how much is buffered rather than growing memory without bound.
     """
-    if self._debug:
-      self._logger.debug( "binding to %s", str(args) )
+    self._throttled_sock = sock
+    if self._write_paused:
+      sock._set_throttled( True )
 
-    self._sock.bind( *args )
-    self._peername = "%s:%d"%self.getsockname()
+  def pause_reading(self):
+    """
+    Stop reading from the socket until resume_reading() is called.  Any data
+    that is already buffered will still be passed to read_cb.
+    """
+    self._read_paused = True
+    self._update_read_event()
 
+  def resume_reading(self):
+    """
+    Resume reading from the socket after pause_reading().
+    """
+    self._read_paused = False
+    self._update_read_event()
+
+  def _set_throttled(self, throttled):
+    """
+    Stop or restart reading from this socket on behalf of another.
+    """
+    self._throttled = throttled
+    self._update_read_event()
+
+  def _check_read_buf(self):
+    """
+    Resume reading if the input buffer has drained below the read high
+    watermark.
+    """
+    if self._read_buf_full and len(self._read_buf)<self._read_high_water:
+      self._read_buf_full = False
+      self._update_read_event()
+
+  def _update_read_event(self):
+    """
+    Add or delete the read event according to whether reading is paused.
+    """
+    if self._read_event:
+      if self.reading_paused:
+        self._read_event.delete()
+      elif not self._read_event.pending():
+        self._read_event.add()
+
+  def bind(self, *args):
+    """
+    Bind the socket.
+    """
+    if self._debug:
+      self._logger.debug( "binding to %s", str(args) )
+
+    self._sock.bind( *args )
+    self._start_accepting()
+
+  def _start_accepting(self):
+    """
+    Start accepting connections on a bound socket.
+    """
+    self._peername = "%s:%d"%self.getsockname()
     self._accept_event = event.read( self, self._protected_cb, self._accept_cb )
 
+  def listen(self, backlog=socket.SOMAXCONN):
+    """
+    Listen for connections.  The backlog defaults to the system maximum so
+    that bursts of connections aren't refused before they can be accepted.
+    """
+    self._sock.listen( backlog )
+
   def connect(self, *args, **kwargs):
     '''
     Connect to the socket. If currently non-blocking, will return immediately
     and call close_cb when the timeout is reached. If timeout_at is a float,
     will wait until that time and then call the close_cb. Otherwise, it will
     set timeout_at as time()+timeout, where timeout is a float argument or the
-    current timeout value of the socket. The check interval for successful
-    connection on a non-blocking socket is 100ms.
+    current timeout value of the socket. On a non-blocking socket, connection
+    completes when the socket becomes writable, at which point connect_cb is
+    called with this socket.
 
     IMPORTANT: If you want the socket to timeout at all in non-blocking mode,
     you *must* pass in either a relative timout in seconds, or an absolute 
@@ -245,36 +1385,31 @@ class EventSocket(object):
 
   def _connect_cb(self, timeout_at, *args, **kwargs):
     '''
-    Local support for synch and asynch connect. Required because 
-    `event.timeout` doesn't support kwargs. They are spec'd though so that
+    Local support for synch and asynch connect. The kwargs are spec'd so that
     we can branch how exceptions are handled. 
     '''
     err = self._sock.connect_ex( *args )
 
     if not err:
-      self._peername = "%s:%d"%self._sock.getpeername()
-      self._read_event = event.read( self._sock, self._protected_cb, self._read_cb )
-      self._write_event = event.write( self._sock, self._protected_cb, self._write_cb )
-      
-      if self._connect_event:
-        self._connect_event.delete()
-        self._connect_event = None
+      self._connected()
 
     elif err in (errno.EINPROGRESS,errno.EALREADY):
-      # Only track timeout if we're about to re-schedule. Should only receive
-      # these on a non-blocking socket.
+      # Should only receive these on a non-blocking socket.
       if isinstance(timeout_at,float) and time.time()>timeout_at:
         self._error_msg = 'timeout connecting to %s'%str(args)
+        self._close_reason = 'connect_timeout'
         self.close()
         return
       
       if self._connect_event:
         self._connect_event.delete()
 
-      # Checking every 100ms seems to be a reasonable amount of frequency. If
-      # requested this too can be configurable.
-      self._connect_event = event.timeout(0.1, self._connect_cb, 
-        timeout_at, *args)
+      # The socket becomes writable when the connection completes or fails.
+      self._connect_event = event.write( self._sock, self._protected_cb,
+        self._connect_ready_cb, args )
+      if isinstance(timeout_at,float) and not self._connect_timeout_event:
+        self._connect_timeout_event = event.timeout( timeout_at-time.time(),
+          self._protected_cb, self._connect_timeout_cb, args )
     else:
       if self._connect_event:
         self._connect_event.delete()
@@ -287,22 +1422,86 @@ class EventSocket(object):
       else:
         self._handle_error( serr )
 
+  def _connect_ready_cb(self, args):
+    '''
+    Callback when a non-blocking connection has completed or failed.
+    '''
+    self._error_msg = 'error connecting to %s'%str(args)
+    self._connect_event = None
+    if self._connect_timeout_event:
+      self._connect_timeout_event.delete()
+      self._connect_timeout_event = None
+
+    err = self._sock.getsockopt( socket.SOL_SOCKET, socket.SO_ERROR )
+    if not err:
+      self._connected()
+    else:
+      self._error_msg = os.strerror(err)
+      self._handle_error( socket.error(err, self._error_msg) )
+
+    # never reschedule
+    return None
+
+  def _connect_timeout_cb(self, args):
+    '''
+    Callback when a non-blocking connection has not completed in time.
+    '''
+    self._connect_timeout_event = None
+    self._error_msg = 'timeout connecting to %s'%str(args)
+    self._close_reason = 'connect_timeout'
+    self.close()
+
+  def _connected(self):
+    '''
+    Start reading and writing on a newly connected socket.
+    '''
+    self._peername = "%s:%d"%self._sock.getpeername()
+    self._read_event = event.read( self._sock, self._protected_cb, self._read_cb )
+    if self.reading_paused:
+      self._read_event.delete()
+    # Flush anything written or spliced in while connecting.
+    if len(self._write_buf)>0 or (self._splice_in and self._splice_in.pending):
+      self._schedule_write()
+    
+    if self._connect_event:
+      self._connect_event.delete()
+      self._connect_event = None
+    if self._connect_timeout_event:
+      self._connect_timeout_event.delete()
+      self._connect_timeout_event = None
+
+    if self._parent_connect_cb:
+      self._parent_connect_cb( self )
+
   def set_inactive_timeout(self, t):
     """
     Set the inactivity timeout.  If is None or 0, there is no activity timeout.
     If t>0 then socket will automatically close if there has been no activity
     after t seconds (float supported).  Will raise TypeError if <t> is invalid.
+    If EventSocket.timer_wheel is set, the timeout is tracked by that wheel.
     """
     if t==None or t==0:
       if self._inactive_event:
         self._inactive_event.delete()
         self._inactive_event = None
+      if self._timer_wheel:
+        self._timer_wheel.remove( self )
+        self._timer_wheel = None
       self._inactive_timeout = 0
     elif isinstance(t,(int,long,float)):
       if self._inactive_event:
         self._inactive_event.delete()
-      self._inactive_event = event.timeout( t, self._inactive_cb )
+        self._inactive_event = None
+      if self._timer_wheel:
+        self._timer_wheel.remove( self )
+        self._timer_wheel = None
       self._inactive_timeout = t
+
+      if self.timer_wheel:
+        self._timer_wheel = self.timer_wheel
+        self._timer_wheel.add( self )
+      else:
+        self._inactive_event = event.timeout( t, self._inactive_cb )
     else:
       raise TypeError( "invalid timeout %s"%(str(t)) )
    
@@ -334,7 +1533,10 @@ class EventSocket(object):
     rval = None
 
     try:
-      rval = cb(*args, **kwargs)
+      if self.profiler:
+        rval = self.profiler.call( self, cb, args, kwargs )
+      else:
+        rval = cb(*args, **kwargs)
     except Exception, e:
       self._handle_error( e )
 
@@ -346,16 +1548,71 @@ class EventSocket(object):
     Accept callback from libevent.
     """
     self._error_msg = "error accepting new socket"
-    (conn, addr) = self._sock.accept()
+
+    # Only a non-blocking listener can accept until EAGAIN without blocking
+    # the loop.  Python has no accept4, so set the flags it would have set on
+    # each new socket straight after accepting it.
+    burst = 1
+    if self._accept_burst>1 and self._sock.gettimeout()==0.0:
+      burst = self._accept_burst
+
+    accepted = []
+    more = True
+    while len(accepted)<burst:
+      try:
+        (conn, addr) = self._sock.accept()
+      except socket.error, e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          more = False
+          break
+        # Hand off what we have, the error will be raised again next time.
+        if accepted:
+          break
+        raise
+
+      if burst>1:
+        conn.setblocking( False )
+        fcntl.fcntl( conn.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC )
+      accepted.append( (conn, addr) )
+
+    if self._stats:
+      self._count_accepts( len(accepted) )
+    for (conn, addr) in accepted:
+      self._accepted( conn, addr )
+
+    # An edge-triggered backend won't fire again for connections that are
+    # already waiting.
+    if more and _edge_triggered and self._accept_event:
+      self._accept_event.add()
+
+    # Still reschedule event even if there was an error.
+    return True
+
+  def _accepted(self, conn, addr):
+    """
+    Wrap a newly accepted connection and pass it to the accept callback.
+    """
     if self._debug:
       self._logger.debug("accepted connection from %s"%(str(addr)))
 
-
     evsock = EventSocket( read_cb=self._parent_read_cb,
                             error_cb=self._parent_error_cb,
                             close_cb=self._parent_close_cb, sock=conn,
                             debug=self._debug, logger=self._logger,
-                            max_read_buffer=self._max_read_buffer )
+                            max_read_buffer=self._max_read_buffer,
+                            recv_into=self._recv_into,
+                            vectored_writes=self._vectored_writes,
+                            write_high_water=self._write_high_water,
+                            write_low_water=self._write_low_water,
+                            read_high_water=self._read_high_water,
+                            stats=self._stats_level,
+                            sync_read=self._sync_read,
+                            min_read_size=self._min_read_size,
+                            max_read_size=self._max_read_size,
+                            drain_budget=self._drain_budget,
+                            drain_reads=self._drain_reads,
+                            framing=self._framing,
+                            message_cb=self._parent_message_cb )
 
     if self._parent_accept_cb:
       # 31 march 09 aaron - We can't call accept callback asynchronously in the
@@ -368,21 +1625,58 @@ class EventSocket(object):
       # that situation entirely asynchronously would be a giant PITA and prone
       # to bugs.  We'll avoid that.
       self._protected_cb( self._parent_accept_cb, evsock )
-
-    # Still reschedule event even if there was an error.
-    return True
+    return evsock
 
   def _read_cb(self):
     """
     Read callback from libevent.
     """
-    # We should be able to use recv_into for speed and efficiency, but sadly
-    # this was broken after 2.6.1 http://bugs.python.org/issue7827
+    # recv_into was broken after 2.6.1 http://bugs.python.org/issue7827 but
+    # has since been fixed, so it's optional rather than the default.
     self._error_msg = "error reading from socket"
-    data = self._sock.recv( self.getsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF) )
-    if len(data)>0:
+    if self._splice_out:
+      return self._splice_read()
+
+    size = self._read_size
+    if not size:
+      size = self._read_size = self.getsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF)
+
+    # Only a non-blocking socket can be drained, else the last recv blocks.
+    drain = self._drain_budget and self._sock.gettimeout()==0.0
+    total = 0
+    reads = 0
+    # Whether reading stopped before the socket was empty.
+    more = False
+
+    while True:
+      try:
+        if self._recv_into:
+          data = None
+          nbytes = self._read_buf.recv_into( self._sock, size )
+        else:
+          data = self._sock.recv( size )
+          nbytes = len(data)
+      except socket.error, e:
+        if reads and e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          if self._stats:
+            self._count_eagain()
+          break
+        # Hand off what we have, the error will be raised again next time.
+        if reads:
+          more = True
+          break
+        raise
+
+      if nbytes==0:
+        # Any data read so far is flushed to read_cb by close().
+        self._close_reason = 'eof'
+        self.close()
+        return None
+
       if self._debug:
-        self._logger.debug( "read %d bytes from %s"%(len(data), self._peername) )
+        self._logger.debug( "read %d bytes from %s"%(nbytes, self._peername) )
+      if self._max_read_size:
+        self._adapt_read_size( nbytes )
       # 23 Feb 09 aaron - There are cases where the client will have started
       # pushing data right away, and there's a chance that async handling of
       # accept will cause data to be read before the callback function has been
@@ -394,28 +1688,69 @@ class EventSocket(object):
       # approach is to raise a notice to a callback and let the callback decide
       # what to do.
       self._flag_activity()
-      self._read_buf.extend( data )
+      if data is not None:
+        self._read_buf.extend( data )
+      if self._stats:
+        self._count_read( nbytes )
 
       if self._max_read_buffer and len(self._read_buf) > self._max_read_buffer:
         if self._debug:
           self._logger.debug( "buffer for %s overflowed!"%(self._peername) )
 
         # Clear the input buffer so that the callback flush code isn't called in close
-        self._read_buf = bytearray()
+        self._read_buf = ReadBuffer()
+        self._close_reason = 'overflow'
         self.close()
         return None
-  
-      # Callback asynchronously so that priority is given to libevent to
-      # allocate time slices.
-      if self._parent_read_cb!=None and self._pending_read_cb_event==None:
+
+      if self._read_high_water and len(self._read_buf)>=self._read_high_water:
+        if self._debug:
+          self._logger.debug( "buffer for %s full, pausing reads"%(self._peername) )
+        self._read_buf_full = True
+
+      # Keep reading until the socket is empty, which a short read suggests,
+      # or this socket has had its share of the loop.
+      total += nbytes
+      reads += 1
+      if not drain or nbytes<size or self._read_buf_full or \
+          total>=self._drain_budget or reads>=self._drain_reads:
+        more = nbytes>=size
+        break
+      size = self._read_size
+
+    # Callback asynchronously so that priority is given to libevent to
+    # allocate time slices, unless the socket is in sync_read mode.
+    if (self._parent_read_cb or self._parent_message_cb) and \
+        self._pending_read_cb_event==None:
+      if self._sync_read:
+        # Protect it separately so that an error in the callback doesn't
+        # stop us reading.
+        self._protected_cb( self._parent_read_timer_cb )
+        self._error_msg = "error reading from socket"
+        if self._closed:
+          return None
+      else:
         self._pending_read_cb_event = \
           event.timeout( 0, self._protected_cb, self._parent_read_timer_cb )
 
-    else:
-      self.close()
+    # Don't reschedule if reading has been paused.
+    if self.reading_paused:
       return None
+    # An edge-triggered backend won't fire again for data that's already
+    # waiting.
+    if more and _edge_triggered:
+      self._read_event.add()
     return True
 
+  def _adapt_read_size(self, nbytes):
+    """
+    Adjust the size of the next read according to how much the last one got.
+    """
+    if nbytes>=self._read_size:
+      self._read_size = min( self._read_size*2, self._max_read_size )
+    elif nbytes*4<=self._read_size:
+      self._read_size = max( self._read_size//2, self._min_read_size )
+
   def _parent_read_timer_cb(self):
     """
     Callback when we want the parent to read buffered data.
@@ -431,131 +1766,1995 @@ class EventSocket(object):
       self._pending_read_cb_event = None
 
       # Catch edge case where this could have been cleared after _read_cb
-      if self._parent_read_cb:
-        self._parent_read_cb( self )
+      if self._parent_read_cb or self._parent_message_cb:
+        if self._stats and self._stats.read_cb_latency:
+          start = time.time()
+          self._call_read_cb()
+          self._count_read_cb( time.time()-start )
+        else:
+          self._call_read_cb()
 
     # never reschedule
     return None
 
+  def _call_read_cb(self):
+    """
+    Pass the input buffer to read_cb, or its frames to message_cb.
+    """
+    if self._parent_read_cb:
+      self._parent_read_cb( self )
+    else:
+      self._dispatch_messages( self._parent_message_cb )
+
+  def _dispatch_messages(self, cb):
+    """
+    Pass each complete frame in the input buffer to cb.
+    """
+    # The buffer is gone if cb closes the socket.
+    while self._read_buf is not None and len(self._read_buf)>0:
+      try:
+        frame = self._read_buf.next_frame( self._framing )
+      except ValueError, e:
+        self._error_msg = "invalid message framing"
+        self._handle_error( e )
+
+        # Don't pass the rest of the input to cb in close
+        self._read_buf = ReadBuffer()
+        self._close_reason = 'framing'
+        self.close()
+        return
+      if frame is None:
+        break
+      cb( self, frame )
+
+    if self._read_buf is not None:
+      self._check_read_buf()
+
   def _write_cb(self):
     """
     Write callback from libevent.
     """
     self._error_msg = "error writing socket output buffer"
 
+    # Anything written before splice() goes first.
+    if self._splice_in and len(self._write_buf)==0:
+      return self._splice_write()
+
     # If no data, don't reschedule
     if len(self._write_buf)==0:
       return None
 
+    if self._debug:
+      total_len = self._write_buf_bytes
+
+    if self._vectored_writes:
+      total_sent = self._send_vectored()
+    else:
+      total_sent = self._send_chunks()
+    
+    if self._debug:
+      self._logger.debug( "wrote %d/%d bytes to %s", total_sent,total_len,self._peername )
+
+    if self._write_paused and self._write_buf_bytes<=self._write_low_water:
+      self._resume_writes()
+      if self._closed:
+        return None
+      
+    # also flag activity here?  might not be necessary, but in some cases the
+    # timeout could still be small enough to trigger between accesses to the
+    # socket output.
+    self._flag_activity()
+    
+    if len(self._write_buf)>0 or (self._splice_in and self._splice_in.pending):
+      return True
+
+    if self._tcp_corked and not self._cork_depth:
+      self._set_tcp_cork( False )
+
+    if self._parent_output_empty_cb!=None:
+      self._parent_output_empty_cb( self )
+    return None
+
+  def _send_chunks(self):
+    """
+    Send the write buffer one chunk at a time.  Partial sends are tracked
+    with _write_offset rather than by re-slicing the head of the buffer.
+    Returns the number of bytes sent.
+    """
     # 7 April 09 aaron - Changed this algorithm so that we continually send
     # data from the buffer until the socket didn't accept all of it, then
     # break.  This should be a bit faster.
-    if self._debug:
-      total_sent = 0
-      total_len = sum( map(len,self._write_buf) )
-
+    total_sent = 0
     while len(self._write_buf)>0:
-      cur = self._write_buf.popleft()
+      cur = self._write_buf[0]
+      cur_len = len(cur) - self._write_offset
       
       # Catch all env errors since that should catch OSError, IOError and
       # socket.error.
       try:
-        bytes_sent = self._sock.send( cur )
+        if isinstance(cur, FileSegment):
+          bytes_sent = cur.send( self._sock )
+        elif self._write_offset:
+          bytes_sent = self._sock.send( _tail(cur, self._write_offset) )
+        else:
+          bytes_sent = self._sock.send( cur )
       except EnvironmentError, e:
         # For now this seems to be the only error that isn't fatal.  It seems
         # to be used only for nonblocking sockets and implies that it can't
         # buffer any more data right now.
         if e.errno==errno.EAGAIN:
-          self._write_buf.appendleft( cur )
+          if self._stats:
+            self._count_eagain()
           if self._debug:
             self._logger.debug( '"%s" raised, waiting to flush to %s', e, self._peername )
           break
         else:
           raise
 
-      if self._debug:
-        total_sent += bytes_sent
+      total_sent += bytes_sent
+      self._write_buf_bytes -= bytes_sent
+      if self._stats:
+        self._count_send( bytes_sent, cur_len )
 
-      if bytes_sent < len(cur):
-        # keep the first entry and set to all remaining bytes.
-        self._write_buf.appendleft( cur[bytes_sent:] )
+      if bytes_sent < cur_len:
+        # keep the first entry and remember how much of it has been sent.  A
+        # file segment keeps track of that itself.
+        if not isinstance(cur, FileSegment):
+          self._write_offset += bytes_sent
         break
-    
+
+      self._write_buf.popleft()
+      self._write_offset = 0
+
+    return total_sent
+
+  def _send_vectored(self):
+    """
+    Send the write buffer with one writev call per batch of up to IOV_MAX
+    chunks.  Where writev is not available, small chunks are coalesced into
+    one send of up to COALESCE_WRITE_SIZE bytes and larger ones are sent by
+    themselves.  Partial sends are tracked with _write_offset rather than by
+    re-slicing the head of the buffer.  File segments are sent on their own.
+    Returns the number of bytes sent.
+    """
+    total_sent = 0
+
+    while len(self._write_buf)>0:
+      head = self._write_buf[0]
+      try:
+        if isinstance(head, FileSegment):
+          batch_len = len(head)
+          bytes_sent = head.send( self._sock )
+        elif _writev is not None and isinstance(head, _IOVEC_TYPES):
+          bufs = []
+          batch_len = -self._write_offset
+          for chunk in islice(self._write_buf, IOV_MAX):
+            if not isinstance(chunk, _IOVEC_TYPES):
+              break
+            bufs.append( chunk )
+            batch_len += len(chunk)
+          bytes_sent = _writev( self._sock.fileno(), bufs, self._write_offset )
+        else:
+          if self._write_offset:
+            head = _tail( head, self._write_offset )
+          bufs = [ head ]
+          batch_len = len(head)
+          for chunk in islice(self._write_buf, 1, IOV_MAX):
+            if isinstance(chunk, FileSegment) or \
+                batch_len+len(chunk)>COALESCE_WRITE_SIZE:
+              break
+            bufs.append( chunk )
+            batch_len += len(chunk)
+
+          if len(bufs)==1:
+            bytes_sent = self._sock.send( head )
+          else:
+            data = bytearray()
+            for chunk in bufs:
+              data += chunk
+            bytes_sent = self._sock.send( data )
+      except EnvironmentError, e:
+        if e.errno==errno.EAGAIN:
+          if self._stats:
+            self._count_eagain()
+          if self._debug:
+            self._logger.debug( '"%s" raised, waiting to flush to %s', e, self._peername )
+          break
+        else:
+          raise
+
+      total_sent += bytes_sent
+      self._write_buf_bytes -= bytes_sent
+      if self._stats:
+        self._count_send( bytes_sent, batch_len )
+
+      # Drop every chunk that was completely sent and remember how far into
+      # the next one we got.  A file segment keeps track of that itself.
+      if isinstance(head, FileSegment):
+        if not len(head):
+          self._write_buf.popleft()
+      else:
+        offset = self._write_offset + bytes_sent
+        while len(self._write_buf)>0 and offset>=len(self._write_buf[0]):
+          offset -= len( self._write_buf.popleft() )
+        self._write_offset = offset
+
+      if bytes_sent < batch_len:
+        break
+
+    return total_sent
+
+  def splice(self, sock, pipe_size=0):
+    """
+    Join this socket to another so that everything read from each is written
+    to the other through a pair of kernel pipes, without being copied into
+    Python.  Both sockets are made non-blocking.  When one side reaches EOF
+    the other is shut down for writing once all the data has been sent, and
+    both are closed when both sides are done.  Reading from one stops while
+    its pipe to the other is full.  Closing either socket closes both.  Any
+    input already buffered is written to the other socket first.  If set,
+    pipe_size is the capacity to give each pipe.  Raises socket.error with
+    errno ENOSYS if the platform doesn't support splice.
+    """
+    if _splice is None:
+      raise socket.error( errno.ENOSYS, 'splice error: not supported on this platform' )
+    if self._closed or sock._closed:
+      raise socket.error('splice error: socket is closed')
+
+    for (src, dest) in ((self, sock), (sock, self)):
+      src.setblocking( False )
+      src._splice_peer = dest
+      src._splice_out = dest._splice_in = SplicePipe( src, dest, pipe_size )
+      if len(src._read_buf):
+        dest.write( str(src._read_buf.detach()) )
+
+  def _splice_read(self):
+    """
+    Splice from this socket into the pipe to its peer.
+    """
+    pipe = self._splice_out
+    try:
+      nbytes = _splice( self._sock.fileno(), pipe.write_fd,
+        pipe.capacity-pipe.pending, SPLICE_F_MOVE|SPLICE_F_NONBLOCK )
+    except EnvironmentError, e:
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return True
+      self._handle_error( e )
+      self.close()
+      return None
+
+    if nbytes==0:
+      if self._debug:
+        self._logger.debug( "end of input from %s", self._peername )
+      pipe.eof = True
+      if not pipe.pending:
+        pipe.dest._splice_shutdown()
+      return None
+
+    pipe.pending += nbytes
     if self._debug:
-      self._logger.debug( "wrote %d/%d bytes to %s", total_sent,total_len,self._peername )
-      
-    # also flag activity here?  might not be necessary, but in some cases the
-    # timeout could still be small enough to trigger between accesses to the
-    # socket output.
+      self._logger.debug( "spliced %d bytes from %s", nbytes, self._peername )
     self._flag_activity()
-    
-    if len(self._write_buf)>0:
-      return True
+    if self._stats:
+      self._count_read( nbytes )
 
-    if self._parent_output_empty_cb!=None:
-      self._parent_output_empty_cb( self )
+    pipe.dest._schedule_write()
+
+    # Stop reading until the peer empties the pipe.
+    if pipe.pending>=pipe.capacity:
+      self._set_throttled( True )
+    if self.reading_paused:
+      return None
+    # A short splice may be limited by the pipe rather than the socket.
+    if _edge_triggered:
+      self._read_event.add()
+    return True
+
+  def _splice_write(self):
+    """
+    Splice from the pipe from this socket's peer into this socket.
+    """
+    pipe = self._splice_in
+    if not pipe.pending:
+      return None
+
+    try:
+      nbytes = _splice( pipe.read_fd, self._sock.fileno(), pipe.pending,
+        SPLICE_F_MOVE|SPLICE_F_NONBLOCK )
+    except EnvironmentError, e:
+      if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+        if self._stats:
+          self._count_eagain()
+        return True
+      self._handle_error( e )
+      self.close()
+      return None
+
+    if self._debug:
+      self._logger.debug( "spliced %d/%d bytes to %s", nbytes, pipe.pending,
+        self._peername )
+    if self._stats:
+      self._count_send( nbytes, pipe.pending )
+    pipe.pending -= nbytes
+    self._flag_activity()
+
+    if pipe.source._throttled and pipe.pending<pipe.capacity:
+      pipe.source._set_throttled( False )
+
+    if pipe.pending:
+      return True
+    if pipe.eof:
+      self._splice_shutdown()
     return None
 
+  def _splice_shutdown(self):
+    """
+    Shut down writing once the peer has reached EOF and all it sent has been
+    written, and close both sockets if the peer has been shut down too.
+    """
+    self._splice_in.done = True
+    try:
+      self._sock.shutdown( socket.SHUT_WR )
+    except socket.error:
+      pass
+
+    if self._splice_out.done:
+      self._close_reason = 'eof'
+      self.close()
+
+  def _schedule_write(self):
+    """
+    Schedule the write event.  It's created the first time there's something
+    to write once the socket is connected, which the read event indicates,
+    so that idle sockets don't hold one.
+    """
+    if self._write_event:
+      if not self._write_event.pending():
+        self._write_event.add()
+    elif self._read_event:
+      self._write_event = event.write( self._sock, self._protected_cb, self._write_cb )
+
+  def _pause_writes(self):
+    """
+    Called when the output has exceeded the write high watermark.
+    """
+    if self._debug:
+      self._logger.debug( "pausing writes to %s with %d bytes buffered",
+        self._peername, self._write_buf_bytes )
+    self._write_paused = True
+    if self._throttled_sock:
+      self._throttled_sock._set_throttled( True )
+    if self._parent_write_paused_cb:
+      self._parent_write_paused_cb( self )
+
+  def _resume_writes(self):
+    """
+    Called when the output has drained to the write low watermark.
+    """
+    if self._debug:
+      self._logger.debug( "resuming writes to %s with %d bytes buffered",
+        self._peername, self._write_buf_bytes )
+    self._write_paused = False
+    if self._throttled_sock:
+      self._throttled_sock._set_throttled( False )
+    if self._parent_write_resumed_cb:
+      self._parent_write_resumed_cb( self )
+
   def _inactive_cb(self):
     """
     Timeout when a socket has been inactive for a long time.
     """
     self._error_msg = "error closing inactive socket"
+    self._close_reason = 'inactive'
     self.close()
 
   def _flag_activity(self):
     """
     Flag that this socket is active.
     """
+    # The timer wheel only needs to know when we were last active.
+    if self._timer_wheel:
+      self._last_activity = self._timer_wheel.now
+
     # is there a better way of reseting a timer?
-    if self._inactive_event:
+    elif self._inactive_event:
       self._inactive_event.delete()
       self._inactive_event = event.timeout( self._inactive_timeout, self._protected_cb, self._inactive_cb )
 
+  # Stats are kept for the socket and the process.  These are only called
+  # when the socket has stats enabled.
+  def _count_read(self, nbytes):
+    for stats in (self._stats, global_stats):
+      stats.recv_calls += 1
+      stats.bytes_in += nbytes
+      if len(self._read_buf)>stats.read_buf_high:
+        stats.read_buf_high = len(self._read_buf)
+
+  def _count_read_cb(self, latency):
+    self._stats.read_cb_latency.add( latency )
+    global_stats.read_cb_latency.add( latency )
+
+  def _count_send(self, bytes_sent, requested):
+    for stats in (self._stats, global_stats):
+      stats.send_calls += 1
+      stats.bytes_out += bytes_sent
+      if bytes_sent<requested:
+        stats.partial_writes += 1
+
+  def _count_eagain(self):
+    self._stats.eagain += 1
+    global_stats.eagain += 1
+
+  def _count_write(self):
+    for stats in (self._stats, global_stats):
+      if self._write_buf_bytes>stats.write_buf_high:
+        stats.write_buf_high = self._write_buf_bytes
+
+  def _count_accepts(self, n):
+    self._stats.accepts += n
+    global_stats.accepts += n
+
+  def _count_close(self):
+    reason = self._close_reason or 'closed'
+    for stats in (self._stats, global_stats):
+      stats.closes[reason] = stats.closes.get(reason, 0) + 1
+    _stats_sockets.discard( self )
+
   def write(self, data):
     """
-    Write some data.  Will raise socket.error if connection is closed.
+    Write some data, which may be a str, bytearray, memoryview or buffer.
+    Data is queued as is rather than copied, so a bytearray or the object
+    under a view must not be changed until it's been sent.  Will raise
+    socket.error if connection is closed.
     """
     if self._closed:
       raise socket.error('write error: socket is closed')
 
     # Always append the data to the write buffer, even if we're not connected
     # yet.  
-    self._write_buf.append( data )
+    if self._cork_depth and len(data)<COALESCE_WRITE_SIZE and \
+        not isinstance(data, FileSegment):
+      self._coalesce_write( data )
+    else:
+      self._write_buf.append( data )
+    self._write_buf_bytes += len(data)
+    if self._stats:
+      self._count_write()
+    if self._write_high_water and not self._write_paused and \
+        self._write_buf_bytes>self._write_high_water:
+      self._pause_writes()
 
     # 21 July 09 aaron - I'm not sure if this has a significant benefit, but in
     # trying to improve throughput I confirmed that this doesn't break anything
     # and keeping the event queue cleaner is certainly good.
-    if self._write_event and not self._write_event.pending():
-      self._write_event.add()
+    if not self._cork_depth:
+      self._schedule_write()
   
     if self._debug > 1:
       self._logger.debug("buffered %d bytes (%d total) to %s",
-        len(data), sum(map(len,self._write_buf)), self._peername )
+        len(data), self._write_buf_bytes, self._peername )
 
     # Flag activity here so we don't timeout in case that event is ready to
     # fire and we're just now writing.
     self._flag_activity()
 
-  def read(self):
-    """
-    Return the current read buffer.  Will return a bytearray object.
-    """
-    if self._closed:
-      raise socket.error('read error: socket is closed')
+  def _coalesce_write(self, data):
+    '''
+    Copy a small write into the cork buffer, starting a new one if it would
+    grow past COALESCE_WRITE_SIZE or something else was queued after it.
+    '''
+    buf = self._cork_buf
+    # The buffer may have been sent while still corked, if the write event
+    # was already pending.
+    if buf is None or not self._write_buf or self._write_buf[-1] is not buf or \
+        len(buf)+len(data)>COALESCE_WRITE_SIZE:
+      buf = self._cork_buf = bytearray( data )
+      self._write_buf.append( buf )
+    else:
+      buf += data
 
-    rval = self._read_buf
-    self._read_buf = bytearray()
-    return rval
+  def cork(self):
+    '''
+    Hold back writes until uncork().  Small writes are gathered into one
+    buffer rather than queued and sent one by one, and TCP_CORK (TCP_NOPUSH)
+    is set where there is one so that the kernel doesn't send partial
+    segments either.  Calls may be nested; the data is flushed when the
+    outermost one is uncorked.  See batch().
+    '''
+    self._cork_depth += 1
+    if self._cork_depth==1 and not self._tcp_corked:
+      self._set_tcp_cork( True )
 
-  def buffer(self, s):
+  def uncork(self):
     '''
-    Re-buffer some data. If it's a bytearray will assign directly as the current
-    input buffer, else will add to the current buffer. Assumes that re-buffered
-    data is happening in the same cycle as read() was called, as anything other
-    than that would be nearly impossible to handle inside an application.
+    Undo a call to cork(), and start sending once all of them are undone.
+    TCP_CORK is cleared once the write buffer has drained.
     '''
-    if isinstance(s, bytearray):
-      self._read_buf = s
-    else:
-      self._read_buf.extend( s )
+    if not self._cork_depth:
+      return
+    self._cork_depth -= 1
+    if self._cork_depth or self._closed:
+      return
+
+    self._cork_buf = None
+    if len(self._write_buf)>0:
+      self._schedule_write()
+    elif self._tcp_corked:
+      self._set_tcp_cork( False )
+
+  @contextlib.contextmanager
+  def batch(self):
+    '''
+    A context manager that corks the socket for the writes in its block, so
+    that they're sent together when it exits.
+
+      with sock.batch():
+        sock.write( header )
+        sock.write( body )
+    '''
+    self.cork()
+    try:
+      yield self
+    finally:
+      self.uncork()
+
+  def _set_tcp_cork(self, corked):
+    '''
+    Set or clear TCP_CORK, if the platform and the socket support it.
+    '''
+    if TCP_CORK is None:
+      return
+    try:
+      self._sock.setsockopt( socket.IPPROTO_TCP, TCP_CORK, int(corked) )
+      self._tcp_corked = corked
+    except socket.error:
+      # Not a TCP socket
+      pass
+
+  def set_nodelay(self, nodelay=True):
+    '''
+    Set TCP_NODELAY, which disables Nagle's algorithm so that small writes
+    are sent immediately instead of waiting to be combined with later ones.
+    Use cork() or batch() to group the writes of a message when it's set.
+    '''
+    self._sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay) )
+
+  def write_file(self, fileobj, offset=0, count=None):
+    """
+    Write count bytes of a file starting at offset, or the rest of the file
+    if count is None.  The data is queued in order with other writes and
+    sent straight from the file with sendfile, or from a memory map of it if
+    sendfile can't be used, rather than being read into memory.  A file
+    object without a fileno() is read and written.  The file must stay open
+    and unchanged until the data has been sent.  Will raise socket.error if
+    connection is closed.
+    """
+    if self._closed:
+      raise socket.error('write error: socket is closed')
+
+    try:
+      fd = fileobj.fileno()
+    except (AttributeError, IOError, ValueError):
+      fileobj.seek( offset )
+      if count is None:
+        data = fileobj.read()
+      else:
+        data = fileobj.read( count )
+      if data:
+        self.write( data )
+      return
+
+    if count is None:
+      count = os.fstat( fd ).st_size - offset
+    if count>0:
+      self.write( FileSegment(fileobj, offset, count) )
+
+  def read(self):
+    """
+    Return the current read buffer.  Will return a bytearray object.
+    """
+    if self._closed:
+      raise socket.error('read error: socket is closed')
+
+    rval = self._read_buf.detach()
+    self._check_read_buf()
+    return rval
+
+  def peek(self, n=None):
+    """
+    Return up to n bytes of the input buffer, or all of it, without consuming
+    them.  Like the results of consume(), readexactly() and readuntil(), this
+    is a memoryview of the buffer that's only valid until read_cb returns.
+    Together they let read_cb parse input in place rather than taking it
+    all with read() and returning the remainder with buffer().  Will raise
+    socket.error if the socket is closed.
+    """
+    if self._closed:
+      raise socket.error('read error: socket is closed')
+    return self._read_buf.peek( n )
+
+  def consume(self, n):
+    """
+    Drop up to n bytes from the front of the input buffer.
+    """
+    if self._closed:
+      raise socket.error('read error: socket is closed')
+    self._read_buf.consume( n )
+    self._check_read_buf()
+
+  def readexactly(self, n):
+    """
+    Consume and return n bytes of input, or None if fewer are buffered.
+    """
+    if self._closed:
+      raise socket.error('read error: socket is closed')
+    rval = self._read_buf.readexactly( n )
+    if rval is not None:
+      self._check_read_buf()
+    return rval
+
+  def readuntil(self, sep):
+    """
+    Consume and return input up to and including sep, or None if sep hasn't
+    been received yet.
+    """
+    if self._closed:
+      raise socket.error('read error: socket is closed')
+    rval = self._read_buf.readuntil( sep )
+    if rval is not None:
+      self._check_read_buf()
+    return rval
+
+  def buffer(self, s):
+    '''
+    Re-buffer some data. If it's a bytearray will assign directly as the current
+    input buffer, else will add to the current buffer. Assumes that re-buffered
+    data is happening in the same cycle as read() was called, as anything other
+    than that would be nearly impossible to handle inside an application.
+    '''
+    if isinstance(s, bytearray):
+      self._read_buf.assign( s )
+    else:
+      self._read_buf.extend( s )
+
+class PreforkServer(object):
+  """
+  Serve an address from several worker processes, each running its own
+  libevent loop with a listening EventSocket.  If reuseport is True and the
+  platform supports SO_REUSEPORT, each worker binds its own socket and the
+  kernel balances connections between them.  Otherwise the address is bound
+  once and the workers are forked after binding and share the socket.  All
+  other keyword arguments, such as accept_cb and read_cb, are passed to the
+  listening EventSocket in each worker.  serve() supervises the workers and
+  restarts any that exit until the supervisor receives SIGINT or SIGTERM.
+  """
+
+  def __init__(self, address, workers=None, reuseport=True,
+               backlog=socket.SOMAXCONN, **kwargs):
+    if workers is None:
+      import multiprocessing
+      workers = multiprocessing.cpu_count()
+
+    self._address = address
+    self._num_workers = workers
+    self._reuseport = reuseport and SO_REUSEPORT is not None
+    self._backlog = backlog
+    self._logger = kwargs.get('logger')
+    self._kwargs = kwargs
+
+    # The shared listening socket when not using SO_REUSEPORT
+    self._sock = None
+    # Map of worker pid to the time it was started
+    self._workers = {}
+    self._running = False
+
+  def serve(self):
+    """
+    Start the workers and supervise them until stopped.  Blocks until all
+    workers have exited.
+    """
+    if not self._reuseport:
+      self._sock = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+      self._sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+      self._sock.setblocking( False )
+      self._sock.bind( self._address )
+      self._sock.listen( self._backlog )
+
+    self._running = True
+    signal.signal( signal.SIGINT, self._stop_cb )
+    signal.signal( signal.SIGTERM, self._stop_cb )
+
+    for x in xrange(self._num_workers):
+      self._spawn()
+
+    while self._workers:
+      try:
+        (pid, status) = os.wait()
+      except OSError, e:
+        if e.errno==errno.EINTR:
+          continue
+        if e.errno==errno.ECHILD:
+          break
+        raise
+
+      started = self._workers.pop( pid, None )
+      if started is None:
+        continue
+      if self._logger:
+        self._logger.info( "worker %d exited with status %d", pid, status )
+
+      if self._running:
+        # Don't restart a worker that keeps failing as fast as we can fork.
+        if time.time()-started < 1:
+          time.sleep( 1 )
+        # We may have been stopped while sleeping.
+        if self._running:
+          self._spawn()
+
+    if self._sock:
+      self._sock.close()
+      self._sock = None
+
+  def stop(self):
+    """
+    Stop restarting workers and ask the running ones to exit.
+    """
+    self._running = False
+    for pid in self._workers.keys():
+      try:
+        os.kill( pid, signal.SIGTERM )
+      except OSError:
+        pass
+
+  def _stop_cb(self, signum, frame):
+    """
+    Signal handler in the supervisor.
+    """
+    self.stop()
+
+  def _spawn(self):
+    """
+    Fork a new worker.
+    """
+    pid = os.fork()
+    if pid:
+      self._workers[pid] = time.time()
+      return pid
+
+    # In the child, never return into the supervisor's loop.
+    status = 0
+    try:
+      self._run_worker()
+    except:
+      status = 1
+      if self._logger:
+        self._logger.error( "worker %d failed", os.getpid(), exc_info=True )
+      else:
+        traceback.print_exc()
+    os._exit( status )
+
+  def _run_worker(self):
+    """
+    Run the event loop in a worker process.
+    """
+    signal.signal( signal.SIGINT, signal.SIG_IGN )
+    signal.signal( signal.SIGTERM, signal.SIG_DFL )
+
+    # The event base doesn't survive fork, so start with a fresh one.
+    event.init()
+    event.signal( signal.SIGTERM, event.abort )
+
+    if self._reuseport:
+      listener = EventSocket( **self._kwargs )
+      listener.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+      listener.setsockopt( socket.SOL_SOCKET, SO_REUSEPORT, 1 )
+      listener.setblocking( False )
+      listener.bind( self._address )
+      listener.listen( self._backlog )
+    else:
+      listener = EventSocket( sock=self._sock, **self._kwargs )
+      listener._start_accepting()
+
+    event.dispatch()
+    listener.close()
+
+class LoopShard(object):
+  """
+  An EpollBackend run by its own thread in a ShardedServer.  Other threads
+  pass it work with call_soon(), which queues the call and writes to a
+  wakeup pipe that the loop is waiting on.
+  """
+
+  def __init__(self, edge_triggered=False, logger=None):
+    self.backend = EpollBackend( edge_triggered )
+    self._logger = logger
+    self._calls = deque()
+    # The connections accepted on to this shard, so they can be closed with it.
+    self._sockets = weakref.WeakSet()
+
+    self._wakeup_r, self._wakeup_w = _nonblocking_pipe()
+    self._wakeup_event = self.backend.read( self._wakeup_r, self._wakeup_cb )
+
+  def load(self):
+    """
+    Return roughly how busy this shard is, as the number of fds its loop is
+    watching plus the calls waiting for it.
+    """
+    return self.backend.fd_count() + len(self._calls)
+
+  def call_soon(self, func, *args):
+    """
+    Call func(*args) in this shard's thread.  Safe to call from any thread.
+    """
+    self._calls.append( (func, args) )
+    _wake_pipe( self._wakeup_w )
+
+  def run(self, router):
+    """
+    Run the loop in the calling thread until stopped, with every event and
+    timer created in this thread going to it through router, a
+    ThreadLocalBackend.
+    """
+    router.bind( self.backend )
+    try:
+      self.backend.dispatch()
+    finally:
+      router.bind( None )
+
+  def stop(self):
+    """
+    Close this shard's connections and stop its loop.  Must be called in the
+    shard's thread, such as through call_soon().
+    """
+    for sock in list(self._sockets):
+      if not sock.closed:
+        sock.close()
+    self.backend.abort()
+
+  def close(self):
+    """
+    Release the loop and wakeup pipe once the loop has stopped.
+    """
+    self._wakeup_event.delete()
+    self.backend.close()
+    os.close( self._wakeup_r )
+    os.close( self._wakeup_w )
+
+  def _accept(self, listener, conn, addr):
+    """
+    Wrap a connection handed off by the listener, in this shard's thread.
+    """
+    evsock = EventSocket._accepted( listener, conn, addr )
+    if evsock and not evsock.closed:
+      self._sockets.add( evsock )
+
+  def _wakeup_cb(self):
+    """
+    Run the queued calls.  The pipe is drained first so that a call queued
+    while they run wakes the loop again.
+    """
+    _drain_pipe( self._wakeup_r )
+    while self._calls:
+      func,args = self._calls.popleft()
+      try:
+        func( *args )
+      except:
+        if self._logger:
+          self._logger.error( "error in shard callback", exc_info=True )
+        else:
+          traceback.print_exc()
+    return True
+
+class _ShardListener(EventSocket):
+  """
+  A listening socket that hands each connection to its ShardedServer rather
+  than wrapping it in the accepting thread.
+  """
+
+  __slots__ = ('_server',)
+
+  def _accepted(self, conn, addr):
+    self._server._hand_off( self, conn, addr )
+
+class ShardedServer(object):
+  """
+  Serve an address from a single process with several event loops, each
+  run by a thread on its own EpollBackend, which releases the GIL while it
+  waits.  The thread calling serve() accepts the connections and hands each
+  one through a wakeup pipe to a shard chosen round-robin, or the one with
+  the fewest fds to watch if balance is 'least-connections'.  The accepted
+  EventSocket is created in the shard's thread, so its events, timers and
+  buffers all belong to that shard, and its callbacks run there.  All other
+  keyword arguments, such as accept_cb and read_cb, are passed to the
+  listening EventSocket as with PreforkServer.  Don't set a TimerWheel on
+  EventSocket, as it would be shared by the shards.
+
+  While it runs, the process backend is a ThreadLocalBackend which sends
+  each thread's events to its own loop.  serve() runs until stop() is
+  called or, in the main thread, SIGINT or SIGTERM is received.
+  """
+
+  BALANCE = ('round-robin', 'least-connections')
+
+  def __init__(self, address, shards=None, balance='round-robin',
+               edge_triggered=False, backlog=socket.SOMAXCONN, **kwargs):
+    if shards is None:
+      import multiprocessing
+      shards = multiprocessing.cpu_count()
+    if balance not in self.BALANCE:
+      raise ValueError( "unknown balance %s"%(balance) )
+
+    self._address = address
+    self._num_shards = shards
+    self._balance = balance
+    self._edge_triggered = edge_triggered
+    self._backlog = backlog
+    self._logger = kwargs.get('logger')
+    self._kwargs = kwargs
+
+    self._acceptor = None
+    self._shards = []
+    self._next_shard = 0
+    self.address = None
+
+  def serve(self):
+    """
+    Start the shards and accept connections until stopped.  Blocks until
+    all of the shards' threads have exited.
+    """
+    previous = event
+    if isinstance(previous, ThreadLocalBackend):
+      router = previous
+    else:
+      default = previous
+      if isinstance(default, _DefaultBackend):
+        default = default.resolve()
+      router = set_backend( ThreadLocalBackend(default, self._edge_triggered) )
+
+    self._acceptor = LoopShard( self._edge_triggered, self._logger )
+    self._shards = [ LoopShard(self._edge_triggered, self._logger)
+      for x in xrange(self._num_shards) ]
+    threads = [ threading.Thread(target=shard.run, args=(router,),
+      name='eventsocket-shard-%d'%(i)) for i,shard in enumerate(self._shards) ]
+
+    router.bind( self._acceptor.backend )
+    listener = None
+    signals = []
+    try:
+      # Only the main thread can handle signals.
+      if isinstance(threading.current_thread(), threading._MainThread):
+        signals = [ self._acceptor.backend.signal(signum, self.stop)
+          for signum in (signal.SIGINT, signal.SIGTERM) ]
+
+      listener = _ShardListener( **self._kwargs )
+      listener._server = self
+      listener.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+      listener.setblocking( False )
+      listener.bind( self._address )
+      listener.listen( self._backlog )
+      self.address = listener.getsockname()
+
+      for thread in threads:
+        thread.daemon = True
+        thread.start()
+      self._acceptor.run( router )
+    finally:
+      if listener:
+        listener.close()
+      for ev in signals:
+        ev.delete()
+      for shard in self._shards:
+        shard.call_soon( shard.stop )
+      for thread in threads:
+        if thread.is_alive():
+          thread.join()
+      for shard in [self._acceptor]+self._shards:
+        shard.close()
+      self._shards = []
+      self._acceptor = None
+      router.bind( None )
+      if router is not previous:
+        set_backend( previous )
+
+  def stop(self):
+    """
+    Stop accepting and close the shards.  Safe to call from any thread.
+    """
+    acceptor = self._acceptor
+    if acceptor:
+      acceptor.call_soon( acceptor.backend.abort )
+
+  def _choose_shard(self):
+    """
+    Return the shard for the next connection.
+    """
+    if self._balance=='least-connections':
+      return min( self._shards, key=LoopShard.load )
+    shard = self._shards[ self._next_shard ]
+    self._next_shard = (self._next_shard+1) % len(self._shards)
+    return shard
+
+  def _hand_off(self, listener, conn, addr):
+    """
+    Pass a connection accepted by the listener to a shard.
+    """
+    shard = self._choose_shard()
+    shard.call_soon( shard._accept, listener, conn, addr )
+
+class _OffloadChannel(object):
+  """
+  A wakeup pipe on one thread's event loop, through which executor threads
+  pass back the sockets whose handlers have finished.
+  """
+
+  def __init__(self, deliver):
+    self._deliver = deliver
+    self._ready = deque()
+    self._wakeup_r, self._wakeup_w = _nonblocking_pipe()
+    self._wakeup_event = event.read( self._wakeup_r, self._wakeup_cb )
+
+  def notify(self, sock):
+    """
+    Ask the loop to deliver the results of sock.  Safe to call from any
+    thread.
+    """
+    self._ready.append( sock )
+    _wake_pipe( self._wakeup_w )
+
+  def close(self):
+    self._wakeup_event.delete()
+    os.close( self._wakeup_r )
+    os.close( self._wakeup_w )
+
+  def _wakeup_cb(self):
+    _drain_pipe( self._wakeup_r )
+    while self._ready:
+      self._deliver( self._ready.popleft() )
+    return True
+
+class ExecutorOffload(object):
+  """
+  Runs a blocking or CPU heavy handler for each read in an executor, such
+  as a concurrent.futures ThreadPoolExecutor or ProcessPoolExecutor, rather
+  than on the event loop, so that an expensive request doesn't hold up every
+  other connection.  Use its read_cb or message_cb as a socket's own:
+
+    offload = ExecutorOffload( ThreadPoolExecutor(8), parse_request )
+    listener = EventSocket( framing=DelimiterFraming(),
+      message_cb=offload.message_cb )
+
+  handler is called in the executor with the bytes read, or with each frame
+  as a string.  Unless it returns None its result is written to the socket,
+  or passed to reply_cb(sock, result) if that's set.  The handlers for one
+  socket may run at the same time, but their results are delivered in the
+  order that their input arrived.  Delivery is on the thread of the
+  socket's loop, which executor threads wake through a pipe, so write() is
+  never called from anywhere else.  An exception raised by handler is passed
+  to the socket's error_cb.  Reading from a socket is paused while it has
+  max_pending handlers outstanding.  handler has to be picklable for a
+  process pool.
+  """
+
+  def __init__(self, executor, handler, reply_cb=None, max_pending=16):
+    self._executor = executor
+    self._handler = handler
+    self._reply_cb = reply_cb
+    self._max_pending = max_pending
+
+    # The futures of each socket in the order they were submitted, and the
+    # sockets that have been paused for having too many.
+    self._pending = {}
+    self._paused = set()
+    # A channel for each thread that submits, as each has its own loop when
+    # using ShardedServer.
+    self._local = threading.local()
+    self._channels = []
+
+  def read_cb(self, sock):
+    self._submit( sock, sock.read() )
+
+  def message_cb(self, sock, frame):
+    # The frame refers to the input buffer, which will have moved on by the
+    # time the handler runs.
+    self._submit( sock, frame.tobytes() )
+
+  def pending(self, sock):
+    """
+    Return the number of results that sock is waiting for.
+    """
+    return len( self._pending.get(sock, ()) )
+
+  def close(self):
+    """
+    Close the wakeup pipes once the loops have stopped.  Doesn't shut down
+    the executor.
+    """
+    for channel in self._channels:
+      channel.close()
+    self._channels = []
+    self._local = threading.local()
+
+  def _channel(self):
+    """
+    Return the channel to the calling thread's loop.
+    """
+    channel = getattr( self._local, 'channel', None )
+    if channel is None:
+      channel = self._local.channel = _OffloadChannel( self._deliver )
+      self._channels.append( channel )
+    return channel
+
+  def _submit(self, sock, data):
+    """
+    Run the handler on data in the executor.
+    """
+    channel = self._channel()
+    future = self._executor.submit( self._handler, data )
+
+    queue = self._pending.get( sock )
+    if queue is None:
+      queue = self._pending[sock] = deque()
+    queue.append( future )
+    if self._max_pending and len(queue)>=self._max_pending and \
+        sock not in self._paused:
+      self._paused.add( sock )
+      sock.pause_reading()
+
+    # Called in the executor's thread, or straight away if already done.
+    future.add_done_callback( lambda f: channel.notify(sock) )
+
+  def _deliver(self, sock):
+    """
+    Pass on the results of sock that are ready, up to the first that isn't.
+    """
+    queue = self._pending.get( sock )
+    if queue is None:
+      return
+
+    while queue and queue[0].done():
+      future = queue.popleft()
+      if not sock.closed and not future.cancelled():
+        sock._error_msg = "error in offloaded handler"
+        sock._protected_cb( self._reply, sock, future )
+
+    if not queue:
+      del self._pending[sock]
+    if sock in self._paused and \
+        (sock.closed or len(queue)<self._max_pending):
+      self._paused.discard( sock )
+      if not sock.closed:
+        sock.resume_reading()
+
+  def _reply(self, sock, future):
+    # Raises the handler's exception, if any, for error_cb.
+    result = future.result()
+    if self._reply_cb:
+      self._reply_cb( sock, result )
+    elif result is not None:
+      sock.write( result )
+
+class Backend(object):
+  """
+  The interface of an event loop backend, which is the part of the event
+  module's that this module uses.  Subclasses implement every method; the
+  ones here only document them.  See set_backend().
+  """
+
+  # Whether EventSocket must add() a read event again when it stops reading
+  # before the socket would block.
+  edge_triggered = False
+
+  def read(self, handle, callback, *args):
+    """
+    Call callback(*args) when handle, a file descriptor or an object with a
+    fileno() method, is readable.  Returns an event that has already been
+    added, with add(), delete() and pending() methods.  An event is no
+    longer pending once it has fired, and is added again if its callback
+    returns something other than None.
+    """
+
+  def write(self, handle, callback, *args):
+    """
+    Call callback(*args) when handle is writable.  Returns an added event
+    as read() does.
+    """
+
+  def timeout(self, secs, callback, *args):
+    """
+    Call callback(*args) after secs seconds.  Returns an added event as
+    read() does.
+    """
+
+  def signal(self, signum, callback, *args):
+    """
+    Call callback(*args) when the process receives signum.  Returns an added
+    event as read() does.
+    """
+
+  def init(self):
+    """
+    Prepare the loop for use, such as in a child process after a fork.
+    """
+
+  def dispatch(self):
+    """
+    Run the loop until abort() is called or there are no more events.
+    """
+
+  def abort(self):
+    """
+    Make dispatch() return.
+    """
+
+class BackendEvent(object):
+  """
+  Base class for the events of a backend.
+  """
+
+  READ, WRITE, TIMEOUT, SIGNAL = range(4)
+
+  def __init__(self, evtype, handle, callback, args, secs=0):
+    self._evtype = evtype
+    if evtype in (self.READ, self.WRITE) and not isinstance(handle, (int,long)):
+      handle = handle.fileno()
+    self._handle = handle
+    self._callback = callback
+    self._args = args
+    self._secs = secs
+    self._pending = False
+
+  def pending(self):
+    """
+    Return whether the event is waiting to fire.
+    """
+    return self._pending
+
+class AsyncioEvent(BackendEvent):
+  """
+  An event on an asyncio loop.
+  """
+
+  def __init__(self, loop, evtype, handle, callback, args, secs=0):
+    super(AsyncioEvent,self).__init__( evtype, handle, callback, args, secs )
+    self._loop = loop
+    # A reader, writer or signal handler stays registered while its callback
+    # runs so that it isn't removed and added again each time the callback
+    # reschedules it.
+    self._registered = False
+    self._timer = None
+
+  def add(self):
+    """
+    Add the event.  Returns the event.
+    """
+    if self._evtype==self.TIMEOUT:
+      if self._timer:
+        self._timer.cancel()
+      self._timer = self._loop.call_later( max(self._secs,0), self._fire )
+    elif not self._registered:
+      if self._evtype==self.READ:
+        self._loop.add_reader( self._handle, self._fire )
+      elif self._evtype==self.WRITE:
+        self._loop.add_writer( self._handle, self._fire )
+      else:
+        self._loop.add_signal_handler( self._handle, self._fire )
+      self._registered = True
+    self._pending = True
+    return self
+
+  def delete(self):
+    """
+    Delete the event.
+    """
+    self._pending = False
+    if self._timer:
+      self._timer.cancel()
+      self._timer = None
+    if self._registered:
+      self._unregister()
+
+  def _unregister(self):
+    self._registered = False
+    if self._evtype==self.READ:
+      self._loop.remove_reader( self._handle )
+    elif self._evtype==self.WRITE:
+      self._loop.remove_writer( self._handle )
+    else:
+      self._loop.remove_signal_handler( self._handle )
+
+  def _fire(self):
+    self._pending = False
+    self._timer = None
+    rval = None
+    try:
+      rval = self._callback( *self._args )
+    finally:
+      if rval is not None:
+        self.add()
+      elif self._registered and not self._pending:
+        self._unregister()
+
+class AsyncioBackend(Backend):
+  """
+  Runs events on an asyncio loop, by default the current one.  See
+  use_asyncio().
+  """
+
+  def __init__(self, loop=None):
+    if loop is None:
+      if asyncio is None:
+        raise ImportError( "the asyncio backend needs asyncio or trollius" )
+      loop = asyncio.get_event_loop()
+    self.loop = loop
+
+  def read(self, handle, callback, *args):
+    return AsyncioEvent( self.loop, AsyncioEvent.READ, handle, callback, args ).add()
+
+  def write(self, handle, callback, *args):
+    return AsyncioEvent( self.loop, AsyncioEvent.WRITE, handle, callback, args ).add()
+
+  def timeout(self, secs, callback, *args):
+    return AsyncioEvent( self.loop, AsyncioEvent.TIMEOUT, None, callback, args,
+      secs ).add()
+
+  def signal(self, signum, callback, *args):
+    return AsyncioEvent( self.loop, AsyncioEvent.SIGNAL, signum, callback, args ).add()
+
+  def init(self):
+    """
+    Switch to a new event loop, made by the current event loop policy, and
+    make it the current one.  A forked child, such as a PreforkServer
+    worker, must call this as the loop's selector is shared with its parent.
+    """
+    if asyncio is None:
+      raise ImportError( "the asyncio backend needs asyncio or trollius" )
+    # Don't close the old loop, as unregistering its fds would remove them
+    # from the parent's selector too.
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop( self.loop )
+
+  def dispatch(self):
+    self.loop.run_forever()
+
+  def abort(self):
+    self.loop.stop()
+
+def use_asyncio(loop=None):
+  """
+  Run all EventSockets, TimerWheels and PreforkServer workers on an asyncio
+  loop, by default the current one, so that they can share a process with
+  asyncio code.  Call this before creating any of them.  The loop may be
+  any asyncio compatible loop, such as uvloop.  Returns the AsyncioBackend,
+  whose dispatch() and abort() run and stop the loop.  Each PreforkServer
+  worker runs on a new loop from the event loop policy, as the parent's
+  can't be shared after fork.
+  """
+  return set_backend( AsyncioBackend(loop) )
+
+class EpollEvent(BackendEvent):
+  """
+  An event of an EpollBackend.
+  """
+
+  def __init__(self, backend, evtype, handle, callback, args, secs=0):
+    super(EpollEvent,self).__init__( evtype, handle, callback, args, secs )
+    self._backend = backend
+    # Identifies the current heap entry of a timer.
+    self._seq = None
+
+  def add(self):
+    """
+    Add the event.  Returns the event.
+    """
+    self._backend._add( self )
+    return self
+
+  def delete(self):
+    """
+    Delete the event.
+    """
+    self._backend._delete( self )
+
+class EpollBackend(Backend):
+  """
+  A pure Python event loop on epoll, with timers kept in a heap and signals
+  delivered through a pipe.
+
+  In level-triggered mode a socket stays registered while its events are
+  rescheduled, and changes to what each socket is waiting for are applied
+  just before the next poll, so that an event which is deleted and added
+  again in the meantime costs nothing.  In edge-triggered mode a socket is
+  registered once for both reading and writing, so that write events can
+  come and go without updating epoll.  A rescheduled write event is re-armed
+  in case its callback stopped before the socket would block, but a read
+  callback has to add() its event again itself if it stopped reading early,
+  which EventSocket does.
+  """
+
+  # epoll is only on Linux, and the module has to import elsewhere.
+  if hasattr(select, 'epoll'):
+    READ_MASK = select.EPOLLIN | select.EPOLLPRI | select.EPOLLERR | select.EPOLLHUP
+    WRITE_MASK = select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP
+    ET_MASK = select.EPOLLIN | select.EPOLLOUT | select.EPOLLET
+
+  def __init__(self, edge_triggered=False):
+    if not hasattr(select, 'epoll'):
+      raise ImportError( "the epoll backend needs select.epoll, which is only on Linux" )
+    self.edge_triggered = edge_triggered
+    self._epoll = None
+    self.init()
+
+  def init(self):
+    """
+    Start with a new epoll instance and no events.  A forked child must call
+    this as the epoll instance is shared with its parent.
+    """
+    self.close()
+
+    self._epoll = select.epoll()
+    # The read and write events of each fd, what it's registered for, and
+    # the fds whose registration may need updating or re-arming.
+    self._fds = {}
+    self._registered = {}
+    self._changed = set()
+    self._rearm = set()
+    # A heap of (deadline, seq, event).  Deleted timers are left in the heap
+    # until they expire or outnumber the live ones.
+    self._timers = []
+    self._next_seq = 0
+    self._stale_timers = 0
+    # Signal events, the handlers they replaced, and the signals caught.
+    self._signals = {}
+    self._handlers = {}
+    self._caught = []
+    self._running = False
+
+    self._wakeup_r, self._wakeup_w = _nonblocking_pipe()
+    self._epoll.register( self._wakeup_r, select.EPOLLIN )
+
+  def read(self, handle, callback, *args):
+    return EpollEvent( self, EpollEvent.READ, handle, callback, args ).add()
+
+  def write(self, handle, callback, *args):
+    return EpollEvent( self, EpollEvent.WRITE, handle, callback, args ).add()
+
+  def timeout(self, secs, callback, *args):
+    return EpollEvent( self, EpollEvent.TIMEOUT, None, callback, args, secs ).add()
+
+  def signal(self, signum, callback, *args):
+    return EpollEvent( self, EpollEvent.SIGNAL, signum, callback, args ).add()
+
+  def dispatch(self):
+    """
+    Run the loop until abort() is called or there are no more events.
+    """
+    self._running = True
+    try:
+      while self._running and self.loop_once():
+        pass
+    finally:
+      self._running = False
+
+  def abort(self):
+    self._running = False
+
+  def close(self):
+    """
+    Close the epoll instance and wakeup pipe, and restore the handlers of
+    any signals being waited for.  Call init() to use the backend again.
+    """
+    if self._epoll:
+      self._epoll.close()
+      self._epoll = None
+      os.close( self._wakeup_r )
+      os.close( self._wakeup_w )
+      for signum,handler in self._handlers.iteritems():
+        signal.signal( signum, handler )
+      self._handlers = {}
+      self._signals = {}
+
+  def fd_count(self):
+    """
+    Return the number of fds the loop is waiting on.
+    """
+    return len(self._fds)
+
+  def loop_once(self, block=True):
+    """
+    Wait for and run one round of events.  Returns False if there are none
+    to wait for.
+    """
+    self._update()
+    timers = self._timers
+    while timers and timers[0][2]._seq!=timers[0][1]:
+      heapq.heappop( timers )
+      self._stale_timers -= 1
+    if not (self._registered or timers or self._signals):
+      return False
+
+    timeout = -1
+    if not block:
+      timeout = 0
+    elif timers:
+      timeout = max( timers[0][0]-time.time(), 0 )
+
+    try:
+      ready = self._epoll.poll( timeout )
+    except IOError, e:
+      if e.errno!=errno.EINTR:
+        raise
+      ready = ()
+
+    for fd,mask in ready:
+      if fd==self._wakeup_r:
+        _drain_pipe( self._wakeup_r )
+        continue
+
+      # A callback may close the fd, or even hand it to another socket.
+      slots = self._fds.get( fd )
+      if slots and slots[0] and mask & self.READ_MASK and slots[0]._pending:
+        self._fire( slots[0] )
+        slots = self._fds.get( fd )
+      if slots and slots[1] and mask & self.WRITE_MASK and slots[1]._pending:
+        self._fire( slots[1] )
+
+    while self._caught:
+      ev = self._signals.get( self._caught.pop(0) )
+      if ev and ev._pending:
+        self._fire( ev )
+
+    now = time.time()
+    while timers and timers[0][0]<=now:
+      deadline,seq,ev = heapq.heappop( timers )
+      if ev._seq==seq:
+        ev._seq = None
+        self._fire( ev )
+      else:
+        self._stale_timers -= 1
+    return True
+
+  def _add(self, ev):
+    if ev._evtype==ev.TIMEOUT:
+      if ev._seq is not None:
+        self._stale_timers += 1
+      self._next_seq += 1
+      ev._seq = self._next_seq
+      heapq.heappush( self._timers, (time.time()+ev._secs, ev._seq, ev) )
+      ev._pending = True
+
+      if self._stale_timers>64 and self._stale_timers*2>len(self._timers):
+        self._timers = [ t for t in self._timers if t[2]._seq==t[1] ]
+        heapq.heapify( self._timers )
+        self._stale_timers = 0
+      return
+
+    if ev._pending:
+      # Adding a pending event again is how an edge-triggered callback that
+      # stopped early asks to be called again without a new edge.
+      if self.edge_triggered and ev._evtype!=ev.SIGNAL:
+        self._rearm.add( ev._handle )
+        self._changed.add( ev._handle )
+      return
+    ev._pending = True
+
+    if ev._evtype==ev.SIGNAL:
+      if ev._handle not in self._handlers:
+        self._handlers[ev._handle] = signal.signal( ev._handle, self._signal_handler )
+      self._signals[ev._handle] = ev
+      return
+
+    slots = self._fds.get( ev._handle )
+    if slots is None:
+      slots = self._fds[ev._handle] = [None, None]
+    # If another event had this fd, its socket may have closed and the fd
+    # been reused since it was registered.
+    if slots[ev._evtype] is not ev:
+      if slots[ev._evtype] is not None:
+        self._rearm.add( ev._handle )
+      slots[ev._evtype] = ev
+    if self.edge_triggered:
+      self._rearm.add( ev._handle )
+    self._changed.add( ev._handle )
+
+  def _delete(self, ev):
+    if not ev._pending:
+      return
+    ev._pending = False
+    self._release( ev )
+
+  def _release(self, ev):
+    """
+    Stop waiting for an event that is no longer pending.
+    """
+    if ev._evtype==ev.TIMEOUT:
+      if ev._seq is not None:
+        ev._seq = None
+        self._stale_timers += 1
+    elif ev._evtype==ev.SIGNAL:
+      if self._signals.get( ev._handle ) is ev:
+        del self._signals[ev._handle]
+        signal.signal( ev._handle, self._handlers.pop(ev._handle) )
+    else:
+      slots = self._fds.get( ev._handle )
+      if slots and slots[ev._evtype] is ev:
+        self._changed.add( ev._handle )
+
+  def _fire(self, ev):
+    ev._pending = False
+    rval = None
+    try:
+      rval = ev._callback( *ev._args )
+    finally:
+      if ev._pending:
+        # The callback added it again.
+        pass
+      elif rval is None:
+        self._release( ev )
+      elif ev._evtype==ev.READ or \
+          (ev._evtype==ev.WRITE and not self.edge_triggered):
+        # Still registered, so there's nothing to change.
+        ev._pending = True
+      else:
+        self._add( ev )
+
+  def _update(self):
+    """
+    Bring the registration of changed fds up to date.
+    """
+    epoll = self._epoll
+    for fd in self._changed:
+      slots = self._fds.get( fd )
+      read = slots and slots[0] and slots[0]._pending
+      write = slots and slots[1] and slots[1]._pending
+      current = self._registered.get( fd, 0 )
+
+      if self.edge_triggered:
+        wanted = self.ET_MASK if (read or write) else 0
+      else:
+        wanted = (select.EPOLLIN if read else 0) | (select.EPOLLOUT if write else 0)
+
+      try:
+        if not wanted:
+          self._registered.pop( fd, None )
+          self._fds.pop( fd, None )
+          if current:
+            epoll.unregister( fd )
+        elif not current:
+          self._registered[fd] = wanted
+          epoll.register( fd, wanted )
+        elif wanted!=current or fd in self._rearm:
+          self._registered[fd] = wanted
+          try:
+            epoll.modify( fd, wanted )
+          except IOError, e:
+            # The fd was closed and reused since it was registered.
+            if e.errno!=errno.ENOENT:
+              raise
+            epoll.register( fd, wanted )
+      except IOError, e:
+        # The fd has been closed, which removed it from epoll.
+        if e.errno not in (errno.EBADF, errno.ENOENT):
+          raise
+        self._registered.pop( fd, None )
+    self._changed.clear()
+    self._rearm.clear()
+
+  def _signal_handler(self, signum, frame):
+    self._caught.append( signum )
+    try:
+      os.write( self._wakeup_w, '\0' )
+    except OSError:
+      pass
+
+class ThreadLocalBackend(Backend):
+  """
+  Passes each call to the backend that the calling thread has bound with
+  bind(), or to the default backend in threads that haven't, so that the
+  sockets and timers each thread creates are on its own loop.  Callbacks
+  run in the thread of the loop their event is on.  ShardedServer installs
+  one of these while it runs.
+  """
+
+  def __init__(self, default, edge_triggered=False):
+    self.default = default
+    # All of the loops have to agree, as EventSocket only checks once.
+    self.edge_triggered = edge_triggered or \
+      getattr( default, 'edge_triggered', False )
+    self._local = threading.local()
+
+  def bind(self, backend):
+    """
+    Use backend for the calling thread, or the default if it's None.
+    """
+    self._local.backend = backend
+
+  def current(self):
+    """
+    Return the backend for the calling thread.
+    """
+    return getattr( self._local, 'backend', None ) or self.default
+
+  def read(self, handle, callback, *args):
+    return self.current().read( handle, callback, *args )
+
+  def write(self, handle, callback, *args):
+    return self.current().write( handle, callback, *args )
+
+  def timeout(self, secs, callback, *args):
+    return self.current().timeout( secs, callback, *args )
+
+  def signal(self, signum, callback, *args):
+    return self.current().signal( signum, callback, *args )
+
+  def init(self):
+    return self.current().init()
+
+  def dispatch(self):
+    return self.current().dispatch()
+
+  def abort(self):
+    return self.current().abort()
+
+# Whether the backend needs EventSocket to re-arm read events.
+_edge_triggered = False
+
+def set_backend(backend, **kwargs):
+  """
+  Choose the event loop backend for this process, by name or as a Backend:
+
+    libevent  the event module, the default where it's installed
+    epoll     an EpollBackend, the default otherwise
+    epoll-et  an edge-triggered EpollBackend
+    asyncio   an AsyncioBackend on the current loop, see use_asyncio()
+
+  The name may also be set in the EVENTSOCKET_BACKEND environment variable.
+  Any kwargs are passed to the backend.  Call this before creating any
+  sockets or timers, and use the returned backend, which is also available
+  as eventsocket.event, to run the loop.
+  """
+  global event, _edge_triggered
+
+  backend = _new_backend( backend, **kwargs )
+  event = backend
+  _edge_triggered = getattr( backend, 'edge_triggered', False )
+  return backend
+
+def _new_backend(backend, **kwargs):
+  """
+  Return the backend named by backend, or backend itself if it isn't a name.
+  """
+  if backend=='libevent':
+    if _libevent is None:
+      raise ImportError( "the libevent backend needs the event module" )
+    backend = _libevent
+  elif backend=='epoll':
+    backend = EpollBackend( **kwargs )
+  elif backend=='epoll-et':
+    backend = EpollBackend( edge_triggered=True, **kwargs )
+  elif backend=='asyncio':
+    backend = AsyncioBackend( **kwargs )
+  elif isinstance(backend, basestring):
+    raise ValueError( "unknown backend %s"%(backend) )
+  return backend
+
+class _DefaultBackend(object):
+  """
+  Stands in as eventsocket.event until it's first used, then installs the
+  default backend, so that importing this module doesn't open an epoll
+  descriptor that set_backend() is about to replace.
+  """
+
+  def __init__(self):
+    self._backend = None
+
+  def __getattr__(self, name):
+    return getattr( self.resolve(), name )
+
+  def resolve(self):
+    """
+    Return the default backend, creating it on first use.
+    """
+    if self._backend is None:
+      name = os.environ.get('EVENTSOCKET_BACKEND') or \
+        ('libevent' if _libevent else 'epoll')
+      if event is self:
+        self._backend = set_backend( name )
+      else:
+        self._backend = _new_backend( name )
+    return self._backend
+
+event = _DefaultBackend()
+
+class AsyncioStream(object):
+  """
+  Wraps an EventSocket on an asyncio loop with methods that return Futures,
+  like asyncio's StreamReader and StreamWriter, for use in coroutines:
+
+    header = yield From( stream.readexactly(4) )   # trollius
+    stream.write( reply )
+    yield From( stream.drain() )
+
+  The stream takes over the read_cb, output_empty_cb and write_resumed_cb of
+  the socket and chains its close_cb.  Input is moved out of the socket as
+  it arrives, and reading is paused while more than limit bytes are waiting
+  to be read and no read is waiting for more.
+  """
+
+  def __init__(self, sock, loop=None, limit=64*1024):
+    if loop is None:
+      loop = event.loop
+    self._sock = sock
+    self._loop = loop
+    self._limit = limit
+    self._buf = bytearray()
+    self._eof = False
+    self._paused = False
+    # Futures for reads, with functions that take their result from the
+    # buffer, and for drain()
+    self._readers = deque()
+    self._drainers = deque()
+
+    self._close_cb = sock._parent_close_cb
+    sock.read_cb = self._read_cb
+    sock.close_cb = self._closed_cb
+    sock.output_empty_cb = self._drained_cb
+    sock.write_resumed_cb = self._drained_cb
+
+  @property
+  def sock(self):
+    return self._sock
+
+  def at_eof(self):
+    """
+    Return whether the socket has closed and the input has all been read.
+    """
+    return self._eof and not self._buf
+
+  def read(self, n=-1):
+    """
+    Return a Future for up to n bytes of input, or all that's buffered if n
+    is negative, once there is some.  The result is empty once the socket has
+    closed.
+    """
+    def take():
+      if not self._buf:
+        return '' if self._eof else None
+      if n<0 or n>=len(self._buf):
+        data = self._buf
+        self._buf = bytearray()
+        return bytes( data )
+      data = bytes( self._buf[:n] )
+      del self._buf[:n]
+      return data
+    return self._wait( take )
+
+  def readexactly(self, n):
+    """
+    Return a Future for exactly n bytes of input.  Fails with EOFError if the
+    socket closes first.
+    """
+    def take():
+      if len(self._buf)>=n:
+        data = bytes( self._buf[:n] )
+        del self._buf[:n]
+        return data
+      if self._eof:
+        raise EOFError( "%d of %d bytes read before the socket closed"%(len(self._buf), n) )
+      return None
+    return self._wait( take )
+
+  def readuntil(self, sep='\n'):
+    """
+    Return a Future for the input up to and including sep.  Fails with
+    EOFError if the socket closes first, or ValueError if sep isn't found
+    within limit bytes.
+    """
+    def take():
+      idx = self._buf.find( sep )
+      if idx>=0:
+        data = bytes( self._buf[:idx+len(sep)] )
+        del self._buf[:idx+len(sep)]
+        return data
+      if self._eof:
+        raise EOFError( "separator not found before the socket closed" )
+      if self._limit and len(self._buf)>self._limit:
+        raise ValueError( "separator not found in %d bytes"%(len(self._buf)) )
+      return None
+    return self._wait( take )
+
+  def write(self, data):
+    """
+    Write data to the socket.  Follow a series of writes with drain().
+    """
+    self._sock.write( data )
+
+  def drain(self):
+    """
+    Return a Future that is done once the output has drained, to the write
+    low watermark if the socket has a high watermark, else completely.  Fails
+    with socket.error if the socket closes first.
+    """
+    fut = self._future()
+    if self._sock.closed:
+      fut.set_exception( socket.error('write error: socket is closed') )
+    elif self._drained():
+      fut.set_result( None )
+    else:
+      self._drainers.append( fut )
+    return fut
+
+  def close(self):
+    self._sock.close()
+
+  def _future(self):
+    if hasattr(self._loop, 'create_future'):
+      return self._loop.create_future()
+    return asyncio.Future( loop=self._loop )
+
+  def _wait(self, take):
+    fut = self._future()
+    self._readers.append( (take, fut) )
+    self._wake_readers()
+    return fut
+
+  def _wake_readers(self):
+    """
+    Complete the reads that can be, in order.
+    """
+    while self._readers:
+      take,fut = self._readers[0]
+      if fut.cancelled():
+        self._readers.popleft()
+        continue
+
+      try:
+        data = take()
+      except (EOFError, ValueError), e:
+        self._readers.popleft()
+        fut.set_exception( e )
+        continue
+      if data is None:
+        break
+      self._readers.popleft()
+      fut.set_result( data )
+
+    # Keep reading while a read is waiting for more than limit bytes.
+    if self._paused and (self._readers or len(self._buf)<=self._limit):
+      self._paused = False
+      if not self._eof:
+        self._sock.resume_reading()
+
+  def _read_cb(self, sock):
+    data = sock.read()
+    if self._buf:
+      self._buf += data
+    else:
+      self._buf = data
+    self._wake_readers()
+
+    if self._limit and len(self._buf)>self._limit and not self._readers and \
+        not self._paused:
+      self._paused = True
+      sock.pause_reading()
+
+  def _drained(self):
+    if self._sock._write_high_water:
+      return not self._sock.write_paused
+    return self._sock.pending_write_bytes==0
+
+  def _drained_cb(self, sock):
+    if self._drained():
+      while self._drainers:
+        fut = self._drainers.popleft()
+        if not fut.done():
+          fut.set_result( None )
+
+  def _closed_cb(self, sock):
+    self._eof = True
+    self._wake_readers()
+    while self._drainers:
+      fut = self._drainers.popleft()
+      if not fut.done():
+        fut.set_exception( socket.error('write error: socket is closed') )
+    if self._close_cb:
+      self._close_cb( sock )
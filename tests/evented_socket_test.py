@@ -6,6 +6,12 @@ import socket
 import os
 import errno
 import time
+import fcntl
+import struct
+import tempfile
+import select
+import signal
+import threading
 from collections import deque
 from chai import Chai
 
@@ -20,6 +26,34 @@ class EventSocketTest(Chai):
     # mock all event callbacks
     mock( eventsocket, 'event' )
 
+    # keep stats from leaking between tests
+    mock( eventsocket, 'global_stats' )
+    eventsocket.global_stats = eventsocket.IOStats( histograms=True )
+
+  def test_socket_methods_are_delegated(self):
+    sock = EventSocket()
+    sock._sock = mock()
+
+    expect( sock._sock.setsockopt ).args( 1, 2, 3 )
+    expect( sock._sock.getsockopt ).args( 1, 2 ).returns( 3 )
+    expect( sock._sock.fileno ).returns( 7 )
+    expect( sock._sock.getpeername ).returns( ('.com', 1234) )
+    expect( sock._sock.getsockname ).returns( ('foo', 5678) )
+    expect( sock._sock.setblocking ).args( False )
+    expect( sock._sock.settimeout ).args( 8.67 )
+    expect( sock._sock.gettimeout ).returns( 8.67 )
+    expect( sock._sock.shutdown ).args( socket.SHUT_WR )
+
+    sock.setsockopt( 1, 2, 3 )
+    assert_equals( 3, sock.getsockopt(1, 2) )
+    assert_equals( 7, sock.fileno() )
+    assert_equals( ('.com', 1234), sock.getpeername() )
+    assert_equals( ('foo', 5678), sock.getsockname() )
+    sock.setblocking( False )
+    sock.settimeout( 8.67 )
+    assert_equals( 8.67, sock.gettimeout() )
+    sock.shutdown( socket.SHUT_WR )
+
   def test_init_without_args(self):
     sock = EventSocket()
     assert_false( sock._debug )
@@ -28,36 +62,78 @@ class EventSocketTest(Chai):
     assert_equal( None, sock._write_event )
     assert_equal( None, sock._accept_event )
     assert_equal( None, sock._connect_event )
+    assert_equal( None, sock._connect_timeout_event )
     assert_equal( None, sock._pending_read_cb_event )
     assert_equal( 'unknown', sock._peername )
     assert_true( isinstance(sock._sock, socket.socket) )
-    assert_equal( sock.listen, sock._sock.listen )
-    assert_equal( sock.setsockopt, sock._sock.setsockopt )
-    assert_equal( sock.fileno, sock._sock.fileno )
-    assert_equal( sock.getpeername, sock._sock.getpeername )
-    assert_equal( sock.getsockname, sock._sock.getsockname )
-    assert_equal( sock.getsockopt, sock._sock.getsockopt )
-    assert_equal( sock.setblocking, sock._sock.setblocking )
-    assert_equal( sock.settimeout, sock._sock.settimeout )
-    assert_equal( sock.gettimeout, sock._sock.gettimeout )
-    assert_equal( sock.shutdown, sock._sock.shutdown )
+    assert_false( hasattr(sock, '__dict__') and sock.__dict__ )
     assert_equal( 0, sock._max_read_buffer )
+    assert_equal( 1, sock._accept_burst )
     assert_equal( deque(), sock._write_buf )
-    assert_equal( bytearray(), sock._read_buf )
+    assert_true( isinstance(sock._read_buf, eventsocket.ReadBuffer) )
+    assert_equal( 0, len(sock._read_buf) )
+    assert_false( sock._recv_into )
+    assert_false( sock._sync_read )
+    assert_equal( 0, sock._read_size )
+    assert_equal( 0, sock._min_read_size )
+    assert_equal( 0, sock._max_read_size )
+    assert_equal( 0, sock._drain_budget )
+    assert_equal( 16, sock._drain_reads )
+    assert_false( sock._vectored_writes )
+    assert_equal( 0, sock._write_offset )
+    assert_equal( 0, sock._write_buf_bytes )
+    assert_equal( 0, sock._write_high_water )
+    assert_equal( 0, sock._write_low_water )
+    assert_false( sock._write_paused )
+    assert_equal( None, sock._throttled_sock )
+    assert_false( sock._throttled )
+    assert_false( sock._read_paused )
+    assert_equal( 0, sock._read_high_water )
+    assert_false( sock._read_buf_full )
     assert_equal( None, sock._parent_accept_cb )
     assert_equal( None, sock._parent_read_cb )
+    assert_equal( None, sock._parent_message_cb )
+    assert_equal( None, sock._framing )
     assert_equal( None, sock._parent_error_cb )
     assert_equal( None, sock._parent_close_cb )
     assert_equal( None, sock._parent_output_empty_cb )
+    assert_equal( None, sock._parent_connect_cb )
+    assert_equal( None, sock._parent_write_paused_cb )
+    assert_equal( None, sock._parent_write_resumed_cb )
     assert_equal( None, sock._error_msg )
     assert_false( sock._closed )
     assert_equal( None, sock._inactive_event )
+    assert_equal( None, sock._timer_wheel )
+    assert_equal( None, sock._close_reason )
+    assert_equal( 0, sock._stats_level )
+    assert_equal( None, sock._stats )
+    assert_equal( None, sock.stats )
 
     # TODO: mock instead that we're calling setinactivetimeout() ?
     assert_equal( 0, sock._inactive_timeout )
 
   # TODO: test with all possible args
 
+  def test_init_with_adaptive_read_size(self):
+    sock = EventSocket( max_read_size=65536 )
+    assert_equal( eventsocket.MIN_READ_SIZE, sock._min_read_size )
+    assert_equal( eventsocket.MIN_READ_SIZE, sock._read_size )
+
+    sock = EventSocket( min_read_size=512, max_read_size=65536 )
+    assert_equal( 512, sock._read_size )
+
+    sock = EventSocket( min_read_size=512, max_read_size=256 )
+    assert_equal( 256, sock._read_size )
+
+  def test_init_with_stats(self):
+    sock = EventSocket( stats=1 )
+    assert_true( isinstance(sock.stats, eventsocket.IOStats) )
+    assert_equal( None, sock.stats.read_cb_latency )
+    assert_true( sock in eventsocket._stats_sockets )
+
+    sock = EventSocket( stats=2 )
+    assert_true( isinstance(sock.stats.read_cb_latency, eventsocket.Histogram) )
+
   def test_closed_property(self):
     sock = EventSocket()
     sock._closed = 'yes'
@@ -74,7 +150,7 @@ class EventSocketTest(Chai):
 
   def test_set_read_cb_when_should_flush(self):
     sock = EventSocket()
-    sock._read_buf = bytearray('somedata')
+    sock._read_buf.extend( 'somedata' )
     sock._parent_read_cb = None
     sock._pending_read_cb_event = None
 
@@ -86,7 +162,7 @@ class EventSocketTest(Chai):
 
   def test_set_read_cb_when_data_to_flush_but_pending_read_event(self):
     sock = EventSocket()
-    sock._read_buf = bytearray('somedata')
+    sock._read_buf.extend( 'somedata' )
     sock._parent_read_cb = None
     sock._pending_read_cb_event = 'pending_event'
 
@@ -124,6 +200,98 @@ class EventSocketTest(Chai):
     sock.output_empty_cb = 'output_empty_cb'
     assert_equals( 'output_empty_cb', sock._parent_output_empty_cb )
 
+  def test_connect_cb_property(self):
+    sock = EventSocket()
+    sock.connect_cb = 'connect_cb'
+    assert_equals( 'connect_cb', sock._parent_connect_cb )
+
+  def test_write_paused_cb_property(self):
+    sock = EventSocket()
+    sock.write_paused_cb = 'write_paused_cb'
+    assert_equals( 'write_paused_cb', sock._parent_write_paused_cb )
+
+  def test_write_resumed_cb_property(self):
+    sock = EventSocket()
+    sock.write_resumed_cb = 'write_resumed_cb'
+    assert_equals( 'write_resumed_cb', sock._parent_write_resumed_cb )
+
+  def test_throttle_when_not_paused(self):
+    sock = EventSocket()
+    other = EventSocket()
+    other._read_event = mock()
+
+    sock.throttle( other )
+    assert_equals( other, sock._throttled_sock )
+    assert_false( other._throttled )
+
+  def test_throttle_when_paused(self):
+    sock = EventSocket()
+    sock._write_paused = True
+    other = EventSocket()
+    other._read_event = mock()
+
+    expect( other._read_event.delete )
+
+    sock.throttle( other )
+    assert_true( other._throttled )
+
+  def test_set_throttled_off_when_read_event_not_pending(self):
+    sock = EventSocket()
+    sock._throttled = True
+    sock._read_event = mock()
+
+    expect( sock._read_event.pending ).returns( False )
+    expect( sock._read_event.add )
+
+    sock._set_throttled( False )
+    assert_false( sock._throttled )
+
+  def test_set_throttled_when_unconnected(self):
+    sock = EventSocket()
+    sock._set_throttled( True )
+    assert_true( sock._throttled )
+
+  def test_pause_reading(self):
+    sock = EventSocket()
+    sock._read_event = mock()
+
+    expect( sock._read_event.delete )
+
+    sock.pause_reading()
+    assert_true( sock.reading_paused )
+
+  def test_resume_reading(self):
+    sock = EventSocket()
+    sock._read_paused = True
+    sock._read_event = mock()
+
+    expect( sock._read_event.pending ).returns( False )
+    expect( sock._read_event.add )
+
+    sock.resume_reading()
+    assert_false( sock.reading_paused )
+
+  def test_resume_reading_when_still_throttled(self):
+    sock = EventSocket()
+    sock._read_paused = True
+    sock._throttled = True
+    sock._read_event = mock()
+
+    expect( sock._read_event.delete )
+
+    sock.resume_reading()
+    assert_true( sock.reading_paused )
+
+  def test_close_releases_throttled_sock(self):
+    sock = EventSocket()
+    other = EventSocket()
+    sock._throttled_sock = other
+
+    expect( other._set_throttled ).args( False )
+
+    sock.close()
+    assert_equals( None, sock._throttled_sock )
+
   def test_bind_without_debugging(self):
     sock = EventSocket()
     sock._sock = mock()
@@ -176,12 +344,11 @@ class EventSocketTest(Chai):
     expect( sock._sock.connect_ex ).args( ('.com', 1234) )
     expect( sock._sock.getpeername ).returns( ('.com', 1234) )
     expect( eventsocket.event.read ).args( sock._sock, sock._protected_cb, sock._read_cb ).returns( 'readev' )
-    expect( eventsocket.event.write ).args( sock._sock, sock._protected_cb, sock._write_cb ).returns( 'writeev' )
     
     sock._connect_cb( 3.14, ('.com',1234) )
     assert_equals( '.com:1234', sock._peername )
     assert_equals( 'readev', sock._read_event )
-    assert_equals( 'writeev', sock._write_event )
+    assert_equals( None, sock._write_event )
     assert_equals( None, sock._connect_event )
 
   def test_connect_cb_when_no_err_and_pending_connect_event(self):
@@ -191,7 +358,6 @@ class EventSocketTest(Chai):
     expect( sock._sock.connect_ex ).args( ('.com', 1234) )
     expect( sock._sock.getpeername ).returns( ('.com', 1234) )
     expect( eventsocket.event.read ).any_args()
-    expect( eventsocket.event.write ).any_args()
     expect( sock._connect_event.delete )
     
     sock._connect_cb( 3.14, ('.com',1234) )
@@ -203,23 +369,39 @@ class EventSocketTest(Chai):
     
     timeout_at = time.time()+3
     expect( sock._sock.connect_ex ).args( ('.com', 1234) ).returns( errno.EINPROGRESS )
-    expect( eventsocket.event.timeout ).args( 0.1, sock._connect_cb, timeout_at, ('.com', 1234) ).returns( 'connectev' )
+    expect( eventsocket.event.write ).args( sock._sock, sock._protected_cb, sock._connect_ready_cb, (('.com', 1234),) ).returns( 'connectev' )
+    expect( eventsocket.event.timeout ).args( almost_equals(3,1), sock._protected_cb, sock._connect_timeout_cb, (('.com', 1234),) ).returns( 'timeoutev' )
 
     sock._connect_cb( timeout_at, ('.com',1234) )
     assert_equals( 'connectev', sock._connect_event )
+    assert_equals( 'timeoutev', sock._connect_timeout_event )
 
   def test_connect_cb_when_einprogress_and_notimeout_and_pending_connect(self):
     sock = EventSocket()
     mock( sock, '_sock' )
     mock( sock, '_connect_event' )
     
+    sock._connect_timeout_event = 'timeoutev'
+    
     timeout_at = time.time()+3
     expect( sock._sock.connect_ex ).args( ('.com', 1234) ).returns( errno.EINPROGRESS )
     expect( sock._connect_event.delete )
-    expect( eventsocket.event.timeout ).args( 0.1, sock._connect_cb, timeout_at, ('.com', 1234) ).returns( 'connectev' )
+    expect( eventsocket.event.write ).args( sock._sock, sock._protected_cb, sock._connect_ready_cb, (('.com', 1234),) ).returns( 'connectev' )
 
     sock._connect_cb( timeout_at, ('.com',1234) )
     assert_equals( 'connectev', sock._connect_event )
+    assert_equals( 'timeoutev', sock._connect_timeout_event )
+
+  def test_connect_cb_when_einprogress_and_no_timeout(self):
+    sock = EventSocket()
+    mock( sock, '_sock' )
+    
+    expect( sock._sock.connect_ex ).args( ('.com', 1234) ).returns( errno.EINPROGRESS )
+    expect( eventsocket.event.write ).args( sock._sock, sock._protected_cb, sock._connect_ready_cb, (('.com', 1234),) ).returns( 'connectev' )
+
+    sock._connect_cb( None, ('.com',1234) )
+    assert_equals( 'connectev', sock._connect_event )
+    assert_equals( None, sock._connect_timeout_event )
 
   def test_connect_cb_when_ealready_and_timeout(self):
     sock = EventSocket()
@@ -252,6 +434,97 @@ class EventSocketTest(Chai):
 
     sock._connect_cb( time.time(), ('.com',1234) )
 
+  def test_connect_ready_cb_when_connected(self):
+    sock = EventSocket()
+    mock( sock, '_sock' )
+    sock._connect_event = 'connectev'
+    sock._connect_timeout_event = mock()
+
+    expect( sock._connect_timeout_event.delete )
+    expect( sock._sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_ERROR ).returns( 0 )
+    expect( sock._connected )
+
+    assert_equals( None, sock._connect_ready_cb( ('.com',1234) ) )
+    assert_equals( None, sock._connect_event )
+    assert_equals( None, sock._connect_timeout_event )
+    assert_equals( "error connecting to ('.com', 1234)", sock._error_msg )
+
+  def test_connect_ready_cb_when_failed(self):
+    sock = EventSocket()
+    mock( sock, '_sock' )
+
+    expect( sock._sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_ERROR ).returns( errno.ECONNREFUSED )
+    expect( sock._handle_error ).args( socket.error )
+
+    assert_equals( None, sock._connect_ready_cb( ('.com',1234) ) )
+    assert_equals( os.strerror(errno.ECONNREFUSED), sock._error_msg )
+
+  def test_connect_timeout_cb(self):
+    sock = EventSocket()
+    sock._connect_timeout_event = 'timeoutev'
+
+    expect( sock.close )
+
+    sock._connect_timeout_cb( ('.com',1234) )
+    assert_equals( None, sock._connect_timeout_event )
+    assert_equals( "timeout connecting to ('.com', 1234)", sock._error_msg )
+    assert_equals( 'connect_timeout', sock._close_reason )
+
+  def test_connected_calls_connect_cb(self):
+    sock = EventSocket()
+    mock( sock, '_sock' )
+    sock._parent_connect_cb = mock()
+    sock._connect_timeout_event = mock()
+
+    expect( sock._sock.getpeername ).returns( ('.com', 1234) )
+    expect( eventsocket.event.read ).args( sock._sock, sock._protected_cb, sock._read_cb ).returns( 'readev' )
+    expect( sock._connect_timeout_event.delete )
+    expect( sock._parent_connect_cb ).args( sock )
+
+    sock._connected()
+    assert_equals( '.com:1234', sock._peername )
+    assert_equals( None, sock._connect_timeout_event )
+    assert_equals( None, sock._write_event )
+
+  def test_connected_flushes_writes(self):
+    sock = EventSocket()
+    mock( sock, '_sock' )
+    sock._write_buf = deque(['data'])
+
+    expect( sock._sock.getpeername ).returns( ('.com', 1234) )
+    expect( eventsocket.event.read ).args( sock._sock, sock._protected_cb, sock._read_cb ).returns( 'readev' )
+    expect( eventsocket.event.write ).args( sock._sock, sock._protected_cb, sock._write_cb ).returns( 'writeev' )
+
+    sock._connected()
+    assert_equals( 'writeev', sock._write_event )
+
+  def test_connected_flushes_data_spliced_while_connecting(self):
+    sock = EventSocket()
+    mock( sock, '_sock' )
+    sock._splice_in = mock()
+    sock._splice_in.pending = 18
+
+    expect( sock._sock.getpeername ).returns( ('.com', 1234) )
+    expect( eventsocket.event.read ).args( sock._sock, sock._protected_cb, sock._read_cb ).returns( 'readev' )
+    expect( eventsocket.event.write ).args( sock._sock, sock._protected_cb, sock._write_cb ).returns( 'writeev' )
+
+    sock._connected()
+    assert_equals( 'writeev', sock._write_event )
+
+  def test_schedule_write_creates_write_event_once_connected(self):
+    sock = EventSocket()
+
+    sock._schedule_write()
+    assert_equals( None, sock._write_event )
+
+    sock._read_event = mock()
+    expect( eventsocket.event.write ).args( sock._sock, sock._protected_cb, sock._write_cb ).returns( mock() )
+    sock._schedule_write()
+
+    expect( sock._write_event.pending ).returns( False )
+    expect( sock._write_event.add )
+    sock._schedule_write()
+
   def test_set_inactive_timeout_when_turning_off(self):
     sock = EventSocket()
     sock._inactive_event = mock()
@@ -273,6 +546,37 @@ class EventSocketTest(Chai):
     assert_equals( 'new_timeout', sock._inactive_event )
     assert_equals( 32, sock._inactive_timeout )
 
+  def test_set_inactive_timeout_with_timer_wheel(self):
+    sock = EventSocket()
+    wheel = mock()
+    EventSocket.timer_wheel = wheel
+    try:
+      expect( wheel.add ).args( sock )
+      sock.set_inactive_timeout( 32 )
+    finally:
+      EventSocket.timer_wheel = None
+    assert_equals( wheel, sock._timer_wheel )
+    assert_equals( None, sock._inactive_event )
+    assert_equals( 32, sock._inactive_timeout )
+
+  def test_set_inactive_timeout_off_with_timer_wheel(self):
+    sock = EventSocket()
+    sock._timer_wheel = mock()
+
+    expect( sock._timer_wheel.remove ).args( sock )
+
+    sock.set_inactive_timeout( 0 )
+    assert_equals( None, sock._timer_wheel )
+
+  def test_close_removes_from_timer_wheel(self):
+    sock = EventSocket()
+    wheel = sock._timer_wheel = mock()
+
+    expect( wheel.remove ).args( sock )
+
+    sock.close()
+    assert_equals( None, sock._timer_wheel )
+
   def test_set_inactive_timeout_on_stupid_input(self):
     sock = EventSocket()
     assert_raises( TypeError, sock.set_inactive_timeout, 'blah' )
@@ -342,6 +646,32 @@ class EventSocketTest(Chai):
       sock._protected_cb( cb, 'arg1', 'arg2', arg3='foo' ) )
     assert_equals( None, sock._error_msg )
 
+  def test_protected_cb_with_profiler(self):
+    sock = EventSocket()
+    sock.profiler = mock()
+    cb = mock()
+
+    expect( sock.profiler.call ).args( sock, cb, ('arg1',), {'arg2':'foo'} ).returns( 'result' )
+
+    assert_equals( 'result', sock._protected_cb( cb, 'arg1', arg2='foo' ) )
+
+  def test_protected_cb_with_profiler_when_an_error(self):
+    sock = EventSocket()
+    sock.profiler = eventsocket.CallbackProfiler()
+
+    def failing_cb():
+      raise RuntimeError('fale')
+    expect( sock._handle_error ).args( is_a(RuntimeError) )
+
+    assert_equals( None, sock._protected_cb( failing_cb ) )
+    assert_equals( 1, sock.profiler.callbacks['failing_cb'].count )
+
+  def test_close_forgets_profiled_peer(self):
+    sock = EventSocket()
+    sock.profiler = mock()
+    expect( sock.profiler.forget ).args( sock )
+    sock.close()
+
   def test_accept_cb_when_no_logger_and_no_parent_cb(self):
     sock = EventSocket()
     sock._sock = mock()
@@ -355,7 +685,11 @@ class EventSocketTest(Chai):
     expect(sock._sock.accept).returns( ('connection', 'address') )
     expect(EventSocket.__init__).args( read_cb='p_read_cb', error_cb='p_error_cb',
       close_cb='p_close_cb', sock='connection', debug=False,
-      logger=None, max_read_buffer=42 )
+      logger=None, max_read_buffer=42, recv_into=False,
+      vectored_writes=False, write_high_water=0, write_low_water=0,
+      read_high_water=0, stats=0, sync_read=False, min_read_size=0,
+      max_read_size=0, drain_budget=0, drain_reads=16, framing=None,
+      message_cb=None )
 
     assert_true( sock._accept_cb() )
     assert_equals( 'error accepting new socket', sock._error_msg )
@@ -375,11 +709,126 @@ class EventSocketTest(Chai):
     expect(sock._logger.debug).args( "accepted connection from address" )
     expect(EventSocket.__init__).args( read_cb='p_read_cb', error_cb='p_error_cb',
       close_cb='p_close_cb', sock='connection', debug=True,
-      logger=sock._logger, max_read_buffer=42 )
+      logger=sock._logger, max_read_buffer=42, recv_into=False,
+      vectored_writes=False, write_high_water=0, write_low_water=0,
+      read_high_water=0, stats=0, sync_read=False, min_read_size=0,
+      max_read_size=0, drain_budget=0, drain_reads=16, framing=None,
+      message_cb=None )
     expect(sock._protected_cb).args( 'p_accept_cb', is_a(EventSocket) )
 
     assert_true( sock._accept_cb() )
 
+  def test_accept_cb_counts_accepts(self):
+    sock = EventSocket( stats=1 )
+    sock._sock = mock()
+
+    expect(sock._sock.accept).returns( ('connection', 'address') )
+    expect(sock._accepted).args( 'connection', 'address' )
+
+    assert_true( sock._accept_cb() )
+    assert_equals( 1, sock.stats.accepts )
+    assert_equals( 1, eventsocket.global_stats.accepts )
+
+  def test_accept_cb_bursts_until_eagain(self):
+    sock = EventSocket( accept_burst=5 )
+    sock._sock = mock()
+    conn1 = mock()
+    conn2 = mock()
+
+    expect( sock._sock.gettimeout ).returns( 0.0 )
+    expect( sock._sock.accept ).returns( (conn1, 'address1') )
+    expect( conn1.setblocking ).args( False )
+    expect( conn1.fileno ).returns( 7 )
+    expect( fcntl, 'fcntl' ).args( 7, fcntl.F_SETFD, fcntl.FD_CLOEXEC )
+    expect( sock._sock.accept ).returns( (conn2, 'address2') )
+    expect( conn2.setblocking ).args( False )
+    expect( conn2.fileno ).returns( 8 )
+    expect( fcntl, 'fcntl' ).args( 8, fcntl.F_SETFD, fcntl.FD_CLOEXEC )
+    expect( sock._sock.accept ).raises( socket.error(errno.EAGAIN, 'try again') )
+    expect( sock._accepted ).args( conn1, 'address1' )
+    expect( sock._accepted ).args( conn2, 'address2' )
+
+    assert_true( sock._accept_cb() )
+
+  def test_accept_cb_rearms_edge_triggered_accept_at_burst_limit(self):
+    sock = EventSocket()
+    sock._sock = mock()
+    sock._accept_event = mock()
+    conn = mock()
+    mock( eventsocket, '_edge_triggered' )
+    eventsocket._edge_triggered = True
+
+    expect( sock._sock.accept ).returns( (conn, 'address') )
+    expect( sock._accepted ).args( conn, 'address' )
+    expect( sock._accept_event.add )
+
+    assert_true( sock._accept_cb() )
+
+  def test_accept_cb_burst_limit(self):
+    sock = EventSocket( accept_burst=2 )
+    sock._sock = mock()
+    conn = mock()
+
+    expect( sock._sock.gettimeout ).returns( 0.0 )
+    expect( sock._sock.accept ).returns( (conn, 'address') ).times( 2 )
+    expect( conn.setblocking ).args( False ).times( 2 )
+    expect( conn.fileno ).returns( 7 ).times( 2 )
+    expect( fcntl, 'fcntl' ).args( 7, fcntl.F_SETFD, fcntl.FD_CLOEXEC ).times( 2 )
+    expect( sock._accepted ).args( conn, 'address' ).times( 2 )
+
+    assert_true( sock._accept_cb() )
+
+  def test_accept_cb_only_accepts_once_when_blocking(self):
+    sock = EventSocket( accept_burst=5 )
+    sock._sock = mock()
+
+    expect( sock._sock.gettimeout ).returns( None )
+    expect( sock._sock.accept ).returns( ('connection', 'address') )
+    expect( sock._accepted ).args( 'connection', 'address' )
+
+    assert_true( sock._accept_cb() )
+
+  def test_accept_cb_when_nothing_to_accept(self):
+    sock = EventSocket()
+    sock._sock = mock()
+
+    expect( sock._sock.accept ).raises( socket.error(errno.EAGAIN, 'try again') )
+
+    assert_true( sock._accept_cb() )
+
+  def test_accept_cb_when_error_after_accepting(self):
+    sock = EventSocket( accept_burst=5 )
+    sock._sock = mock()
+    conn = mock()
+
+    expect( sock._sock.gettimeout ).returns( 0.0 )
+    expect( sock._sock.accept ).returns( (conn, 'address') )
+    expect( conn.setblocking ).args( False )
+    expect( conn.fileno ).returns( 7 )
+    expect( fcntl, 'fcntl' ).args( 7, fcntl.F_SETFD, fcntl.FD_CLOEXEC )
+    expect( sock._sock.accept ).raises( socket.error(errno.EMFILE, 'too many') )
+    expect( sock._accepted ).args( conn, 'address' )
+
+    assert_true( sock._accept_cb() )
+
+  def test_accept_cb_when_error(self):
+    sock = EventSocket()
+    sock._sock = mock()
+
+    expect( sock._sock.accept ).raises( socket.error(errno.EMFILE, 'too many') )
+
+    assert_raises( socket.error, sock._accept_cb )
+
+  def test_listen(self):
+    sock = EventSocket()
+    sock._sock = mock()
+
+    expect( sock._sock.listen ).args( socket.SOMAXCONN )
+    sock.listen()
+
+    expect( sock._sock.listen ).args( 42 )
+    sock.listen( 42 )
+
   def test_read_cb_simplest_case(self):
     sock = EventSocket()
     sock._sock = mock()
@@ -390,98 +839,462 @@ class EventSocketTest(Chai):
     expect( sock._flag_activity )
     
     assert_true( sock._read_cb() )
-    assert_equals( bytearray('sumdata'), sock._read_buf )
+    assert_equals( bytearray('sumdata'), sock._read_buf.detach() )
     assert_equals( 'error reading from socket', sock._error_msg )
 
-  def test_read_cb_when_debugging_and_parent_cb_and_no_pending_event(self):
-    sock = EventSocket()
+  def test_read_cb_counts_reads(self):
+    sock = EventSocket( stats=1 )
     sock._sock = mock()
-    sock._logger = mock()
-    sock._peername = 'peername'
-    sock._debug = True
-    sock._parent_read_cb = 'p_read_cb'
+    sock._read_buf.extend( 'old' )
     mock( sock, 'getsockopt' )
     
     expect( sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_RCVBUF ).returns( 42 )
     expect( sock._sock.recv ).args( 42 ).returns( 'sumdata' )
-    expect( sock._logger.debug ).args( 'read 7 bytes from peername' )
-    expect( sock._flag_activity )
-    expect( eventsocket.event.timeout ).args( 0, sock._protected_cb, sock._parent_read_timer_cb ).returns('pending_read')
     
     assert_true( sock._read_cb() )
-    assert_equals( bytearray('sumdata'), sock._read_buf )
-    assert_equals( 'pending_read', sock._pending_read_cb_event )
-  
-  def test_read_cb_when_parent_cb_and_is_a_pending_event_and_already_buffered_data(self):
-    sock = EventSocket()
-    sock._read_buf = bytearray('foo')
+    for stats in (sock.stats, eventsocket.global_stats):
+      assert_equals( 1, stats.recv_calls )
+      assert_equals( 7, stats.bytes_in )
+      assert_equals( 10, stats.read_buf_high )
+
+  def test_read_cb_counts_eof_as_close_reason(self):
+    sock = EventSocket( stats=1 )
     sock._sock = mock()
-    sock._peername = 'peername'
-    sock._parent_read_cb = 'p_read_cb'
-    sock._pending_read_cb_event = 'pending_read'
     mock( sock, 'getsockopt' )
     
     expect( sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_RCVBUF ).returns( 42 )
-    expect( sock._sock.recv ).args( 42 ).returns( 'sumdata' )
-    expect( sock._flag_activity )
+    expect( sock._sock.recv ).args( 42 ).returns( '' )
+    expect( sock._sock.close )
     
-    assert_true( sock._read_cb() )
-    assert_equals( bytearray('foosumdata'), sock._read_buf )
+    assert_equals( None, sock._read_cb() )
+    assert_equals( {'eof':1}, sock.stats.closes )
+    assert_equals( {'eof':1}, eventsocket.global_stats.closes )
+    assert_false( sock in eventsocket._stats_sockets )
 
-  def test_read_cb_when_buffer_overflow(self):
+  def test_read_cb_caches_rcvbuf(self):
     sock = EventSocket()
     sock._sock = mock()
-    sock._logger = mock()
-    sock._peername = 'peername'
-    sock._debug = True
-    sock._max_read_buffer = 5
     mock( sock, 'getsockopt' )
-    mock( sock, 'close' )
     
     expect( sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_RCVBUF ).returns( 42 )
-    expect( sock._sock.recv ).args( 42 ).returns( 'sumdata' )
-    expect( sock._logger.debug ).args( 'read 7 bytes from peername' )
-    expect( sock._flag_activity )
-    expect( sock._logger.debug ).args( 'buffer for peername overflowed!' )
-    expect( sock.close )
+    expect( sock._sock.recv ).args( 42 ).returns( 'sum' ).times( 2 )
     
-    assert_equals( None, sock._read_cb() )
-    assert_equals( bytearray(), sock._read_buf )
+    assert_true( sock._read_cb() )
+    assert_true( sock._read_cb() )
+    assert_equals( bytearray('sumsum'), sock._read_buf.detach() )
 
-  def test_read_cb_when_no_data(self):
-    sock = EventSocket()
+  def test_read_cb_with_adaptive_read_size(self):
+    sock = EventSocket( min_read_size=4, max_read_size=16 )
     sock._sock = mock()
-    mock( sock, 'getsockopt' )
-    mock( sock, 'close' )
     
-    expect( sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_RCVBUF ).returns( 42 )
-    expect( sock._sock.recv ).args( 42 ).returns( '' )
-    expect( sock.close )
+    expect( sock._sock.recv ).args( 4 ).returns( 'abcd' )
+    expect( sock._sock.recv ).args( 8 ).returns( 'abcdefgh' )
+    expect( sock._sock.recv ).args( 16 ).returns( 'abcdefghijklmnop' )
+    expect( sock._sock.recv ).args( 16 ).returns( 'abcd' )
+    expect( sock._sock.recv ).args( 8 ).returns( 'abcd' )
     
-    assert_equals( None, sock._read_cb() )
+    for x in xrange(5):
+      assert_true( sock._read_cb() )
+    assert_equals( 8, sock._read_size )
+
+  def test_adapt_read_size(self):
+    sock = EventSocket( min_read_size=4096, max_read_size=65536 )
+
+    sock._adapt_read_size( 4096 )
+    assert_equals( 8192, sock._read_size )
+    sock._adapt_read_size( 2049 )
+    assert_equals( 8192, sock._read_size )
+    sock._adapt_read_size( 2048 )
+    assert_equals( 4096, sock._read_size )
+    sock._adapt_read_size( 1 )
+    assert_equals( 4096, sock._read_size )
+
+    sock._read_size = 65536
+    sock._adapt_read_size( 65536 )
+    assert_equals( 65536, sock._read_size )
+
+  def test_read_cb_drains_until_eagain(self):
+    sock = EventSocket( drain_budget=100, stats=1 )
+    sock._sock = mock()
+    sock._read_size = 4
+    
+    expect( sock._sock.gettimeout ).returns( 0.0 )
+    expect( sock._sock.recv ).args( 4 ).returns( 'abcd' ).times( 2 )
+    expect( sock._sock.recv ).args( 4 ).raises( 
+      socket.error(errno.EAGAIN, 'try again') )
+    
+    assert_true( sock._read_cb() )
+    assert_equals( bytearray('abcdabcd'), sock._read_buf.detach() )
+    assert_equals( 1, sock.stats.eagain )
 
-  def test_parent_read_timer_cb(self):
-    sock = EventSocket()
-    sock._pending_read_cb_event = 'foo'
-    sock._parent_read_cb = mock()
-    expect( sock._parent_read_cb ).args( sock )
+  def test_read_cb_drain_stops_on_short_read(self):
+    sock = EventSocket( drain_budget=100 )
+    sock._sock = mock()
+    sock._read_size = 4
+    
+    expect( sock._sock.gettimeout ).returns( 0.0 )
+    expect( sock._sock.recv ).args( 4 ).returns( 'abcd' )
+    expect( sock._sock.recv ).args( 4 ).returns( 'ab' )
+    
+    assert_true( sock._read_cb() )
+    assert_equals( bytearray('abcdab'), sock._read_buf.detach() )
 
-    sock._parent_read_timer_cb()
-    assert_equals( 'error processing socket input buffer', sock._error_msg )
-    assert_equals( None, sock._pending_read_cb_event )
+  def test_read_cb_drain_stops_at_byte_budget(self):
+    sock = EventSocket( drain_budget=8 )
+    sock._sock = mock()
+    sock._read_size = 4
+    
+    expect( sock._sock.gettimeout ).returns( 0.0 )
+    expect( sock._sock.recv ).args( 4 ).returns( 'abcd' ).times( 2 )
+    
+    assert_true( sock._read_cb() )
+    assert_equals( 8, len(sock._read_buf) )
 
-  def test_parent_read_timer_cb_when_closed(self):
-    sock = EventSocket()
-    sock._pending_read_cb_event = 'foo'
-    sock._closed = True
-    sock._parent_read_cb = mock()
+  def test_read_cb_drain_stops_at_read_budget(self):
+    sock = EventSocket( drain_budget=100, drain_reads=3 )
+    sock._sock = mock()
+    sock._read_size = 4
+    
+    expect( sock._sock.gettimeout ).returns( 0.0 )
+    expect( sock._sock.recv ).args( 4 ).returns( 'abcd' ).times( 3 )
+    
+    assert_true( sock._read_cb() )
+    assert_equals( 12, len(sock._read_buf) )
 
-    sock._parent_read_timer_cb()
-    assert_equals( None, sock._error_msg )
-    assert_equals( 'foo', sock._pending_read_cb_event )
+  def test_read_cb_rearms_edge_triggered_read_when_stopped_early(self):
+    sock = EventSocket( drain_budget=8 )
+    sock._sock = mock()
+    sock._read_event = mock()
+    sock._read_size = 4
+    mock( eventsocket, '_edge_triggered' )
+    eventsocket._edge_triggered = True
 
-  def test_parent_read_timer_cb_when_read_cb_reset(self):
-    sock = EventSocket()
+    expect( sock._sock.gettimeout ).returns( 0.0 )
+    expect( sock._sock.recv ).args( 4 ).returns( 'abcd' ).times( 2 )
+    expect( sock._read_event.add )
+
+    assert_true( sock._read_cb() )
+
+  def test_read_cb_doesnt_rearm_edge_triggered_read_after_short_read(self):
+    sock = EventSocket()
+    sock._sock = mock()
+    sock._read_event = mock()
+    sock._read_size = 4
+    mock( eventsocket, '_edge_triggered' )
+    eventsocket._edge_triggered = True
+
+    expect( sock._sock.recv ).args( 4 ).returns( 'ab' )
+    expect( sock._read_event.add ).times( 0 )
+
+    assert_true( sock._read_cb() )
+
+  def test_read_cb_drain_stops_at_read_high_water(self):
+    sock = EventSocket( drain_budget=100, read_high_water=8 )
+    sock._sock = mock()
+    sock._read_size = 4
+    
+    expect( sock._sock.gettimeout ).returns( 0.0 )
+    expect( sock._sock.recv ).args( 4 ).returns( 'abcd' ).times( 2 )
+    
+    assert_equals( None, sock._read_cb() )
+    assert_equals( 8, len(sock._read_buf) )
+
+  def test_read_cb_doesnt_drain_blocking_socket(self):
+    sock = EventSocket( drain_budget=100 )
+    sock._sock = mock()
+    sock._read_size = 4
+    
+    expect( sock._sock.gettimeout ).returns( None )
+    expect( sock._sock.recv ).args( 4 ).returns( 'abcd' )
+    
+    assert_true( sock._read_cb() )
+    assert_equals( 4, len(sock._read_buf) )
+
+  def test_read_cb_drain_when_error_after_reading(self):
+    sock = EventSocket( drain_budget=100 )
+    sock._sock = mock()
+    sock._read_size = 4
+    sock._parent_read_cb = 'p_read_cb'
+    
+    expect( sock._sock.gettimeout ).returns( 0.0 )
+    expect( sock._sock.recv ).args( 4 ).returns( 'abcd' )
+    expect( sock._sock.recv ).args( 4 ).raises( 
+      socket.error(errno.ECONNRESET, 'reset') )
+    expect( eventsocket.event.timeout ).args( 0, sock._protected_cb, sock._parent_read_timer_cb ).returns('pending_read')
+    
+    assert_true( sock._read_cb() )
+    assert_equals( 'pending_read', sock._pending_read_cb_event )
+
+  def test_read_cb_drain_when_eof_after_reading(self):
+    sock = EventSocket( drain_budget=100 )
+    sock._sock = mock()
+    sock._read_size = 4
+    sock._parent_read_cb = mock()
+    
+    expect( sock._sock.gettimeout ).returns( 0.0 )
+    expect( sock._sock.recv ).args( 4 ).returns( 'abcd' )
+    expect( sock._sock.recv ).args( 4 ).returns( '' )
+    expect( sock._sock.close )
+    expect( sock._parent_read_cb ).args( sock )
+    
+    assert_equals( None, sock._read_cb() )
+    assert_true( sock.closed )
+
+  def test_read_cb_when_debugging_and_parent_cb_and_no_pending_event(self):
+    sock = EventSocket()
+    sock._sock = mock()
+    sock._logger = mock()
+    sock._peername = 'peername'
+    sock._debug = True
+    sock._parent_read_cb = 'p_read_cb'
+    mock( sock, 'getsockopt' )
+    
+    expect( sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_RCVBUF ).returns( 42 )
+    expect( sock._sock.recv ).args( 42 ).returns( 'sumdata' )
+    expect( sock._logger.debug ).args( 'read 7 bytes from peername' )
+    expect( sock._flag_activity )
+    expect( eventsocket.event.timeout ).args( 0, sock._protected_cb, sock._parent_read_timer_cb ).returns('pending_read')
+    
+    assert_true( sock._read_cb() )
+    assert_equals( bytearray('sumdata'), sock._read_buf.detach() )
+    assert_equals( 'pending_read', sock._pending_read_cb_event )
+  
+  def test_read_cb_when_sync_read(self):
+    sock = EventSocket( sync_read=True )
+    sock._sock = mock()
+    sock._parent_read_cb = mock()
+    mock( sock, 'getsockopt' )
+    
+    expect( sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_RCVBUF ).returns( 42 )
+    expect( sock._sock.recv ).args( 42 ).returns( 'sumdata' )
+    expect( sock._parent_read_cb ).args( sock ).side_effect(
+      lambda: assert_equals(bytearray('sumdata'), sock.read()) )
+    expect( sock._handle_error ).times( 0 )
+    
+    assert_true( sock._read_cb() )
+    assert_equals( None, sock._pending_read_cb_event )
+    assert_equals( 'error reading from socket', sock._error_msg )
+
+  def test_read_cb_when_sync_read_and_read_cb_raises(self):
+    sock = EventSocket( sync_read=True )
+    sock._sock = mock()
+    sock._parent_read_cb = mock()
+    mock( sock, 'getsockopt' )
+    exc = RuntimeError('fale')
+    
+    expect( sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_RCVBUF ).returns( 42 )
+    expect( sock._sock.recv ).args( 42 ).returns( 'sumdata' )
+    expect( sock._parent_read_cb ).args( sock ).raises( exc )
+    expect( sock._handle_error ).args( exc )
+    
+    assert_true( sock._read_cb() )
+
+  def test_read_cb_when_sync_read_and_read_cb_closes(self):
+    sock = EventSocket( sync_read=True )
+    sock._sock = mock()
+    sock._parent_read_cb = mock()
+    mock( sock, 'getsockopt' )
+    
+    expect( sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_RCVBUF ).returns( 42 )
+    expect( sock._sock.recv ).args( 42 ).returns( 'sumdata' )
+    expect( sock._parent_read_cb ).args( sock ).side_effect(
+      lambda: setattr(sock, '_closed', True) )
+    
+    assert_equals( None, sock._read_cb() )
+
+  def test_read_cb_when_parent_cb_and_is_a_pending_event_and_already_buffered_data(self):
+    sock = EventSocket()
+    sock._read_buf.extend( 'foo' )
+    sock._sock = mock()
+    sock._peername = 'peername'
+    sock._parent_read_cb = 'p_read_cb'
+    sock._pending_read_cb_event = 'pending_read'
+    mock( sock, 'getsockopt' )
+    
+    expect( sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_RCVBUF ).returns( 42 )
+    expect( sock._sock.recv ).args( 42 ).returns( 'sumdata' )
+    expect( sock._flag_activity )
+    
+    assert_true( sock._read_cb() )
+    assert_equals( bytearray('foosumdata'), sock._read_buf.detach() )
+
+  def test_read_cb_when_buffer_overflow(self):
+    sock = EventSocket()
+    sock._sock = mock()
+    sock._logger = mock()
+    sock._peername = 'peername'
+    sock._debug = True
+    sock._max_read_buffer = 5
+    mock( sock, 'getsockopt' )
+    mock( sock, 'close' )
+    
+    expect( sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_RCVBUF ).returns( 42 )
+    expect( sock._sock.recv ).args( 42 ).returns( 'sumdata' )
+    expect( sock._logger.debug ).args( 'read 7 bytes from peername' )
+    expect( sock._flag_activity )
+    expect( sock._logger.debug ).args( 'buffer for peername overflowed!' )
+    expect( sock.close )
+    
+    assert_equals( None, sock._read_cb() )
+    assert_equals( 0, len(sock._read_buf) )
+
+  def test_read_cb_with_recv_into(self):
+    sock = EventSocket( recv_into=True )
+    sock._sock = mock()
+    sock._read_buf = mock()
+    mock( sock, 'getsockopt' )
+
+    expect( sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_RCVBUF ).returns( 42 )
+    expect( sock._read_buf.recv_into ).args( sock._sock, 42 ).returns( 7 )
+    expect( sock._flag_activity )
+
+    assert_true( sock._read_cb() )
+
+  def test_read_cb_with_recv_into_when_no_data(self):
+    sock = EventSocket( recv_into=True )
+    sock._sock = mock()
+    sock._read_buf = mock()
+    mock( sock, 'getsockopt' )
+    mock( sock, 'close' )
+
+    expect( sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_RCVBUF ).returns( 42 )
+    expect( sock._read_buf.recv_into ).args( sock._sock, 42 ).returns( 0 )
+    expect( sock.close )
+
+    assert_equals( None, sock._read_cb() )
+
+  def test_read_cb_when_read_high_water_reached(self):
+    sock = EventSocket( read_high_water=10 )
+    sock._sock = mock()
+    sock._read_buf.extend( 'foo' )
+    mock( sock, 'getsockopt' )
+    mock( sock, 'close' )  # assert not called
+
+    expect( sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_RCVBUF ).returns( 42 )
+    expect( sock._sock.recv ).args( 42 ).returns( 'sumdata' )
+    expect( sock._flag_activity )
+
+    assert_equals( None, sock._read_cb() )
+    assert_true( sock.reading_paused )
+    assert_equals( bytearray('foosumdata'), sock._read_buf.detach() )
+
+  def test_read_cb_when_reading_paused(self):
+    sock = EventSocket()
+    sock._sock = mock()
+    sock._read_paused = True
+    mock( sock, 'getsockopt' )
+
+    expect( sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_RCVBUF ).returns( 42 )
+    expect( sock._sock.recv ).args( 42 ).returns( 'sumdata' )
+    expect( sock._flag_activity )
+
+    assert_equals( None, sock._read_cb() )
+
+  def test_read_cb_when_no_data(self):
+    sock = EventSocket()
+    sock._sock = mock()
+    mock( sock, 'getsockopt' )
+    mock( sock, 'close' )
+    
+    expect( sock.getsockopt ).args( socket.SOL_SOCKET, socket.SO_RCVBUF ).returns( 42 )
+    expect( sock._sock.recv ).args( 42 ).returns( '' )
+    expect( sock.close )
+    
+    assert_equals( None, sock._read_cb() )
+
+  def test_parent_read_timer_cb(self):
+    sock = EventSocket()
+    sock._pending_read_cb_event = 'foo'
+    sock._parent_read_cb = mock()
+    expect( sock._parent_read_cb ).args( sock )
+
+    sock._parent_read_timer_cb()
+    assert_equals( 'error processing socket input buffer', sock._error_msg )
+    assert_equals( None, sock._pending_read_cb_event )
+
+  def test_parent_read_timer_cb_records_latency(self):
+    sock = EventSocket( stats=2 )
+    sock._parent_read_cb = mock()
+    expect( sock._parent_read_cb ).args( sock )
+    expect( eventsocket.time.time ).returns( 10.0 )
+    expect( eventsocket.time.time ).returns( 10.25 )
+
+    sock._parent_read_timer_cb()
+    for stats in (sock.stats, eventsocket.global_stats):
+      assert_equals( 1, stats.read_cb_latency.count )
+      assert_equals( 0.25, stats.read_cb_latency.max )
+
+  def test_parent_read_timer_cb_with_message_cb(self):
+    framing = eventsocket.DelimiterFraming( '\n' )
+    sock = EventSocket( framing=framing, read_high_water=8 )
+    sock._read_buf.extend( 'foo\nbar\nbaz' )
+    sock._read_buf_full = True
+    sock._parent_message_cb = mock()
+    frames = []
+
+    expect( sock._parent_message_cb ).args( sock, is_a(memoryview) ).side_effect(
+      lambda: frames.append(sock._read_buf._buf[sock._read_buf._start-4:sock._read_buf._start-1]) ).times( 2 )
+    expect( sock._update_read_event )
+
+    sock._parent_read_timer_cb()
+    assert_equals( [bytearray('foo'), bytearray('bar')], frames )
+    assert_equals( 3, len(sock._read_buf) )
+    assert_false( sock._read_buf_full )
+
+  def test_dispatch_messages_when_invalid_framing(self):
+    framing = eventsocket.LengthPrefixFraming( 1, max_length=2 )
+    sock = EventSocket( framing=framing )
+    sock._read_buf.extend( '\x01a\x03abc' )
+    sock._parent_message_cb = mock()
+    mock( sock, 'close' )
+
+    expect( sock._parent_message_cb ).args( sock, is_a(memoryview) )
+    expect( sock._handle_error ).args( is_a(ValueError) )
+    expect( sock.close )
+
+    sock._dispatch_messages( sock._parent_message_cb )
+    assert_equals( 'invalid message framing', sock._error_msg )
+    assert_equals( 'framing', sock._close_reason )
+    assert_equals( 0, len(sock._read_buf) )
+
+  def test_dispatch_messages_when_cb_closes(self):
+    framing = eventsocket.DelimiterFraming( '\n' )
+    sock = EventSocket( framing=framing )
+    sock._sock = mock()
+    sock._read_buf.extend( 'foo\nbar\n' )
+    frames = []
+    def message_cb(s, frame):
+      frames.append( frame.tobytes() )
+      s.close()
+    sock._parent_message_cb = message_cb
+
+    expect( sock._sock.close )
+
+    sock._parent_read_timer_cb()
+    assert_equals( ['foo','bar'], frames )
+    assert_true( sock.closed )
+
+  def test_message_cb_property(self):
+    sock = EventSocket()
+    sock._read_buf.extend( 'foo' )
+    expect( eventsocket.event.timeout ).args( 0, sock._protected_cb, sock._parent_read_timer_cb ).returns( 'pending_read' )
+
+    sock.message_cb = 'p_message_cb'
+    assert_equals( 'p_message_cb', sock._parent_message_cb )
+    assert_equals( 'pending_read', sock._pending_read_cb_event )
+
+  def test_parent_read_timer_cb_when_closed(self):
+    sock = EventSocket()
+    sock._pending_read_cb_event = 'foo'
+    sock._closed = True
+    sock._parent_read_cb = mock()
+
+    sock._parent_read_timer_cb()
+    assert_equals( None, sock._error_msg )
+    assert_equals( 'foo', sock._pending_read_cb_event )
+
+  def test_parent_read_timer_cb_when_read_cb_reset(self):
+    sock = EventSocket()
     sock._pending_read_cb_event = 'foo'
     
     sock._parent_read_timer_cb()
@@ -505,6 +1318,7 @@ class EventSocketTest(Chai):
     sock._sock = mock()
     sock._parent_output_empty_cb = mock()
     sock._write_buf = deque(['data1','data2'])
+    sock._write_buf_bytes = 10
 
     expect( sock._sock.send ).args( 'data1' ).returns( 5 )
     expect( sock._sock.send ).args( 'data2' ).returns( 5 )
@@ -519,13 +1333,16 @@ class EventSocketTest(Chai):
     sock._sock = mock()
     sock._parent_output_empty_cb = mock()  # assert not called
     sock._write_buf = deque(['data1','data2'])
+    sock._write_buf_bytes = 10
 
     expect( sock._sock.send ).args( 'data1' ).returns( 5 )
     expect( sock._sock.send ).args( 'data2' ).returns( 2 )
     expect( sock._flag_activity )
 
     assert_true( sock._write_cb() )
-    assert_equals( deque(['ta2']), sock._write_buf )
+    assert_equals( deque(['data2']), sock._write_buf )
+    assert_equals( 2, sock._write_offset )
+    assert_equals( 3, sock.pending_write_bytes )
 
   def test_write_cb_when_not_all_data_sent_and_logging(self):
     sock = EventSocket()
@@ -535,6 +1352,7 @@ class EventSocketTest(Chai):
     sock._debug = True
     sock._parent_output_empty_cb = mock()  # assert not called
     sock._write_buf = deque(['data1','data2'])
+    sock._write_buf_bytes = 10
 
     expect( sock._sock.send ).args( 'data1' ).returns( 5 )
     expect( sock._sock.send ).args( 'data2' ).returns( 2 )
@@ -542,13 +1360,40 @@ class EventSocketTest(Chai):
     expect( sock._flag_activity )
 
     assert_true( sock._write_cb() )
-    assert_equals( deque(['ta2']), sock._write_buf )
+    assert_equals( deque(['data2']), sock._write_buf )
+    assert_equals( 2, sock._write_offset )
+    assert_equals( 3, sock.pending_write_bytes )
+
+  def test_write_cb_resumes_from_offset(self):
+    sock = EventSocket()
+    sock._sock = mock()
+    sock._write_buf = deque([bytearray('data1'), buffer('xdata2', 1)])
+    sock._write_buf_bytes = 7
+    sock._write_offset = 3
+
+    expect( sock._sock.send ).args( memoryview('a1') ).returns( 2 )
+    expect( sock._sock.send ).args( func(lambda b: str(b)=='data2') ).returns( 4 )
+    expect( sock._flag_activity )
+
+    assert_true( sock._write_cb() )
+    assert_equals( 1, len(sock._write_buf) )
+    assert_equals( 4, sock._write_offset )
+    assert_equals( 1, sock.pending_write_bytes )
+
+    sock._sock = mock()
+    expect( sock._sock.send ).args( func(lambda b: str(b)=='2') ).returns( 1 )
+    expect( sock._flag_activity )
+
+    assert_equals( None, sock._write_cb() )
+    assert_equals( 0, len(sock._write_buf) )
+    assert_equals( 0, sock._write_offset )
 
   def test_write_cb_when_eagain_raised(self):
     sock = EventSocket()
     sock._sock = mock()
     sock._parent_output_empty_cb = mock()  # assert not called
     sock._write_buf = deque(['data1','data2'])
+    sock._write_buf_bytes = 10
 
     expect( sock._sock.send ).args( 'data1' ).raises(
       EnvironmentError(errno.EAGAIN,'try again') )
@@ -557,6 +1402,38 @@ class EventSocketTest(Chai):
     assert_true( sock._write_cb() )
     assert_equals( deque(['data1','data2']), sock._write_buf )
 
+  def test_write_cb_counts_sends(self):
+    sock = EventSocket( stats=1 )
+    sock._sock = mock()
+    sock._write_buf = deque(['data1','data2'])
+    sock._write_buf_bytes = 10
+
+    expect( sock._sock.send ).args( 'data1' ).returns( 5 )
+    expect( sock._sock.send ).args( 'data2' ).returns( 2 )
+
+    assert_true( sock._write_cb() )
+    for stats in (sock.stats, eventsocket.global_stats):
+      assert_equals( 2, stats.send_calls )
+      assert_equals( 7, stats.bytes_out )
+      assert_equals( 1, stats.partial_writes )
+      assert_equals( 0, stats.eagain )
+
+  def test_write_cb_vectored_counts_eagain(self):
+    mock( eventsocket, '_writev' )
+    eventsocket._writev = None
+    sock = EventSocket( stats=1, vectored_writes=True )
+    sock._sock = mock()
+    sock._write_buf = deque(['data1'])
+    sock._write_buf_bytes = 5
+
+    expect( sock._sock.send ).args( 'data1' ).raises(
+      EnvironmentError(errno.EAGAIN,'try again') )
+
+    assert_true( sock._write_cb() )
+    assert_equals( 0, sock.stats.send_calls )
+    assert_equals( 1, sock.stats.eagain )
+    assert_equals( 1, eventsocket.global_stats.eagain )
+
   def test_write_cb_when_eagain_raised_and_logging(self):
     sock = EventSocket()
     sock._sock = mock()
@@ -565,6 +1442,7 @@ class EventSocketTest(Chai):
     sock._debug = True
     sock._parent_output_empty_cb = mock()  # assert not called
     sock._write_buf = deque(['data1','data2'])
+    sock._write_buf_bytes = 10
 
     expect( sock._sock.send ).args( 'data1' ).raises(
       EnvironmentError(errno.EAGAIN,'try again') )
@@ -583,31 +1461,581 @@ class EventSocketTest(Chai):
     sock._debug = True
     sock._parent_output_empty_cb = mock()  # assert not called
     sock._write_buf = deque(['data1','data2'])
+    sock._write_buf_bytes = 10
 
     expect( sock._sock.send ).args( 'data1' ).raises(
       EnvironmentError(errno.ECONNABORTED,'try again') )
 
     assert_raises( EnvironmentError, sock._write_cb )
 
-  def test_inactive_cb(self):
-    sock = EventSocket()
-    expect( sock.close )
-    sock._inactive_cb()
-    assert_equals( "error closing inactive socket", sock._error_msg )
+  def test_write_cb_vectored_coalesces_chunks(self):
+    mock( eventsocket, '_writev' )
+    eventsocket._writev = None
+    sock = EventSocket( vectored_writes=True )
+    sock._sock = mock()
+    sock._parent_output_empty_cb = mock()
+    sock._write_buf = deque(['data1','data2'])
+    sock._write_buf_bytes = 10
 
-  def test_flag_activity(self):
-    sock = EventSocket()
-    sock._inactive_event = mock()
-    sock._inactive_timeout = 42
-    
-    expect( sock._inactive_event.delete )
-    expect( eventsocket.event.timeout ).args( 42, sock._protected_cb, sock._inactive_cb ).returns( 'doitagain' )
+    expect( sock._sock.send ).args( bytearray('data1data2') ).returns( 10 )
+    expect( sock._flag_activity )
+    expect( sock._parent_output_empty_cb ).args( sock )
 
-    sock._flag_activity()
-    assert_equals( 'doitagain', sock._inactive_event )
+    assert_equals( None, sock._write_cb() )
+    assert_equals( 0, len(sock._write_buf) )
+    assert_equals( 0, sock._write_offset )
 
-  def test_write_when_closed(self):
-    sock = EventSocket()
+  def test_write_cb_vectored_tracks_partial_send_by_offset(self):
+    mock( eventsocket, '_writev' )
+    eventsocket._writev = None
+    sock = EventSocket( vectored_writes=True )
+    sock._sock = mock()
+    sock._parent_output_empty_cb = mock()  # assert not called
+    sock._write_buf = deque(['data1','data2','data3'])
+    sock._write_buf_bytes = 15
+
+    expect( sock._sock.send ).args( bytearray('data1data2data3') ).returns( 7 )
+    expect( sock._flag_activity )
+
+    assert_true( sock._write_cb() )
+    assert_equals( deque(['data2','data3']), sock._write_buf )
+    assert_equals( 2, sock._write_offset )
+    assert_equals( 8, sock.pending_write_bytes )
+
+    expect( sock._sock.send ).args( bytearray('ta2data3') ).returns( 3 )
+    expect( sock._flag_activity )
+
+    assert_true( sock._write_cb() )
+    assert_equals( deque(['data3']), sock._write_buf )
+    assert_equals( 0, sock._write_offset )
+
+  def test_write_cb_vectored_sends_single_chunk_from_offset(self):
+    mock( eventsocket, '_writev' )
+    eventsocket._writev = None
+    sock = EventSocket( vectored_writes=True )
+    sock._sock = mock()
+    sock._write_buf = deque(['data1'])
+    sock._write_buf_bytes = 5
+    sock._write_offset = 3
+
+    expect( sock._sock.send ).args( 'a1' ).returns( 2 )
+    expect( sock._flag_activity )
+
+    assert_equals( None, sock._write_cb() )
+    assert_equals( 0, len(sock._write_buf) )
+    assert_equals( 0, sock._write_offset )
+
+  def test_write_cb_vectored_sends_large_chunk_by_itself(self):
+    mock( eventsocket, '_writev' )
+    eventsocket._writev = None
+    sock = EventSocket( vectored_writes=True )
+    sock._sock = mock()
+    body = 'x'*eventsocket.COALESCE_WRITE_SIZE
+    sock._write_buf = deque(['head', body])
+    sock._write_buf_bytes = 4+len(body)
+
+    expect( sock._sock.send ).args( 'head' ).returns( 4 )
+    expect( sock._sock.send ).args( body ).returns( 10 )
+    expect( sock._flag_activity )
+
+    assert_true( sock._write_cb() )
+    assert_equals( deque([body]), sock._write_buf )
+    assert_equals( 10, sock._write_offset )
+
+  def test_write_cb_vectored_with_writev(self):
+    mock( eventsocket, '_writev' )
+    sock = EventSocket( vectored_writes=True )
+    sock._sock = mock()
+    sock._write_buf = deque(['data1','data2'])
+    sock._write_buf_bytes = 10
+    sock._write_offset = 1
+
+    expect( sock._sock.fileno ).returns( 3 )
+    expect( eventsocket._writev ).args( 3, ['data1','data2'], 1 ).returns( 6 )
+    expect( sock._flag_activity )
+
+    assert_true( sock._write_cb() )
+    assert_equals( deque(['data2']), sock._write_buf )
+    assert_equals( 2, sock._write_offset )
+
+  def test_write_cb_vectored_writev_stops_at_file_segment(self):
+    mock( eventsocket, '_writev' )
+    sock = EventSocket( vectored_writes=True )
+    sock._sock = mock()
+    seg = eventsocket.FileSegment( 'file', 0, 10 )
+    sock._write_buf = deque(['data1', seg])
+    sock._write_buf_bytes = 15
+
+    expect( sock._sock.fileno ).returns( 3 )
+    expect( eventsocket._writev ).args( 3, ['data1'], 0 ).returns( 5 )
+    expect( seg.send ).args( sock._sock ).side_effect(
+      lambda: setattr(seg, 'count', 6) ).returns( 4 )
+
+    assert_true( sock._write_cb() )
+    assert_equals( deque([seg]), sock._write_buf )
+    assert_equals( 6, sock.pending_write_bytes )
+
+  def test_write_cb_vectored_when_eagain_raised(self):
+    mock( eventsocket, '_writev' )
+    eventsocket._writev = None
+    sock = EventSocket( vectored_writes=True )
+    sock._sock = mock()
+    sock._write_buf = deque(['data1','data2'])
+    sock._write_buf_bytes = 10
+
+    expect( sock._sock.send ).args( bytearray('data1data2') ).raises(
+      EnvironmentError(errno.EAGAIN,'try again') )
+    expect( sock._flag_activity )
+
+    assert_true( sock._write_cb() )
+    assert_equals( deque(['data1','data2']), sock._write_buf )
+    assert_equals( 0, sock._write_offset )
+
+  def test_write_cb_with_file_segment(self):
+    sock = EventSocket()
+    sock._sock = mock()
+    seg = eventsocket.FileSegment( 'file', 0, 10 )
+    sock._write_buf = deque(['data1', seg, 'data2'])
+    sock._write_buf_bytes = 20
+
+    expect( sock._sock.send ).args( 'data1' ).returns( 5 )
+    expect( seg.send ).args( sock._sock ).side_effect(
+      lambda: setattr(seg, 'count', 6) ).returns( 4 )
+
+    assert_true( sock._write_cb() )
+    assert_equals( deque([seg, 'data2']), sock._write_buf )
+    assert_equals( 11, sock.pending_write_bytes )
+
+  def test_write_cb_vectored_sends_file_segment_on_its_own(self):
+    mock( eventsocket, '_writev' )
+    eventsocket._writev = None
+    sock = EventSocket( vectored_writes=True )
+    sock._sock = mock()
+    seg = eventsocket.FileSegment( 'file', 0, 10 )
+    sock._write_buf = deque(['data1', 'data2', seg, 'data3'])
+    sock._write_buf_bytes = 25
+
+    expect( sock._sock.send ).args( bytearray('data1data2') ).returns( 10 )
+    expect( seg.send ).args( sock._sock ).side_effect(
+      lambda: setattr(seg, 'count', 0) ).returns( 10 )
+    expect( sock._sock.send ).args( 'data3' ).returns( 2 )
+
+    assert_true( sock._write_cb() )
+    assert_equals( deque(['data3']), sock._write_buf )
+    assert_equals( 2, sock._write_offset )
+    assert_equals( 3, sock.pending_write_bytes )
+
+  def test_write_cb_vectored_when_file_segment_partly_sent(self):
+    sock = EventSocket( vectored_writes=True )
+    sock._sock = mock()
+    seg = eventsocket.FileSegment( 'file', 0, 10 )
+    sock._write_buf = deque([seg, 'data3'])
+    sock._write_buf_bytes = 15
+
+    expect( seg.send ).args( sock._sock ).side_effect(
+      lambda: setattr(seg, 'count', 6) ).returns( 4 )
+
+    assert_true( sock._write_cb() )
+    assert_equals( deque([seg, 'data3']), sock._write_buf )
+    assert_equals( 0, sock._write_offset )
+    assert_equals( 11, sock.pending_write_bytes )
+
+  def test_write_file(self):
+    sock = EventSocket()
+    fileobj = mock()
+    expect( fileobj.fileno ).returns( 42 )
+    expect( sock.write ).args( is_a(eventsocket.FileSegment) )
+
+    sock.write_file( fileobj, 5, 10 )
+
+  def test_write_file_to_end_of_file(self):
+    sock = EventSocket()
+    tmp = tempfile.TemporaryFile()
+    tmp.write( 'x'*100 )
+    tmp.flush()
+
+    sock.write_file( tmp, 40 )
+    seg = sock._write_buf[0]
+    assert_true( isinstance(seg, eventsocket.FileSegment) )
+    assert_equals( (tmp, 40, 60), (seg.fileobj, seg.offset, seg.count) )
+    assert_equals( 60, sock.pending_write_bytes )
+
+    sock.write_file( tmp, 100 )
+    assert_equals( 1, len(sock._write_buf) )
+
+  def test_write_file_without_fileno(self):
+    sock = EventSocket()
+    fileobj = io.BytesIO( 'foobarbaz' )
+
+    sock.write_file( fileobj, 3, 3 )
+    sock.write_file( fileobj, 6 )
+    assert_equals( deque(['bar', 'baz']), sock._write_buf )
+
+  def test_write_file_when_closed(self):
+    sock = EventSocket()
+    sock._closed = True
+    assert_raises( socket.error, sock.write_file, 'file' )
+
+  def test_splice(self):
+    a = EventSocket()
+    b = EventSocket()
+    a._read_buf.extend( 'foo' )
+    mock( a, 'setblocking' )
+    mock( b, 'setblocking' )
+    expect( a.setblocking ).args( False )
+    expect( b.setblocking ).args( False )
+
+    a.splice( b, pipe_size=1024*1024 )
+    assert_true( a._splice_peer is b )
+    assert_true( b._splice_peer is a )
+    assert_true( a._splice_out is b._splice_in )
+    assert_true( b._splice_out is a._splice_in )
+    assert_true( a._splice_out.source is a )
+    assert_true( a._splice_out.dest is b )
+    assert_equals( 0, len(a._read_buf) )
+    assert_equals( deque(['foo']), b._write_buf )
+    a._splice_out.close()
+    b._splice_out.close()
+
+  def test_os_splice_passes_flags_by_name(self):
+    calls = []
+    mock( os, 'splice' )
+    os.splice = lambda *args, **kwargs: calls.append( (args,kwargs) ) or 20
+
+    splice = eventsocket._os_splice()
+    assert_equals( 20, splice(7, 9, 90, 3) )
+    assert_equals( [((7,9,90), {'flags':3})], calls )
+
+  def test_splice_when_not_supported(self):
+    mock( eventsocket, '_splice' )
+    eventsocket._splice = None
+    try:
+      EventSocket().splice( EventSocket() )
+      assert_true( False )
+    except socket.error, e:
+      assert_equals( errno.ENOSYS, e.errno )
+
+  def test_splice_when_closed(self):
+    sock = EventSocket()
+    sock._closed = True
+    assert_raises( socket.error, sock.splice, EventSocket() )
+
+  def test_read_cb_when_spliced(self):
+    sock = EventSocket()
+    sock._splice_out = 'pipe'
+    expect( sock._splice_read ).returns( 'rval' )
+    assert_equals( 'rval', sock._read_cb() )
+
+  def test_splice_read(self):
+    mock( eventsocket, '_splice' )
+    sock = EventSocket()
+    sock._sock = mock()
+    dest = mock()
+    pipe = mock()
+    pipe.write_fd = 9
+    pipe.capacity = 100
+    pipe.pending = 10
+    pipe.dest = dest
+    sock._splice_out = pipe
+
+    expect( sock._sock.fileno ).returns( 7 )
+    expect( eventsocket._splice ).args( 7, 9, 90, 3 ).returns( 20 )
+    expect( sock._flag_activity )
+    expect( dest._schedule_write )
+
+    assert_true( sock._read_cb() )
+    assert_equals( 30, pipe.pending )
+
+  def test_splice_read_when_pipe_fills(self):
+    mock( eventsocket, '_splice' )
+    sock = EventSocket()
+    sock._sock = mock()
+    sock._read_event = mock()
+    pipe = mock()
+    pipe.write_fd = 9
+    pipe.capacity = 100
+    pipe.pending = 10
+    pipe.dest = mock()
+    sock._splice_out = pipe
+
+    expect( sock._sock.fileno ).returns( 7 )
+    expect( eventsocket._splice ).args( 7, 9, 90, 3 ).returns( 90 )
+    expect( pipe.dest._schedule_write )
+    expect( sock._read_event.delete )
+
+    assert_equals( None, sock._splice_read() )
+    assert_true( sock._throttled )
+
+  def test_splice_read_when_eof(self):
+    mock( eventsocket, '_splice' )
+    sock = EventSocket()
+    sock._sock = mock()
+    pipe = mock()
+    pipe.write_fd = 9
+    pipe.capacity = 100
+    pipe.pending = 0
+    pipe.dest = mock()
+    sock._splice_out = pipe
+
+    expect( sock._sock.fileno ).returns( 7 )
+    expect( eventsocket._splice ).args( 7, 9, 100, 3 ).returns( 0 )
+    expect( pipe.dest._splice_shutdown )
+
+    assert_equals( None, sock._splice_read() )
+    assert_true( pipe.eof )
+
+  def test_splice_read_when_eof_and_pipe_not_empty(self):
+    mock( eventsocket, '_splice' )
+    sock = EventSocket()
+    sock._sock = mock()
+    pipe = mock()
+    pipe.write_fd = 9
+    pipe.capacity = 100
+    pipe.pending = 10
+    pipe.dest = mock()  # assert not shut down
+    sock._splice_out = pipe
+
+    expect( sock._sock.fileno ).returns( 7 )
+    expect( eventsocket._splice ).args( 7, 9, 90, 3 ).returns( 0 )
+
+    assert_equals( None, sock._splice_read() )
+    assert_true( pipe.eof )
+
+  def test_splice_read_when_eagain(self):
+    mock( eventsocket, '_splice' )
+    sock = EventSocket()
+    sock._sock = mock()
+    pipe = mock()
+    pipe.write_fd = 9
+    pipe.capacity = 100
+    pipe.pending = 0
+    sock._splice_out = pipe
+
+    expect( sock._sock.fileno ).returns( 7 )
+    expect( eventsocket._splice ).any_args().raises( OSError(errno.EAGAIN, 'try again') )
+
+    assert_true( sock._splice_read() )
+
+  def test_splice_read_when_error(self):
+    mock( eventsocket, '_splice' )
+    sock = EventSocket()
+    sock._sock = mock()
+    pipe = mock()
+    pipe.write_fd = 9
+    pipe.capacity = 100
+    pipe.pending = 0
+    sock._splice_out = pipe
+    exc = OSError(errno.ECONNRESET, 'reset')
+
+    expect( sock._sock.fileno ).returns( 7 )
+    expect( eventsocket._splice ).any_args().raises( exc )
+    expect( sock._handle_error ).args( exc )
+    expect( sock.close )
+
+    assert_equals( None, sock._splice_read() )
+
+  def test_write_cb_when_spliced(self):
+    sock = EventSocket()
+    sock._splice_in = 'pipe'
+    expect( sock._splice_write ).returns( 'rval' )
+    assert_equals( 'rval', sock._write_cb() )
+
+  def test_write_cb_when_spliced_sends_write_buffer_first(self):
+    sock = EventSocket()
+    sock._sock = mock()
+    sock._splice_in = mock()
+    sock._splice_in.pending = 10
+    sock._write_buf = deque(['foo'])
+    sock._write_buf_bytes = 3
+
+    expect( sock._sock.send ).args( 'foo' ).returns( 3 )
+
+    assert_true( sock._write_cb() )
+
+  def test_splice_write(self):
+    mock( eventsocket, '_splice' )
+    sock = EventSocket()
+    sock._sock = mock()
+    pipe = mock()
+    pipe.read_fd = 8
+    pipe.capacity = 100
+    pipe.pending = 100
+    pipe.eof = False
+    pipe.source = mock()
+    pipe.source._throttled = True
+    sock._splice_in = pipe
+
+    expect( sock._sock.fileno ).returns( 7 )
+    expect( eventsocket._splice ).args( 8, 7, 100, 3 ).returns( 60 )
+    expect( sock._flag_activity )
+    expect( pipe.source._set_throttled ).args( False )
+
+    assert_true( sock._splice_write() )
+    assert_equals( 40, pipe.pending )
+
+  def test_splice_write_drains_pipe_after_eof(self):
+    mock( eventsocket, '_splice' )
+    sock = EventSocket()
+    sock._sock = mock()
+    pipe = mock()
+    pipe.read_fd = 8
+    pipe.capacity = 100
+    pipe.pending = 40
+    pipe.eof = True
+    pipe.source = mock()
+    pipe.source._throttled = False
+    sock._splice_in = pipe
+
+    expect( sock._sock.fileno ).returns( 7 )
+    expect( eventsocket._splice ).args( 8, 7, 40, 3 ).returns( 40 )
+    expect( sock._splice_shutdown )
+
+    assert_equals( None, sock._splice_write() )
+
+  def test_splice_write_when_pipe_empty(self):
+    sock = EventSocket()
+    sock._splice_in = mock()
+    sock._splice_in.pending = 0
+    assert_equals( None, sock._splice_write() )
+
+  def test_splice_write_when_eagain(self):
+    mock( eventsocket, '_splice' )
+    sock = EventSocket()
+    sock._sock = mock()
+    pipe = mock()
+    pipe.read_fd = 8
+    pipe.pending = 40
+    sock._splice_in = pipe
+
+    expect( sock._sock.fileno ).returns( 7 )
+    expect( eventsocket._splice ).any_args().raises( OSError(errno.EAGAIN, 'try again') )
+
+    assert_true( sock._splice_write() )
+    assert_equals( 40, pipe.pending )
+
+  def test_splice_shutdown(self):
+    sock = EventSocket()
+    sock._sock = mock()
+    sock._splice_in = mock()
+    sock._splice_out = mock()
+    sock._splice_out.done = False
+
+    expect( sock._sock.shutdown ).args( socket.SHUT_WR )
+
+    sock._splice_shutdown()
+    assert_true( sock._splice_in.done )
+
+  def test_splice_shutdown_when_both_done(self):
+    sock = EventSocket()
+    sock._sock = mock()
+    sock._splice_in = mock()
+    sock._splice_out = mock()
+    sock._splice_out.done = True
+
+    expect( sock._sock.shutdown ).args( socket.SHUT_WR ).raises( socket.error )
+    expect( sock.close )
+
+    sock._splice_shutdown()
+    assert_equals( 'eof', sock._close_reason )
+
+  def test_close_when_spliced(self):
+    a = EventSocket()
+    b = EventSocket()
+    mock( a, 'setblocking' )
+    mock( b, 'setblocking' )
+    expect( a.setblocking ).args( False )
+    expect( b.setblocking ).args( False )
+    a.splice( b )
+    pipes = ( a._splice_out, b._splice_out )
+
+    a._close_reason = 'eof'
+    a.close()
+    assert_true( b.closed )
+    assert_equals( 'eof', b._close_reason )
+    for sock in (a, b):
+      assert_equals( None, sock._splice_peer )
+      assert_equals( None, sock._splice_out )
+      assert_equals( None, sock._splice_in )
+    for pipe in pipes:
+      assert_equals( None, pipe.read_fd )
+
+  def test_write_cb_resumes_writes_at_low_water(self):
+    sock = EventSocket( write_low_water=3 )
+    sock._sock = mock()
+    sock._parent_write_resumed_cb = mock()
+    sock._throttled_sock = mock()
+    sock._write_paused = True
+    sock._write_buf = deque(['data1','data2'])
+    sock._write_buf_bytes = 10
+
+    expect( sock._sock.send ).args( 'data1' ).returns( 5 )
+    expect( sock._sock.send ).args( 'data2' ).returns( 2 )
+    expect( sock._throttled_sock._set_throttled ).args( False )
+    expect( sock._parent_write_resumed_cb ).args( sock )
+    expect( sock._flag_activity )
+
+    assert_true( sock._write_cb() )
+    assert_false( sock.write_paused )
+
+  def test_write_cb_when_write_resumed_cb_closes(self):
+    sock = EventSocket( write_low_water=3 )
+    sock._sock = mock()
+    sock._write_paused = True
+    sock._write_buf = deque(['data1','data2'])
+    sock._write_buf_bytes = 10
+    sock._parent_write_resumed_cb = lambda s: s.close()
+
+    expect( sock._sock.send ).args( 'data1' ).returns( 5 )
+    expect( sock._sock.send ).args( 'data2' ).returns( 5 )
+    expect( sock._sock.close )
+    expect( sock._flag_activity ).times( 0 )
+
+    assert_equals( None, sock._write_cb() )
+    assert_true( sock.closed )
+
+  def test_write_cb_stays_paused_above_low_water(self):
+    sock = EventSocket( write_low_water=2 )
+    sock._sock = mock()
+    sock._parent_write_resumed_cb = mock() # assert not called
+    sock._write_paused = True
+    sock._write_buf = deque(['data1','data2'])
+    sock._write_buf_bytes = 10
+
+    expect( sock._sock.send ).args( 'data1' ).returns( 5 )
+    expect( sock._sock.send ).args( 'data2' ).returns( 2 )
+    expect( sock._flag_activity )
+
+    assert_true( sock._write_cb() )
+    assert_true( sock.write_paused )
+
+  def test_inactive_cb(self):
+    sock = EventSocket()
+    expect( sock.close )
+    sock._inactive_cb()
+    assert_equals( "error closing inactive socket", sock._error_msg )
+    assert_equals( 'inactive', sock._close_reason )
+
+  def test_flag_activity(self):
+    sock = EventSocket()
+    sock._inactive_event = mock()
+    sock._inactive_timeout = 42
+    
+    expect( sock._inactive_event.delete )
+    expect( eventsocket.event.timeout ).args( 42, sock._protected_cb, sock._inactive_cb ).returns( 'doitagain' )
+
+    sock._flag_activity()
+    assert_equals( 'doitagain', sock._inactive_event )
+
+  def test_flag_activity_with_timer_wheel(self):
+    sock = EventSocket()
+    sock._timer_wheel = mock()
+    sock._timer_wheel.now = 1234.5
+
+    sock._flag_activity()
+    assert_equals( 1234.5, sock._last_activity )
+
+  def test_write_when_closed(self):
+    sock = EventSocket()
     sock._closed = True
 
     assert_raises( socket.error, sock.read )
@@ -623,11 +2051,25 @@ class EventSocketTest(Chai):
     sock.write( 'foo' )
     assert_equals( deque(['foo']), sock._write_buf )
 
+  def test_write_queues_buffers_without_copying(self):
+    sock = EventSocket()
+    data = [ bytearray('foo'), memoryview('bar'), buffer('catdog', 3) ]
+
+    expect( sock._flag_activity ).times( 3 )
+
+    for d in data:
+      sock.write( d )
+    assert_equals( data, [c for c in sock._write_buf] )
+    for queued,d in zip(sock._write_buf, data):
+      assert_true( queued is d )
+    assert_equals( 9, sock.pending_write_bytes )
+
   def test_write_when_write_event_is_pending_and_debugging(self):
     sock = EventSocket()
     sock._write_event = mock()
     sock._peername = 'peername'
     sock._write_buf = deque(['data'])
+    sock._write_buf_bytes = 4
     sock._debug = 2
     sock._logger = mock()
     
@@ -638,6 +2080,170 @@ class EventSocketTest(Chai):
     sock.write( 'foo' )
     assert_equals( deque(['data', 'foo']), sock._write_buf )
 
+  def test_write_counts_buffer_high_water(self):
+    sock = EventSocket( stats=1 )
+    sock.write( 'foo' )
+    sock.write( 'bar' )
+    sock._write_buf_bytes = 0
+    sock.write( 'foo' )
+    assert_equals( 6, sock.stats.write_buf_high )
+    assert_equals( 6, eventsocket.global_stats.write_buf_high )
+
+  def test_cork_coalesces_small_writes(self):
+    sock = EventSocket()
+    sock._sock = mock()
+    sock._write_event = mock()
+    big = 'x'*eventsocket.COALESCE_WRITE_SIZE
+
+    expect( sock._sock.setsockopt ).args(
+      socket.IPPROTO_TCP, eventsocket.TCP_CORK, 1 )
+    expect( sock._flag_activity ).times( 5 )
+    expect( sock._write_event.pending ).returns( False )
+    expect( sock._write_event.add )
+
+    sock.cork()
+    sock.write( 'foo' )
+    sock.write( bytearray('bar') )
+    sock.cork()
+    sock.write( big )
+    sock.write( 'cat' )
+    sock.uncork()
+    sock.write( 'dog' )
+    assert_equals( deque(['foobar', big, 'catdog']), sock._write_buf )
+    assert_true( sock._write_buf[0] is not sock._write_buf[1] )
+    assert_equals( len(big)+12, sock.pending_write_bytes )
+    assert_true( sock._tcp_corked )
+
+    sock.uncork()
+    assert_equals( None, sock._cork_buf )
+    sock.uncork()
+
+  def test_cork_write_after_cork_buffer_was_sent(self):
+    sock = EventSocket()
+    sock._sock = mock()
+    sock._cork_depth = 1
+    sock._tcp_corked = True
+    # A pending write event flushed the cork buffer while still corked.
+    sock._cork_buf = bytearray( 'two' )
+
+    expect( sock._flag_activity )
+
+    sock.write( 'three' )
+    assert_equals( deque(['three']), sock._write_buf )
+    assert_true( sock._write_buf[0] is sock._cork_buf )
+
+  def test_batch_uncorks_when_no_data(self):
+    sock = EventSocket()
+    sock._sock = mock()
+
+    expect( sock._sock.setsockopt ).args(
+      socket.IPPROTO_TCP, eventsocket.TCP_CORK, 1 )
+    expect( sock._sock.setsockopt ).args(
+      socket.IPPROTO_TCP, eventsocket.TCP_CORK, 0 )
+
+    with sock.batch() as s:
+      assert_true( s is sock )
+      assert_equals( 1, sock._cork_depth )
+    assert_equals( 0, sock._cork_depth )
+    assert_false( sock._tcp_corked )
+
+  def test_cork_when_not_tcp(self):
+    sock = EventSocket()
+    sock._sock = mock()
+
+    expect( sock._sock.setsockopt ).any_args().raises( socket.error )
+
+    sock.cork()
+    assert_false( sock._tcp_corked )
+
+  def test_write_cb_clears_tcp_cork_when_drained(self):
+    sock = EventSocket()
+    sock._sock = mock()
+    sock._write_buf = deque(['data'])
+    sock._write_buf_bytes = 4
+    sock._tcp_corked = True
+
+    expect( sock._sock.send ).args( 'data' ).returns( 4 )
+    expect( sock._flag_activity )
+    expect( sock._sock.setsockopt ).args(
+      socket.IPPROTO_TCP, eventsocket.TCP_CORK, 0 )
+
+    assert_equals( None, sock._write_cb() )
+    assert_false( sock._tcp_corked )
+
+  def test_set_nodelay(self):
+    sock = EventSocket()
+    sock._sock = mock()
+
+    expect( sock._sock.setsockopt ).args(
+      socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+    expect( sock._sock.setsockopt ).args(
+      socket.IPPROTO_TCP, socket.TCP_NODELAY, 0 )
+
+    sock.set_nodelay()
+    sock.set_nodelay( False )
+
+  def test_close_counts_close_reason(self):
+    sock = EventSocket( stats=1 )
+    sock.close()
+    sock.close()
+    assert_equals( {'closed':1}, sock.stats.closes )
+    assert_equals( {'closed':1}, eventsocket.global_stats.closes )
+
+  def test_stats_snapshot(self):
+    sock = EventSocket( stats=1 )
+    sock._peername = 'peer'
+    sock.stats.bytes_in = 42
+    eventsocket.global_stats.bytes_in = 100
+
+    snap = eventsocket.stats_snapshot()
+    assert_equals( 100, snap['bytes_in'] )
+    assert_false( 'sockets' in snap )
+    assert_true( 'read_cb_latency' in snap )
+
+    snap = eventsocket.stats_snapshot( sockets=True )
+    socks = [ s for s in snap['sockets'] if s['peer']=='peer' ]
+    assert_equals( 1, len(socks) )
+    assert_equals( 42, socks[0]['bytes_in'] )
+    assert_false( 'read_cb_latency' in socks[0] )
+
+  def test_write_pauses_writes_above_high_water(self):
+    sock = EventSocket( write_high_water=5 )
+    sock._parent_write_paused_cb = mock()
+    sock._throttled_sock = mock()
+
+    sock.write( 'foo' )
+    assert_false( sock.write_paused )
+
+    expect( sock._throttled_sock._set_throttled ).args( True )
+    expect( sock._parent_write_paused_cb ).args( sock )
+
+    sock.write( 'bar' )
+    assert_true( sock.write_paused )
+
+    # Only notify once
+    sock.write( 'cat' )
+
+  def test_write_counts_pending_bytes_and_chunks(self):
+    sock = EventSocket()
+    sock.write( 'foo' )
+    sock.write( 'data' )
+    assert_equals( 7, sock.pending_write_bytes )
+    assert_equals( 2, sock.pending_write_chunks )
+
+  def test_pending_read_bytes(self):
+    sock = EventSocket()
+    sock._read_buf.extend( 'datas' )
+    assert_equals( 5, sock.pending_read_bytes )
+
+  def test_pending_counts_when_closed(self):
+    sock = EventSocket()
+    sock.write( 'foo' )
+    sock.close()
+    assert_equals( 0, sock.pending_write_bytes )
+    assert_equals( 0, sock.pending_write_chunks )
+    assert_equals( 0, sock.pending_read_bytes )
+
   def test_read_when_closed(self):
     sock = EventSocket()
     sock._closed = True
@@ -646,17 +2252,1518 @@ class EventSocketTest(Chai):
 
   def test_read(self):
     sock = EventSocket()
-    sock._read_buf = bytearray('datas')
+    sock._read_buf.extend( 'datas' )
+    assert_equals( bytearray('datas'), sock.read() )
+    assert_equals( 0, len(sock._read_buf) )
+
+  def test_read_resumes_reading_when_buffer_was_full(self):
+    sock = EventSocket( read_high_water=5 )
+    sock._read_event = mock()
+    sock._read_buf.extend( 'datas' )
+    sock._read_buf_full = True
+
+    expect( sock._read_event.pending ).returns( False )
+    expect( sock._read_event.add )
+
     assert_equals( bytearray('datas'), sock.read() )
-    assert_equals( bytearray(), sock._read_buf )
+    assert_false( sock.reading_paused )
 
   def test_buffer_when_bytearray(self):
     sock = EventSocket()
     sock.buffer( bytearray('foo') )
-    assert_equals( bytearray('foo'), sock._read_buf )
+    assert_equals( bytearray('foo'), sock._read_buf.detach() )
+
+  def test_cursor_api(self):
+    sock = EventSocket( read_high_water=4 )
+    sock._read_buf.extend( 'foo\nbarbaz' )
+    sock._read_buf_full = True
+    expect( sock._update_read_event )
+
+    assert_equals( 'foo', sock.peek(3).tobytes() )
+    assert_equals( 'foo\n', sock.readuntil('\n').tobytes() )
+    assert_equals( None, sock.readuntil('\n') )
+    assert_equals( None, sock.readexactly(7) )
+    assert_true( sock._read_buf_full )
+    assert_equals( 'bar', sock.readexactly(3).tobytes() )
+    assert_false( sock._read_buf_full )
+    sock.consume( 2 )
+    assert_equals( 'z', sock.peek().tobytes() )
+
+  def test_cursor_api_when_closed(self):
+    sock = EventSocket()
+    sock._closed = True
+    assert_raises( socket.error, sock.peek )
+    assert_raises( socket.error, sock.consume, 1 )
+    assert_raises( socket.error, sock.readexactly, 1 )
+    assert_raises( socket.error, sock.readuntil, '\n' )
 
   def test_buffer_when_string(self):
     sock = EventSocket()
-    sock._read_buf = bytearray('data')
+    sock._read_buf.extend( 'data' )
     sock.buffer( 'foo' )
-    assert_equals( bytearray('datafoo'), sock._read_buf )
+    assert_equals( bytearray('datafoo'), sock._read_buf.detach() )
+
+class HistogramTest(Chai):
+
+  def test_add_and_snapshot(self):
+    hist = eventsocket.Histogram()
+    assert_equals( {'count':0, 'mean':0, 'max':0, 'buckets':{}}, hist.snapshot() )
+
+    hist.add( 0.001 )
+    hist.add( 0.0015 )
+    hist.add( 3 )
+    snap = hist.snapshot()
+    assert_equals( 3, snap['count'] )
+    assert_equals( 3, snap['max'] )
+    assert_equals( {2.0**-9:2, 4.0:1}, snap['buckets'] )
+
+class CallbackProfilerTest(Chai):
+
+  def setUp(self):
+    super(CallbackProfilerTest,self).setUp()
+    mock( eventsocket, 'event' )
+
+  def test_call_records_latency_by_name_and_peer(self):
+    prof = eventsocket.CallbackProfiler()
+    sock = EventSocket()
+    sock._peername = 'peer'
+    cb = mock()
+    cb.__name__ = 'cb'
+
+    expect( eventsocket.time.time ).returns( 10.0 )
+    expect( cb ).args( 'arg', kw='foo' ).returns( 'result' )
+    expect( eventsocket.time.time ).returns( 10.05 )
+
+    assert_equals( 'result', prof.call( sock, cb, ('arg',), {'kw':'foo'} ) )
+    snap = prof.snapshot()
+    assert_equals( 1, snap['callbacks']['cb']['count'] )
+    assert_equals( 1, snap['peers']['peer']['count'] )
+    assert_equals( 0, snap['slow_calls'] )
+
+  def test_call_names_read_timer_after_read_cb(self):
+    prof = eventsocket.CallbackProfiler()
+    sock = EventSocket()
+    def handle_request(sock):
+      pass
+    sock._parent_read_cb = handle_request
+
+    prof.call( sock, sock._parent_read_timer_cb, (), {} )
+    assert_equals( ['handle_request'], prof.callbacks.keys() )
+
+  def test_call_doesnt_record_closed_peers(self):
+    prof = eventsocket.CallbackProfiler()
+    sock = EventSocket()
+    sock._closed = True
+
+    prof.call( sock, sock._inactive_cb, (), {} )
+    assert_equals( ['_inactive_cb'], prof.callbacks.keys() )
+    assert_equals( {}, prof.peers )
+
+  def test_record_when_slow(self):
+    slow_cb = mock()
+    prof = eventsocket.CallbackProfiler( slow_threshold=0.5, slow_cb=slow_cb )
+    sock = EventSocket()
+
+    expect( slow_cb ).args( sock, 'cb', 0.75 )
+
+    prof._record( sock, 'cb', 0.25 )
+    prof._record( sock, 'cb', 0.75 )
+    assert_equals( 1, prof.slow_calls )
+    assert_equals( 2, prof.callbacks['cb'].count )
+
+  def test_record_when_slow_and_logging(self):
+    logger = mock()
+    prof = eventsocket.CallbackProfiler( slow_threshold=0.5, logger=logger )
+    sock = EventSocket()
+    sock._peername = 'peer'
+
+    expect( logger.warning ).args( str, 'cb', 'peer', 0.75 )
+
+    prof._record( sock, 'cb', 0.75 )
+    assert_equals( 1, prof.slow_calls )
+
+  def test_forget(self):
+    prof = eventsocket.CallbackProfiler()
+    sock = EventSocket()
+    sock._peername = 'peer'
+    prof._record( sock, 'cb', 0.25 )
+
+    prof.forget( sock )
+    prof.forget( sock )
+    assert_equals( {}, prof.peers )
+
+class SplicePipeTest(Chai):
+
+  def test_init_and_close(self):
+    pipe = eventsocket.SplicePipe( 'source', 'dest' )
+    assert_equals( 'source', pipe.source )
+    assert_equals( 'dest', pipe.dest )
+    assert_true( pipe.capacity>0 )
+    assert_equals( 0, pipe.pending )
+    assert_false( pipe.eof )
+    assert_false( pipe.done )
+    for fd in (pipe.read_fd, pipe.write_fd):
+      assert_true( fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_NONBLOCK )
+      assert_true( fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC )
+
+    fds = (pipe.read_fd, pipe.write_fd)
+    pipe.close()
+    pipe.close()
+    assert_equals( None, pipe.read_fd )
+    assert_raises( OSError, os.fstat, fds[0] )
+
+class ReadBufferTest(Chai):
+
+  def test_extend_and_detach_hands_over_storage(self):
+    buf = eventsocket.ReadBuffer()
+    buf.extend( 'foo' )
+    buf.extend( bytearray('bar') )
+    assert_equals( 6, len(buf) )
+
+    storage = buf._buf
+    rval = buf.detach()
+    assert_true( rval is storage )
+    assert_equals( bytearray('foobar'), rval )
+    assert_equals( 0, len(buf) )
+
+  def test_recv_into_reuses_spare_capacity(self):
+    a, b = socket.socketpair()
+    buf = eventsocket.ReadBuffer()
+
+    a.send( 'hello' )
+    assert_equals( 5, buf.recv_into(b, 64) )
+    assert_equals( 5, len(buf) )
+    assert_equals( 64, len(buf._buf) )
+
+    storage = buf._buf
+    assert_equals( bytearray('hello'), buf.detach() )
+    assert_true( buf._buf is storage )
+
+    a.send( 'world' )
+    assert_equals( 5, buf.recv_into(b, 64) )
+    assert_true( buf._buf is storage )
+    assert_equals( bytearray('world'), buf.detach() )
+    a.close()
+    b.close()
+
+  def test_extend_trims_spare_capacity(self):
+    a, b = socket.socketpair()
+    buf = eventsocket.ReadBuffer()
+
+    a.send( 'hello' )
+    buf.recv_into( b, 64 )
+    buf.extend( ' world' )
+    assert_equals( 11, len(buf._buf) )
+    assert_equals( bytearray('hello world'), buf.detach() )
+    a.close()
+    b.close()
+
+  def test_next_frame_consumes_frames(self):
+    buf = eventsocket.ReadBuffer()
+    framing = eventsocket.DelimiterFraming( '\n' )
+    buf.extend( 'foo\nbar\nba' )
+
+    frame = buf.next_frame( framing )
+    assert_true( isinstance(frame, memoryview) )
+    assert_equals( 'foo', frame.tobytes() )
+    assert_equals( 'bar', buf.next_frame(framing).tobytes() )
+    assert_equals( None, buf.next_frame(framing) )
+    assert_equals( 2, len(buf) )
+    assert_equals( 10, buf._scanned )
+
+    buf.extend( 'z\n' )
+    assert_equals( 'baz', buf.next_frame(framing).tobytes() )
+    assert_equals( 0, len(buf) )
+
+  def test_extend_compacts_consumed_data_lazily(self):
+    buf = eventsocket.ReadBuffer()
+    framing = eventsocket.DelimiterFraming( '\n' )
+    buf.extend( 'a\nbcdef' )
+    buf.next_frame( framing )
+
+    buf.extend( 'g' )
+    assert_equals( 2, buf._start )
+    buf._start = 4
+    buf.extend( 'h' )
+    assert_equals( 0, buf._start )
+    assert_equals( bytearray('defgh'), buf._buf )
+
+  def test_extend_when_frame_still_in_use(self):
+    buf = eventsocket.ReadBuffer()
+    framing = eventsocket.DelimiterFraming( '\n' )
+    buf.extend( 'foo\nbar' )
+    frame = buf.next_frame( framing )
+    storage = buf._buf
+
+    buf.extend( '\n' )
+    assert_false( buf._buf is storage )
+    assert_equals( 'foo', frame.tobytes() )
+    assert_equals( 'bar', buf.next_frame(framing).tobytes() )
+
+  def test_recv_into_when_frame_still_in_use(self):
+    a, b = socket.socketpair()
+    buf = eventsocket.ReadBuffer()
+    framing = eventsocket.DelimiterFraming( '\n' )
+    buf.extend( 'foo\nbar' )
+    frame = buf.next_frame( framing )
+
+    a.send( '\n' )
+    assert_equals( 1, buf.recv_into(b, 64) )
+    assert_equals( 'foo', frame.tobytes() )
+    assert_equals( 'bar', buf.next_frame(framing).tobytes() )
+    a.close()
+    b.close()
+
+  def test_peek_and_consume(self):
+    buf = eventsocket.ReadBuffer()
+    buf.extend( 'foobar' )
+    assert_equals( 'foo', buf.peek(3).tobytes() )
+    assert_equals( 'foobar', buf.peek().tobytes() )
+    assert_equals( 'foobar', buf.peek(10).tobytes() )
+
+    buf.consume( 4 )
+    assert_equals( 'ar', buf.peek().tobytes() )
+    buf.consume( 10 )
+    assert_equals( 0, len(buf) )
+
+  def test_readexactly(self):
+    buf = eventsocket.ReadBuffer()
+    buf.extend( 'foobar' )
+    assert_equals( 'foo', buf.readexactly(3).tobytes() )
+    assert_equals( None, buf.readexactly(4) )
+    assert_equals( 'bar', buf.readexactly(3).tobytes() )
+    assert_equals( 0, len(buf) )
+
+  def test_readuntil(self):
+    buf = eventsocket.ReadBuffer()
+    buf.extend( 'foo\r\nbar\r' )
+    assert_equals( 'foo\r\n', buf.readuntil('\r\n').tobytes() )
+    assert_equals( None, buf.readuntil('\r\n') )
+    assert_equals( 9, buf._scanned )
+
+    buf.extend( '\nbaz' )
+    assert_equals( 'bar\r\n', buf.readuntil('\r\n').tobytes() )
+    assert_equals( 'ba', buf.readuntil('a').tobytes() )
+    assert_equals( 'z', buf.peek().tobytes() )
+
+  def test_readuntil_rescans_for_a_different_sep(self):
+    buf = eventsocket.ReadBuffer()
+    buf.extend( 'foo;bar' )
+    assert_equals( None, buf.readuntil('\n') )
+    assert_equals( 'foo;', buf.readuntil(';').tobytes() )
+
+  def test_next_frame_after_readuntil(self):
+    buf = eventsocket.ReadBuffer()
+    buf.extend( 'foo\nbar' )
+    assert_equals( None, buf.readuntil(';') )
+    framing = eventsocket.DelimiterFraming( '\n' )
+    assert_equals( 'foo', buf.next_frame(framing).tobytes() )
+
+  def test_consuming_is_linear_in_bytes(self):
+    buf = eventsocket.ReadBuffer()
+    for x in xrange(1000):
+      buf.extend( 'abc\n' )
+      buf.extend( 'de' )
+      assert_equals( 'abc\n', buf.readuntil('\n').tobytes() )
+      buf.consume( 2 )
+    # Consumed data is compacted away rather than accumulating
+    assert_true( len(buf._buf) < 16 )
+
+  def test_assign(self):
+    buf = eventsocket.ReadBuffer()
+    buf.extend( 'foo' )
+    data = bytearray('bar')
+    buf.assign( data )
+    assert_equals( 3, len(buf) )
+    assert_true( buf.detach() is data )
+
+class FileSegmentTest(Chai):
+
+  def setUp(self):
+    super(FileSegmentTest,self).setUp()
+    self._file = tempfile.TemporaryFile()
+    self._file.write( ''.join(chr(x%256) for x in xrange(10000)) )
+    self._file.flush()
+
+  def tearDown(self):
+    super(FileSegmentTest,self).tearDown()
+    self._file.close()
+
+  def test_send_with_sendfile(self):
+    mock( eventsocket, '_sendfile' )
+    sock = mock()
+    seg = eventsocket.FileSegment( self._file, 4100, 50 )
+
+    expect( sock.fileno ).returns( 7 )
+    expect( eventsocket._sendfile ).args( 7, self._file.fileno(), 4100, 50 ).returns( 20 )
+
+    assert_equals( 20, seg.send(sock) )
+    assert_equals( 4120, seg.offset )
+    assert_equals( 30, len(seg) )
+
+  def test_send_falls_back_to_mmap(self):
+    mock( eventsocket, '_sendfile' )
+    sock = mock()
+    seg = eventsocket.FileSegment( self._file, 4100, 50 )
+
+    expect( sock.fileno ).returns( 7 )
+    expect( eventsocket._sendfile ).any_args().raises(
+      OSError(errno.EINVAL, 'invalid') )
+    expect( sock.send ).args( buffer(self._file_data(4100, 50)) ).returns( 50 )
+
+    assert_equals( 50, seg.send(sock) )
+    assert_equals( 0, len(seg) )
+    assert_equals( None, seg._map )
+
+  def test_send_with_mmap(self):
+    a, b = socket.socketpair()
+    seg = eventsocket.FileSegment( self._file, 5000, 3000 )
+    seg._use_sendfile = False
+
+    sent = 0
+    while len(seg):
+      sent += seg.send( a )
+    assert_equals( 3000, sent )
+    assert_equals( self._file_data(5000, 3000), b.recv(3000, socket.MSG_WAITALL) )
+    a.close()
+    b.close()
+
+  def test_send_when_sendfile_fails(self):
+    mock( eventsocket, '_sendfile' )
+    sock = mock()
+    seg = eventsocket.FileSegment( self._file, 0, 50 )
+
+    expect( sock.fileno ).returns( 7 )
+    expect( eventsocket._sendfile ).any_args().raises(
+      OSError(errno.EAGAIN, 'try again') )
+
+    assert_raises( OSError, seg.send, sock )
+    assert_equals( 50, len(seg) )
+
+  def test_send_when_file_is_short(self):
+    mock( eventsocket, '_sendfile' )
+    sock = mock()
+    seg = eventsocket.FileSegment( self._file, 9990, 50 )
+
+    expect( sock.fileno ).returns( 7 )
+    expect( eventsocket._sendfile ).any_args().returns( 0 )
+
+    assert_raises( IOError, seg.send, sock )
+
+  def _file_data(self, offset, count):
+    return ''.join( chr(x%256) for x in xrange(offset, offset+count) )
+
+class FramingTest(Chai):
+
+  def _frames(self, framing, data):
+    buf = eventsocket.ReadBuffer()
+    buf.extend( data )
+    rval = []
+    while True:
+      frame = buf.next_frame( framing )
+      if frame is None:
+        return rval, buf.detach()
+      rval.append( frame.tobytes() )
+
+  def test_length_prefix(self):
+    for size,fmt in ((1,'B'), (2,'H'), (4,'I'), (8,'Q')):
+      for order,char in (('big','>'), ('little','<')):
+        framing = eventsocket.LengthPrefixFraming( size, order )
+        data = struct.pack(char+fmt, 3) + 'foo' + struct.pack(char+fmt, 0) + \
+          struct.pack(char+fmt, 3) + 'ba'
+        assert_equals( (['foo',''], bytearray(data[-size-2:])),
+          self._frames(framing, data) )
+        assert_equals( data[:size+3], framing.encode('foo') )
+
+  def test_length_prefix_when_partial_prefix(self):
+    framing = eventsocket.LengthPrefixFraming( 4 )
+    assert_equals( ([], bytearray('\x00\x00')), self._frames(framing, '\x00\x00') )
+
+  def test_length_prefix_when_too_long(self):
+    framing = eventsocket.LengthPrefixFraming( 2, max_length=10 )
+    assert_raises( ValueError, self._frames, framing, '\x00\x0b' )
+
+  def test_length_prefix_invalid_args(self):
+    assert_raises( ValueError, eventsocket.LengthPrefixFraming, 3 )
+    assert_raises( ValueError, eventsocket.LengthPrefixFraming, 4, 'middle' )
+
+  def test_delimiter(self):
+    framing = eventsocket.DelimiterFraming()
+    assert_equals( (['foo','','bar'], bytearray('ba\r')),
+      self._frames(framing, 'foo\r\n\r\nbar\r\nba\r') )
+    assert_equals( 'foo\r\n', framing.encode('foo') )
+
+  def test_delimiter_split_across_reads(self):
+    framing = eventsocket.DelimiterFraming( '\r\n' )
+    buf = eventsocket.ReadBuffer()
+    buf.extend( 'foo\r' )
+    assert_equals( None, buf.next_frame(framing) )
+    buf.extend( '\nbar' )
+    assert_equals( 'foo', buf.next_frame(framing).tobytes() )
+
+  def test_delimiter_when_too_long(self):
+    framing = eventsocket.DelimiterFraming( max_length=4 )
+    assert_equals( ([], bytearray('abcd')), self._frames(framing, 'abcd') )
+    assert_raises( ValueError, self._frames, framing, 'abcde' )
+    assert_raises( ValueError, eventsocket.DelimiterFraming, '' )
+
+  def test_netstring(self):
+    framing = eventsocket.NetstringFraming()
+    assert_equals( (['foo','','hello world'], bytearray('3:ba')),
+      self._frames(framing, '3:foo,0:,11:hello world,3:ba') )
+    assert_equals( ([], bytearray('3:foo')), self._frames(framing, '3:foo') )
+    assert_equals( ([], bytearray('12')), self._frames(framing, '12') )
+    assert_equals( '3:foo,', framing.encode('foo') )
+
+  def test_netstring_when_invalid(self):
+    framing = eventsocket.NetstringFraming( max_length=10 )
+    assert_raises( ValueError, self._frames, framing, 'x:foo,' )
+    assert_raises( ValueError, self._frames, framing, ':foo,' )
+    assert_raises( ValueError, self._frames, framing, '3:fooo' )
+    assert_raises( ValueError, self._frames, framing, '11:' )
+    assert_raises( ValueError, self._frames, framing, '1'*21 )
+
+class TimerWheelTest(Chai):
+
+  def setUp(self):
+    super(TimerWheelTest,self).setUp()
+    mock( eventsocket, 'event' )
+
+  def _socket(self, timeout):
+    sock = EventSocket()
+    sock._inactive_timeout = timeout
+    return sock
+
+  def test_add_starts_ticking(self):
+    wheel = eventsocket.TimerWheel( resolution=0.5, num_slots=8 )
+    sock = self._socket( 2 )
+
+    expect( time, 'time' ).returns( 100.0 )
+    expect( eventsocket.event.timeout ).args( 0.5, wheel._tick_cb ).returns( 'tick_event' )
+
+    wheel.add( sock )
+    assert_equals( 1, wheel._size )
+    assert_equals( 'tick_event', wheel._tick_event )
+    assert_equals( 100.0, sock._last_activity )
+    assert_equals( 204%8, sock._timer_slot )
+
+  def test_add_when_ticking(self):
+    wheel = eventsocket.TimerWheel( resolution=0.5, num_slots=8 )
+    wheel._tick_event = 'tick_event'
+    wheel.now = 100.0
+    wheel._tick = 200
+    sock = self._socket( 0.1 )
+
+    wheel.add( sock )
+    assert_equals( 201%8, sock._timer_slot )
+
+  def test_remove(self):
+    wheel = eventsocket.TimerWheel()
+    wheel._tick_event = 'tick_event'
+    sock = self._socket( 2 )
+    wheel.add( sock )
+
+    wheel.remove( sock )
+    assert_equals( 0, wheel._size )
+    wheel.remove( sock )
+    assert_equals( 0, wheel._size )
+
+  def test_tick_cb_closes_inactive_and_reschedules_active(self):
+    wheel = eventsocket.TimerWheel( resolution=1.0, num_slots=8 )
+    wheel._tick_event = 'tick_event'
+    wheel.now = 100.0
+    wheel._tick = 100
+
+    inactive = self._socket( 2 )
+    active = self._socket( 2 )
+    wheel.add( inactive )
+    wheel.add( active )
+    active._last_activity = 101.0
+
+    expect( time, 'time' ).returns( 102.5 )
+    expect( inactive._inactive_cb )
+
+    assert_true( wheel._tick_cb() )
+    assert_equals( 1, wheel._size )
+    assert_equals( None, inactive._timer_wheel )
+    assert_equals( 103%8, active._timer_slot )
+    assert_true( active in wheel._slots[103%8] )
+
+  def test_tick_cb_stops_when_empty(self):
+    wheel = eventsocket.TimerWheel( resolution=1.0, num_slots=8 )
+    wheel._tick_event = 'tick_event'
+    wheel.now = 100.0
+    wheel._tick = 100
+
+    expect( time, 'time' ).returns( 101.0 )
+
+    assert_equals( None, wheel._tick_cb() )
+    assert_equals( None, wheel._tick_event )
+
+class PreforkServerTest(Chai):
+
+  def setUp(self):
+    super(PreforkServerTest,self).setUp()
+    mock( eventsocket, 'event' )
+    mock( eventsocket, 'signal' )
+
+  def test_init(self):
+    server = eventsocket.PreforkServer( ('',80), workers=3, read_cb='p_read_cb' )
+    assert_equals( ('',80), server._address )
+    assert_equals( 3, server._num_workers )
+    assert_equals( eventsocket.SO_REUSEPORT is not None, server._reuseport )
+    assert_equals( socket.SOMAXCONN, server._backlog )
+    assert_equals( None, server._logger )
+    assert_equals( {'read_cb':'p_read_cb'}, server._kwargs )
+    assert_equals( None, server._sock )
+    assert_equals( {}, server._workers )
+    assert_false( server._running )
+
+  def test_serve_restarts_workers_until_stopped(self):
+    server = eventsocket.PreforkServer( ('',80), workers=2 )
+    server._reuseport = True
+    server._workers = {}
+
+    def spawn():
+      server._workers[ 40+len(server._workers) ] = 0
+    def spawn_and_stop():
+      server._running = False
+      spawn()
+
+    expect( eventsocket.signal.signal ).args( eventsocket.signal.SIGINT, server._stop_cb )
+    expect( eventsocket.signal.signal ).args( eventsocket.signal.SIGTERM, server._stop_cb )
+    expect( server._spawn ).side_effect( spawn ).times( 2 )
+    expect( os, 'wait' ).returns( (41, 0) )
+    expect( time, 'time' ).returns( 5 )
+    expect( server._spawn ).side_effect( spawn_and_stop )
+    expect( os, 'wait' ).returns( (40, 0) )
+    expect( os, 'wait' ).returns( (41, 0) )
+
+    server.serve()
+    assert_false( server._running )
+    assert_equals( {}, server._workers )
+
+  def test_serve_doesnt_restart_when_stopped_during_backoff(self):
+    server = eventsocket.PreforkServer( ('',80), workers=1 )
+    server._reuseport = True
+
+    expect( eventsocket.signal.signal ).any_args().times( 2 )
+    expect( server._spawn ).side_effect( lambda: server._workers.update({40:0.5}) )
+    expect( os, 'wait' ).returns( (40, 1) )
+    expect( time, 'time' ).returns( 1.0 )
+    expect( time, 'sleep' ).args( 1 ).side_effect(
+      lambda: setattr(server, '_running', False) )
+
+    server.serve()
+    assert_equals( {}, server._workers )
+
+  def test_serve_stops_when_no_children(self):
+    server = eventsocket.PreforkServer( ('',80), workers=1 )
+    server._reuseport = True
+
+    expect( eventsocket.signal.signal ).any_args().times( 2 )
+    expect( server._spawn ).side_effect( lambda: server._workers.update({40:0}) )
+    expect( os, 'wait' ).raises( OSError(errno.ECHILD, 'no children') )
+
+    server.serve()
+
+  def test_serve_binds_shared_socket_without_reuseport(self):
+    server = eventsocket.PreforkServer( ('',80), workers=0, reuseport=False )
+    sock = mock()
+    mock( socket, 'socket' )
+
+    expect( socket.socket ).args( socket.AF_INET, socket.SOCK_STREAM ).returns( sock )
+    expect( sock.setsockopt ).args( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+    expect( sock.setblocking ).args( False )
+    expect( sock.bind ).args( ('',80) )
+    expect( sock.listen ).args( socket.SOMAXCONN )
+    expect( eventsocket.signal.signal ).any_args().times( 2 )
+    expect( sock.close )
+
+    server.serve()
+    assert_equals( None, server._sock )
+
+  def test_spawn_in_parent(self):
+    server = eventsocket.PreforkServer( ('',80), workers=1 )
+
+    expect( os, 'fork' ).returns( 42 )
+    expect( time, 'time' ).returns( 3.14 )
+
+    assert_equals( 42, server._spawn() )
+    assert_equals( {42:3.14}, server._workers )
+
+  def test_spawn_in_child(self):
+    server = eventsocket.PreforkServer( ('',80), workers=1 )
+
+    expect( os, 'fork' ).returns( 0 )
+    expect( server._run_worker )
+    expect( os, '_exit' ).args( 0 )
+
+    server._spawn()
+
+  def test_spawn_in_child_when_worker_fails(self):
+    server = eventsocket.PreforkServer( ('',80), workers=1 )
+    mock( eventsocket, 'traceback' )
+
+    expect( os, 'fork' ).returns( 0 )
+    expect( server._run_worker ).raises( RuntimeError('fale') )
+    expect( eventsocket.traceback.print_exc )
+    expect( os, '_exit' ).args( 1 )
+
+    server._spawn()
+
+  def test_stop(self):
+    server = eventsocket.PreforkServer( ('',80), workers=1 )
+    server._running = True
+    server._workers = {42:3.14}
+
+    expect( os, 'kill' ).args( 42, eventsocket.signal.SIGTERM )
+
+    server.stop()
+    assert_false( server._running )
+
+  def test_run_worker_with_reuseport(self):
+    server = eventsocket.PreforkServer( ('',80), workers=1, read_cb='p_read_cb' )
+    server._reuseport = True
+    listener = mock()
+    mock( eventsocket, 'EventSocket' )
+
+    expect( eventsocket.signal.signal ).any_args().times( 2 )
+    expect( eventsocket.event.init )
+    expect( eventsocket.event.signal ).args( eventsocket.signal.SIGTERM, eventsocket.event.abort )
+    expect( eventsocket.EventSocket ).args( read_cb='p_read_cb' ).returns( listener )
+    expect( listener.setsockopt ).args( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+    expect( listener.setsockopt ).args( socket.SOL_SOCKET, eventsocket.SO_REUSEPORT, 1 )
+    expect( listener.setblocking ).args( False )
+    expect( listener.bind ).args( ('',80) )
+    expect( listener.listen ).args( socket.SOMAXCONN )
+    expect( eventsocket.event.dispatch )
+    expect( listener.close )
+
+    server._run_worker()
+
+  def test_run_worker_with_shared_socket(self):
+    server = eventsocket.PreforkServer( ('',80), workers=1, reuseport=False, read_cb='p_read_cb' )
+    server._sock = 'shared'
+    listener = mock()
+    mock( eventsocket, 'EventSocket' )
+
+    expect( eventsocket.signal.signal ).any_args().times( 2 )
+    expect( eventsocket.event.init )
+    expect( eventsocket.event.signal ).args( eventsocket.signal.SIGTERM, eventsocket.event.abort )
+    expect( eventsocket.EventSocket ).args( sock='shared', read_cb='p_read_cb' ).returns( listener )
+    expect( listener._start_accepting )
+    expect( eventsocket.event.dispatch )
+    expect( listener.close )
+
+    server._run_worker()
+
+class ShardedServerTest(Chai):
+
+  def test_init_when_unknown_balance(self):
+    assert_raises( ValueError, eventsocket.ShardedServer, ('',80), balance='random' )
+
+  def test_choose_shard_round_robin(self):
+    server = eventsocket.ShardedServer( ('',80), shards=3 )
+    server._shards = ['a', 'b', 'c']
+    assert_equals( ['a', 'b', 'c', 'a'],
+      [ server._choose_shard() for x in xrange(4) ] )
+
+  def test_choose_shard_least_connections(self):
+    server = eventsocket.ShardedServer( ('',80), shards=3, balance='least-connections' )
+    shards = [ mock(), mock(), mock() ]
+    server._shards = shards
+    for shard,load in zip(shards, (5, 2, 3)):
+      expect( shard.load ).returns( load )
+    mock( eventsocket, 'LoopShard' )
+    eventsocket.LoopShard.load = lambda shard: shard.load()
+
+    assert_true( server._choose_shard() is shards[1] )
+
+  def test_hand_off(self):
+    server = eventsocket.ShardedServer( ('',80), shards=1 )
+    shard = mock()
+    expect( server._choose_shard ).returns( shard )
+    expect( shard.call_soon ).args( shard._accept, 'listener', 'conn', 'addr' )
+
+    server._hand_off( 'listener', 'conn', 'addr' )
+
+  def test_serve_shards_connections_across_threads(self):
+    threads = []
+    def accept_cb(sock):
+      threads.append( threading.current_thread().name )
+    def read_cb(sock):
+      sock.write( sock.read() )
+
+    previous = eventsocket.event
+    server = eventsocket.ShardedServer( ('127.0.0.1',0), shards=2,
+      accept_cb=accept_cb, read_cb=read_cb )
+    thread = threading.Thread( target=server.serve )
+    thread.start()
+    try:
+      while not server.address and thread.is_alive():
+        time.sleep( 0.01 )
+
+      clients = []
+      for x in xrange(4):
+        client = socket.create_connection( server.address, timeout=5 )
+        client.sendall( 'ping%d'%(x) )
+        assert_equals( 'ping%d'%(x), client.recv(10) )
+        clients.append( client )
+    finally:
+      server.stop()
+      thread.join()
+
+    assert_equals( ['eventsocket-shard-0', 'eventsocket-shard-1']*2, threads )
+    # Stopping closes the connections and restores the backend.
+    for client in clients:
+      assert_equals( '', client.recv(10) )
+    assert_true( eventsocket.event is previous )
+
+class LoopShardTest(Chai):
+
+  def setUp(self):
+    super(LoopShardTest,self).setUp()
+    self.shard = eventsocket.LoopShard()
+
+  def tearDown(self):
+    super(LoopShardTest,self).tearDown()
+    self.shard.close()
+
+  def test_call_soon_runs_calls_in_the_loop(self):
+    shard = self.shard
+    calls = []
+    shard.call_soon( calls.append, 1 )
+    shard.call_soon( calls.append, 2 )
+    assert_equals( 3, shard.load() )
+    assert_equals( [], calls )
+
+    shard.backend.loop_once()
+    assert_equals( [1, 2], calls )
+    assert_equals( 1, shard.load() )
+
+  def test_call_soon_logs_errors(self):
+    shard = self.shard
+    shard._logger = mock()
+    calls = []
+    expect( shard._logger.error ).args( 'error in shard callback', exc_info=True )
+
+    shard.call_soon( int, 'x' )
+    shard.call_soon( calls.append, 1 )
+    shard.backend.loop_once()
+    assert_equals( [1], calls )
+
+  def test_run_and_stop(self):
+    shard = self.shard
+    router = eventsocket.ThreadLocalBackend( 'default' )
+    sock = mock()
+    sock.closed = False
+    shard._sockets.add( sock )
+    expect( sock.close )
+
+    shard.call_soon( shard.stop )
+    shard.run( router )
+    assert_equals( 'default', router.current() )
+
+  def test_accept(self):
+    shard = self.shard
+    evsock = EventSocket()
+    expect( EventSocket._accepted ).args( 'listener', 'conn', 'addr' ).returns( evsock )
+
+    shard._accept( 'listener', 'conn', 'addr' )
+    assert_equals( [evsock], list(shard._sockets) )
+
+class ThreadLocalBackendTest(Chai):
+
+  def test_calls_default_until_bound(self):
+    default = mock()
+    backend = mock()
+    router = eventsocket.ThreadLocalBackend( default )
+    expect( default.read ).args( 'sock', 'cb', 'arg' ).returns( 'ev1' )
+    expect( backend.timeout ).args( 1, 'cb' ).returns( 'ev2' )
+    expect( default.dispatch )
+
+    assert_equals( 'ev1', router.read('sock', 'cb', 'arg') )
+    router.bind( backend )
+    assert_equals( 'ev2', router.timeout(1, 'cb') )
+    router.bind( None )
+    router.dispatch()
+
+  def test_bind_is_per_thread(self):
+    router = eventsocket.ThreadLocalBackend( 'default' )
+    router.bind( 'main' )
+    seen = []
+    def run():
+      seen.append( router.current() )
+      router.bind( 'other' )
+      seen.append( router.current() )
+    thread = threading.Thread( target=run )
+    thread.start()
+    thread.join()
+
+    assert_equals( ['default', 'other'], seen )
+    assert_equals( 'main', router.current() )
+    router.bind( None )
+
+  def test_edge_triggered(self):
+    default = mock()
+    default.edge_triggered = True
+    assert_true( eventsocket.ThreadLocalBackend(default).edge_triggered )
+    assert_false( eventsocket.ThreadLocalBackend('default').edge_triggered )
+    assert_true( eventsocket.ThreadLocalBackend('default', True).edge_triggered )
+
+class ExecutorFuture(object):
+  '''
+  Enough of a concurrent.futures Future to test ExecutorOffload.
+  '''
+  def __init__(self, fn, args):
+    self.fn = fn
+    self.args = args
+    self._done = False
+    self._result = None
+    self._exception = None
+    self._callbacks = []
+
+  def done(self):
+    return self._done
+
+  def cancelled(self):
+    return False
+
+  def result(self):
+    if self._exception:
+      raise self._exception
+    return self._result
+
+  def add_done_callback(self, fn):
+    if self._done:
+      fn( self )
+    else:
+      self._callbacks.append( fn )
+
+  def run(self):
+    try:
+      self._result = self.fn( *self.args )
+    except Exception, e:
+      self._exception = e
+    self._done = True
+    for fn in self._callbacks:
+      fn( self )
+
+class Executor(object):
+  def __init__(self):
+    self.futures = []
+
+  def submit(self, fn, *args):
+    future = ExecutorFuture( fn, args )
+    self.futures.append( future )
+    return future
+
+class ExecutorOffloadTest(Chai):
+
+  def setUp(self):
+    super(ExecutorOffloadTest,self).setUp()
+    mock( eventsocket, 'event' )
+    self.wakeup_event = mock()
+    eventsocket.event.read = lambda fd, cb: self.wakeup_event
+    self.executor = Executor()
+    self.sock = EventSocket()
+
+  def tearDown(self):
+    super(ExecutorOffloadTest,self).tearDown()
+    for channel in self.offload._channels:
+      os.close( channel._wakeup_r )
+      os.close( channel._wakeup_w )
+
+  def _deliver(self):
+    self.offload._local.channel._wakeup_cb()
+
+  def test_results_are_written_in_order(self):
+    offload = self.offload = eventsocket.ExecutorOffload( self.executor, str.upper )
+    offload.message_cb( self.sock, memoryview('foo') )
+    offload.message_cb( self.sock, memoryview('bar') )
+    assert_equals( [('foo',), ('bar',)], [ f.args for f in self.executor.futures ] )
+    assert_equals( 2, offload.pending(self.sock) )
+
+    self.executor.futures[1].run()
+    self._deliver()
+    assert_equals( 2, offload.pending(self.sock) )
+
+    expect( self.sock.write ).args( 'FOO' )
+    expect( self.sock.write ).args( 'BAR' )
+    self.executor.futures[0].run()
+    self._deliver()
+    assert_equals( 0, offload.pending(self.sock) )
+    assert_equals( {}, offload._pending )
+
+  def test_read_cb(self):
+    offload = self.offload = eventsocket.ExecutorOffload( self.executor, len )
+    expect( self.sock.read ).returns( 'data' )
+    offload.read_cb( self.sock )
+
+    expect( self.sock.write ).args( 4 )
+    self.executor.futures[0].run()
+    self._deliver()
+
+  def test_reply_cb_and_none_results(self):
+    replies = []
+    offload = self.offload = eventsocket.ExecutorOffload( self.executor,
+      lambda data: None, reply_cb=lambda sock, result: replies.append(result) )
+    offload.message_cb( self.sock, memoryview('foo') )
+    self.executor.futures[0].run()
+    self._deliver()
+    assert_equals( [None], replies )
+
+    offload = self.offload = eventsocket.ExecutorOffload( self.executor, lambda data: None )
+    expect( self.sock.write ).times( 0 )
+    offload.message_cb( self.sock, memoryview('foo') )
+    self.executor.futures[1].run()
+    self._deliver()
+
+  def test_handler_error_is_passed_to_error_cb(self):
+    errors = []
+    self.sock.error_cb = lambda sock, msg, exc: errors.append( (msg, exc) )
+    offload = self.offload = eventsocket.ExecutorOffload( self.executor, int )
+    offload.message_cb( self.sock, memoryview('x') )
+    offload.message_cb( self.sock, memoryview('1') )
+
+    expect( self.sock.write ).args( 1 )
+    for future in self.executor.futures:
+      future.run()
+    self._deliver()
+    assert_equals( 'error in offloaded handler', errors[0][0] )
+    assert_true( isinstance(errors[0][1], ValueError) )
+
+  def test_results_for_closed_socket_are_dropped(self):
+    offload = self.offload = eventsocket.ExecutorOffload( self.executor, str.upper )
+    offload.message_cb( self.sock, memoryview('foo') )
+    self.sock._closed = True
+
+    expect( self.sock.write ).times( 0 )
+    self.executor.futures[0].run()
+    self._deliver()
+    assert_equals( {}, offload._pending )
+
+  def test_max_pending_pauses_reading(self):
+    offload = self.offload = eventsocket.ExecutorOffload( self.executor, str.upper, max_pending=2 )
+    offload.message_cb( self.sock, memoryview('a') )
+    assert_false( self.sock.reading_paused )
+    offload.message_cb( self.sock, memoryview('b') )
+    assert_true( self.sock.reading_paused )
+
+    expect( self.sock.write ).args( 'A' )
+    self.executor.futures[0].run()
+    self._deliver()
+    assert_false( self.sock.reading_paused )
+
+  def test_channel_per_thread(self):
+    offload = self.offload = eventsocket.ExecutorOffload( self.executor, str.upper )
+    channel = offload._channel()
+    assert_true( channel is offload._channel() )
+
+    other = []
+    thread = threading.Thread( target=lambda: other.append(offload._channel()) )
+    thread.start()
+    thread.join()
+    assert_false( other[0] is channel )
+    assert_equals( [channel, other[0]], offload._channels )
+
+  def test_close(self):
+    offload = eventsocket.ExecutorOffload( self.executor, str.upper )
+    channel = offload._channel()
+    self.offload = mock()
+    self.offload._channels = []
+    expect( self.wakeup_event.delete )
+
+    offload.close()
+    assert_equals( [], offload._channels )
+    assert_equals( None, getattr(offload._local, 'channel', None) )
+    assert_raises( OSError, os.close, channel._wakeup_r )
+
+  def test_notify_wakes_loop(self):
+    offload = self.offload = eventsocket.ExecutorOffload( self.executor, str.upper )
+    expect( offload._deliver ).args( self.sock )
+    channel = offload._channel()
+    channel.notify( self.sock )
+    assert_equals( '\0', os.read(channel._wakeup_r, 10) )
+
+    channel._wakeup_cb()
+
+class Future(object):
+  '''
+  Enough of a Future to test AsyncioStream without an asyncio loop.
+  '''
+  def __init__(self):
+    self._done = False
+    self._cancelled = False
+    self.result = None
+    self.exception = None
+
+  def done(self):
+    return self._done
+
+  def cancelled(self):
+    return self._cancelled
+
+  def cancel(self):
+    self._done = self._cancelled = True
+
+  def set_result(self, result):
+    assert not self._done
+    self._done = True
+    self.result = result
+
+  def set_exception(self, exception):
+    assert not self._done
+    self._done = True
+    self.exception = exception
+
+class Loop(object):
+  def create_future(self):
+    return Future()
+
+class AsyncioBackendTest(Chai):
+
+  def setUp(self):
+    super(AsyncioBackendTest,self).setUp()
+    mock( eventsocket, 'event' )
+
+  def test_read_event(self):
+    loop = mock()
+    backend = eventsocket.AsyncioBackend( loop )
+    handle = mock()
+    cb = mock()
+
+    expect( handle.fileno ).returns( 7 )
+    expect( loop.add_reader ).args( 7, func(callable) )
+    ev = backend.read( handle, cb, 'a' )
+    assert_true( ev.pending() )
+
+    # Stays registered while rescheduled, and is removed when it isn't.
+    expect( cb ).args( 'a' ).returns( True )
+    ev._fire()
+    assert_true( ev.pending() )
+
+    expect( cb ).args( 'a' ).returns( None )
+    expect( loop.remove_reader ).args( 7 )
+    ev._fire()
+    assert_false( ev.pending() )
+
+    expect( loop.add_reader ).args( 7, func(callable) )
+    expect( loop.remove_reader ).args( 7 )
+    ev.add()
+    ev.delete()
+    ev.delete()
+    assert_false( ev.pending() )
+
+  def test_init_switches_to_new_loop(self):
+    backend = eventsocket.AsyncioBackend( mock() )
+    mock( eventsocket, 'asyncio' )
+
+    expect( eventsocket.asyncio.new_event_loop ).returns( 'new_loop' )
+    expect( eventsocket.asyncio.set_event_loop ).args( 'new_loop' )
+
+    backend.init()
+    assert_equals( 'new_loop', backend.loop )
+
+  def test_init_without_asyncio(self):
+    backend = eventsocket.AsyncioBackend( mock() )
+    mock( eventsocket, 'asyncio' )
+    eventsocket.asyncio = None
+    assert_raises( ImportError, backend.init )
+
+  def test_write_event_readded_by_callback(self):
+    loop = mock()
+    backend = eventsocket.AsyncioBackend( loop )
+    cb = mock()
+
+    expect( loop.add_writer ).args( 8, func(callable) )
+    ev = backend.write( 8, cb )
+
+    expect( cb ).side_effect( lambda: ev.add() ).returns( None )
+    ev._fire()
+    assert_true( ev.pending() )
+
+  def test_timeout_event(self):
+    loop = mock()
+    backend = eventsocket.AsyncioBackend( loop )
+    cb = mock()
+    timer = mock()
+
+    expect( loop.call_later ).args( 1.5, func(callable) ).returns( timer )
+    ev = backend.timeout( 1.5, cb )
+    assert_true( ev.pending() )
+
+    expect( cb ).returns( True )
+    expect( loop.call_later ).args( 1.5, func(callable) ).returns( timer )
+    ev._fire()
+    assert_true( ev.pending() )
+
+    expect( timer.cancel )
+    ev.delete()
+    assert_false( ev.pending() )
+
+  def test_signal_event_and_loop_control(self):
+    loop = mock()
+    backend = eventsocket.AsyncioBackend( loop )
+
+    expect( loop.add_signal_handler ).args( 15, func(callable) )
+    expect( loop.remove_signal_handler ).args( 15 )
+    expect( loop.run_forever )
+    expect( loop.stop )
+
+    ev = backend.signal( 15, backend.abort )
+    backend.dispatch()
+    ev._fire()
+
+  def test_use_asyncio(self):
+    loop = mock()
+    backend = eventsocket.use_asyncio( loop )
+    assert_true( eventsocket.event is backend )
+    assert_true( backend.loop is loop )
+
+class AsyncioStreamTest(Chai):
+
+  def setUp(self):
+    super(AsyncioStreamTest,self).setUp()
+    mock( eventsocket, 'event' )
+    self.loop = Loop()
+    self.sock = EventSocket( close_cb='close_cb' )
+    mock( self.sock, 'pause_reading' )
+    mock( self.sock, 'resume_reading' )
+    self.stream = eventsocket.AsyncioStream( self.sock, loop=self.loop, limit=8 )
+
+  def test_init_sets_callbacks(self):
+    stream = self.stream
+    assert_equals( stream._read_cb, self.sock._parent_read_cb )
+    assert_equals( stream._closed_cb, self.sock._parent_close_cb )
+    assert_equals( stream._drained_cb, self.sock._parent_output_empty_cb )
+    assert_equals( stream._drained_cb, self.sock._parent_write_resumed_cb )
+    assert_equals( 'close_cb', stream._close_cb )
+
+  def test_reads_complete_in_order(self):
+    stream = self.stream
+    f1 = stream.readexactly( 3 )
+    f2 = stream.readuntil( '\n' )
+    f3 = stream.read()
+    assert_false( f1.done() )
+
+    self.sock.buffer( 'abcde' )
+    stream._read_cb( self.sock )
+    assert_equals( 'abc', f1.result )
+    assert_false( f2.done() )
+
+    self.sock.buffer( 'f\ngh' )
+    stream._read_cb( self.sock )
+    assert_equals( 'def\n', f2.result )
+    assert_equals( 'gh', f3.result )
+    assert_false( stream.at_eof() )
+
+  def test_read_with_limit(self):
+    stream = self.stream
+    self.sock.buffer( 'abcd' )
+    stream._read_cb( self.sock )
+    assert_equals( 'ab', stream.read( 2 ).result )
+    assert_equals( 'cd', stream.read( 5 ).result )
+
+  def test_pauses_reading_over_limit(self):
+    stream = self.stream
+    self.sock.buffer( 'abcdefghij' )
+    expect( self.sock.pause_reading )
+    stream._read_cb( self.sock )
+
+    expect( self.sock.resume_reading )
+    assert_equals( 'abcdefghij', stream.read().result )
+
+  def test_resumes_reading_for_waiting_read(self):
+    stream = self.stream
+    self.sock.buffer( 'abcdefghij' )
+    expect( self.sock.pause_reading )
+    stream._read_cb( self.sock )
+
+    expect( self.sock.resume_reading )
+    f = stream.readexactly( 20 )
+    assert_false( f.done() )
+
+  def test_readuntil_over_limit(self):
+    stream = self.stream
+    f = stream.readuntil( '\n' )
+    self.sock.buffer( 'abcdefghij' )
+    expect( self.sock.pause_reading )
+    stream._read_cb( self.sock )
+    assert_true( isinstance(f.exception, ValueError) )
+
+  def test_cancelled_read_is_skipped(self):
+    stream = self.stream
+    f1 = stream.read()
+    f2 = stream.read()
+    f1.cancel()
+    self.sock.buffer( 'abc' )
+    stream._read_cb( self.sock )
+    assert_equals( 'abc', f2.result )
+
+  def test_close_completes_reads_and_drains(self):
+    stream = self.stream
+    self.sock._parent_close_cb = mock()
+    stream._close_cb = mock()
+    self.sock.write( 'data' )
+    f1 = stream.readexactly( 3 )
+    f2 = stream.read()
+    f3 = stream.drain()
+    assert_false( f3.done() )
+
+    self.sock.buffer( 'ab' )
+    stream._read_cb( self.sock )
+    expect( stream._close_cb ).args( self.sock )
+    stream._closed_cb( self.sock )
+    assert_true( isinstance(f1.exception, EOFError) )
+    assert_equals( 'ab', f2.result )
+    assert_true( isinstance(f3.exception, socket.error) )
+    assert_equals( '', stream.read().result )
+    assert_true( stream.at_eof() )
+
+  def test_drain(self):
+    stream = self.stream
+    assert_true( stream.drain().done() )
+
+    self.sock.write( 'data' )
+    f = stream.drain()
+    stream._drained_cb( self.sock )
+    assert_false( f.done() )
+
+    self.sock._write_buf_bytes = 0
+    stream._drained_cb( self.sock )
+    assert_true( f.done() )
+
+  def test_drain_with_high_water(self):
+    stream = self.stream
+    self.sock._write_high_water = 4
+    self.sock._write_buf_bytes = 2
+    assert_true( stream.drain().done() )
+
+    self.sock._write_paused = True
+    f = stream.drain()
+    assert_false( f.done() )
+    self.sock._write_paused = False
+    stream._drained_cb( self.sock )
+    assert_true( f.done() )
+
+class EpollBackendTest(Chai):
+
+  def setUp(self):
+    super(EpollBackendTest,self).setUp()
+    self.backend = eventsocket.EpollBackend()
+    self.r, self.w = os.pipe()
+
+  def tearDown(self):
+    super(EpollBackendTest,self).tearDown()
+    self.backend.close()
+    for fd in (self.r, self.w):
+      try:
+        os.close( fd )
+      except OSError:
+        pass
+
+  def test_read_event(self):
+    backend = self.backend
+    calls = []
+    def cb(arg):
+      calls.append( os.read(self.r, 10) )
+      return len(calls)<2 or None
+
+    ev = backend.read( self.r, cb, 'arg' )
+    assert_true( ev.pending() )
+    assert_false( backend.loop_once(block=False) and calls )
+
+    os.write( self.w, 'a' )
+    backend.loop_once()
+    assert_equals( ['a'], calls )
+    assert_true( ev.pending() )
+    assert_equals( {self.r: select.EPOLLIN}, backend._registered )
+
+    os.write( self.w, 'b' )
+    backend.loop_once()
+    assert_equals( ['a', 'b'], calls )
+    assert_false( ev.pending() )
+
+    # Nothing left to wait for.
+    assert_false( backend.loop_once() )
+    assert_equals( {}, backend._registered )
+
+  def test_delete_and_add_before_poll_doesnt_update_epoll(self):
+    backend = self.backend
+    ev = backend.write( self.w, lambda: None )
+    backend.loop_once( block=False )
+    ev2 = backend.read( self.r, lambda: True )
+    backend._update()
+
+    mock( backend, '_epoll' )
+    ev2.delete()
+    ev2.add()
+    backend._update()
+    assert_equals( {self.r: select.EPOLLIN}, backend._registered )
+
+  def test_write_event_and_dispatch(self):
+    backend = self.backend
+    calls = []
+    backend.write( self.w, lambda: calls.append(1) )
+    backend.dispatch()
+    assert_equals( [1], calls )
+
+  def test_timers(self):
+    backend = self.backend
+    calls = []
+    backend.timeout( 0.02, calls.append, 'b' )
+    backend.timeout( 0, calls.append, 'a' )
+    ev = backend.timeout( 0.01, calls.append, 'c' )
+    ev.delete()
+    ticks = []
+    backend.timeout( 0, lambda: ticks.append(1) or (len(ticks)<3 or None) )
+
+    backend.dispatch()
+    assert_equals( ['a', 'b'], calls )
+    assert_equals( 3, len(ticks) )
+    assert_equals( [], backend._timers )
+
+  def test_deleted_timers_are_compacted(self):
+    backend = self.backend
+    ev = backend.timeout( 60, lambda: None )
+    for i in xrange(100):
+      ev.delete()
+      ev = backend.timeout( 60, lambda: None )
+    assert_true( len(backend._timers)<100 )
+    assert_true( ev.pending() )
+
+  def test_signal_and_abort(self):
+    backend = self.backend
+    handler = signal.getsignal( signal.SIGUSR1 )
+    calls = []
+    def cb():
+      calls.append( 1 )
+      backend.abort()
+      return True
+
+    ev = backend.signal( signal.SIGUSR1, cb )
+    backend.timeout( 0, os.kill, os.getpid(), signal.SIGUSR1 )
+    backend.timeout( 5, calls.append, 'timeout' )
+    backend.dispatch()
+    assert_equals( [1], calls )
+    assert_true( ev.pending() )
+
+    ev.delete()
+    assert_equals( handler, signal.getsignal(signal.SIGUSR1) )
+
+  def test_close(self):
+    backend = self.backend
+    handler = signal.getsignal( signal.SIGUSR1 )
+    backend.read( self.r, lambda: True )
+    backend.signal( signal.SIGUSR1, lambda: None )
+    assert_equals( 1, backend.fd_count() )
+    wakeup_r = backend._wakeup_r
+
+    backend.close()
+    assert_equals( handler, signal.getsignal(signal.SIGUSR1) )
+    assert_raises( OSError, os.fstat, wakeup_r )
+    backend.close()
+
+  def test_edge_triggered(self):
+    backend = eventsocket.EpollBackend( edge_triggered=True )
+    try:
+      reads = []
+      writes = []
+      rev = backend.read( self.r, lambda: reads.append(os.read(self.r, 1)) or True )
+      wev = backend.write( self.w, lambda: writes.append(1) )
+      backend._update()
+      assert_equals( {self.r: backend.ET_MASK, self.w: backend.ET_MASK},
+        backend._registered )
+
+      os.write( self.w, 'ab' )
+      backend.loop_once()
+      backend.loop_once( block=False )
+      assert_equals( ['a'], reads )
+      assert_equals( [1], writes )
+
+      # Adding a write event again arms it for the next poll.
+      wev.add()
+      backend.loop_once( block=False )
+      assert_equals( [1, 1], writes )
+
+      # A read callback that stopped early must re-arm its event.
+      rev.add()
+      backend.loop_once( block=False )
+      assert_equals( ['a', 'b'], reads )
+    finally:
+      backend.close()
+
+  def test_reused_fd_is_registered_again(self):
+    backend = self.backend
+    ev = backend.read( self.r, lambda: True )
+    backend.loop_once( block=False )
+
+    # Close and reopen the fd without applying the change to epoll.
+    ev.delete()
+    os.close( self.r )
+    os.close( self.w )
+    self.r, self.w = os.pipe()
+    calls = []
+    backend.read( self.r, lambda: calls.append(os.read(self.r, 1)) )
+    os.write( self.w, 'a' )
+    backend.loop_once()
+    assert_equals( ['a'], calls )
+
+class SetBackendTest(Chai):
+
+  def setUp(self):
+    super(SetBackendTest,self).setUp()
+    mock( eventsocket, 'event' )
+    mock( eventsocket, '_edge_triggered' )
+
+  def test_by_name(self):
+    backend = eventsocket.set_backend( 'epoll-et' )
+    assert_true( isinstance(backend, eventsocket.EpollBackend) )
+    assert_true( eventsocket.event is backend )
+    assert_true( eventsocket._edge_triggered )
+    backend.close()
+
+    if eventsocket._libevent:
+      assert_true( eventsocket.set_backend('libevent') is eventsocket._libevent )
+      assert_false( eventsocket._edge_triggered )
+
+  def test_by_object(self):
+    backend = mock()
+    backend.edge_triggered = False
+    assert_true( eventsocket.set_backend(backend) is backend )
+    assert_true( eventsocket.event is backend )
+
+  def test_unknown_name(self):
+    assert_raises( ValueError, eventsocket.set_backend, 'kqueue' )
+
+  def test_default_created_on_first_use(self):
+    default = eventsocket._DefaultBackend()
+    eventsocket.event = default
+    backend = mock()
+    mock( eventsocket, 'set_backend' )
+    expect( eventsocket.set_backend ).args( str ).returns( backend )
+    expect( backend.dispatch )
+
+    default.dispatch()
+    assert_true( default.resolve() is backend )
+
+  def test_default_when_replaced_before_use(self):
+    default = eventsocket._DefaultBackend()
+    eventsocket.event = mock()
+    mock( eventsocket, 'set_backend' )  # assert not called
+    mock( eventsocket, '_new_backend' )
+    backend = mock()
+    expect( eventsocket._new_backend ).args( str ).returns( backend )
+
+    assert_true( default.resolve() is backend )
+    assert_true( default.resolve() is backend )
+
+  def test_epoll_when_not_supported(self):
+    epoll = select.epoll
+    del select.epoll
+    try:
+      assert_raises( ImportError, eventsocket.set_backend, 'epoll' )
+    finally:
+      select.epoll = epoll